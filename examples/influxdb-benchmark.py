@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the influxdb service plugin against a local fake InfluxDB /write endpoint.
+
+Usage: influxdb-benchmark.py [<number of messages>]
+
+"""
+
+import gzip
+import logging
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from mqttwarn.httpclient import get_session
+from mqttwarn.services.influxdb import Plugin
+from mqttwarn.util import Struct
+
+
+class WriteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+
+        self.server.lines += body.count(b'\n') + 1
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeInfluxDB(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    lines = 0
+
+
+def run(server, num_messages, **options):
+    config = dict(host='localhost', port=server.server_port, database='bench', **options)
+    plugin = Plugin(Struct(log=logging.getLogger('influxdb'), http=get_session()), config)
+    server.lines = 0
+    start = time.time()
+
+    for i in range(num_messages):
+        data = {'topic': 'sensors/kitchen', 'room': 'kitchen', 'temperature': 20.0 + i % 10,
+                'humidity': i % 100, '_dtepoch': time.time()}
+        item = Struct(service='influxdb', target='sensors', topic='sensors/kitchen',
+                      addrs=['sensors', ['room']], data=data, message='')
+        plugin(plugin.srv, item)
+
+    if plugin.batch_size:
+        plugin.flush()
+
+    elapsed = time.time() - start
+    assert server.lines == num_messages, server.lines
+    print("%-40s %8.0f messages/s" % (", ".join("%s=%s" % opt for opt in options.items()) or
+                                       "defaults", num_messages / elapsed))
+
+
+def main(args=None):
+    num_messages = int((args or sys.argv[1:] or [5000])[0])
+    server = FakeInfluxDB(('localhost', 0), WriteHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    run(server, num_messages)
+    run(server, num_messages, batch_size=1000)
+    run(server, num_messages, batch_size=1000, gzip=True)
+    run(server, num_messages, batch_size=5000, precision='s')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# (c) 2014-2019 The mqttwarn developers
+"""Optional HTTP endpoint for inspecting the state of a running mqttwarn instance."""
+
+import json
+import logging
+import os
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+log = logging.getLogger(__name__)
+
+
+class AdminRequestHandler(BaseHTTPRequestHandler):
+    """Answer GET requests with the JSON-encoded result of the server's status function."""
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/status'):
+            self.send_error(404)
+            return
+
+        try:
+            body = json.dumps(self.server.status_func(), indent=2, default=str).encode('utf-8')
+        except Exception as exc:
+            log.exception("Cannot compile status information: %s", exc)
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Clients connected via a unix socket have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s", self.address_string(), format % args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class AdminServer(object):
+    """Serve status information on a TCP address or unix socket in a background thread.
+
+    ``address`` is either ``host:port`` or ``unix:/path/to/socket``.
+    ``status_func`` is called for each request and must return a JSON-serializable dict.
+
+    """
+
+    def __init__(self, address, status_func):
+        self.address = address
+        self.status_func = status_func
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if self.address.startswith('unix:'):
+            path = self.address[5:]
+
+            if os.path.exists(path):
+                os.unlink(path)
+
+            self.server = ThreadingUnixHTTPServer(path, AdminRequestHandler)
+        else:
+            host, _, port = self.address.rpartition(':')
+            self.server = ThreadingHTTPServer((host or 'localhost', int(port)),
+                                              AdminRequestHandler)
+
+        self.server.status_func = self.status_func
+        self.thread = threading.Thread(target=self.server.serve_forever, name='admin')
+        self.thread.daemon = True
+        self.thread.start()
+        log.info("Admin endpoint listening on %s.", self.address)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+            if self.address.startswith('unix:'):
+                try:
+                    os.unlink(self.address[5:])
+                except OSError:
+                    pass
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# (c) 2014-2019 The mqttwarn developers
+"""Read and write captured MQTT traffic for the ``record`` and ``replay`` commands.
+
+A capture file starts with the ``MAGIC`` bytes, followed by one record per
+message. Each record consists of a fixed-size header (see ``RECORD_HEADER``)
+holding the receive timestamp, QoS and retain flag and the lengths of topic
+and payload, followed by the UTF-8 encoded topic and the raw payload.
+
+"""
+
+import struct
+import time
+from collections import namedtuple
+
+
+MAGIC = b'MQTTWARN-CAPTURE\x01'
+
+# timestamp (float seconds since epoch), flags (bits 0-1: QoS, bit 2: retain),
+# topic length, payload length
+RECORD_HEADER = struct.Struct('>dBHI')
+
+FLAG_RETAIN = 0x04
+
+
+# Captured message, usable in place of a paho MQTTMessage object
+CapturedMessage = namedtuple('CapturedMessage', 'timestamp topic payload qos retain')
+
+
+class CaptureFormatError(Exception):
+    pass
+
+
+class CaptureWriter(object):
+    """Append received MQTT messages to a capture file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        self.fp = open(filename, 'wb')
+        self.fp.write(MAGIC)
+
+    def write(self, topic, payload, qos=0, retain=False, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        if isinstance(topic, str):
+            topic = topic.encode('utf-8')
+
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif payload is None:
+            payload = b''
+
+        flags = (qos & 0x03) | (FLAG_RETAIN if retain else 0)
+        self.fp.write(RECORD_HEADER.pack(timestamp, flags, len(topic), len(payload)))
+        self.fp.write(topic)
+        self.fp.write(payload)
+        self.count += 1
+
+    def close(self):
+        self.fp.close()
+
+
+def read_capture(filename):
+    """Return an iterator over the ``CapturedMessage`` records in a capture file."""
+    with open(filename, 'rb') as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise CaptureFormatError("'%s' is not an mqttwarn capture file." % filename)
+
+        while True:
+            header = fp.read(RECORD_HEADER.size)
+
+            if not header:
+                break
+
+            if len(header) < RECORD_HEADER.size:
+                raise CaptureFormatError("Truncated record header in '%s'." % filename)
+
+            timestamp, flags, topic_len, payload_len = RECORD_HEADER.unpack(header)
+            topic = fp.read(topic_len)
+            payload = fp.read(payload_len)
+
+            if len(topic) < topic_len or len(payload) < payload_len:
+                raise CaptureFormatError("Truncated record in '%s'." % filename)
+
+            yield CapturedMessage(timestamp, topic.decode('utf-8'), payload, flags & 0x03,
+                                  int(bool(flags & FLAG_RETAIN)))
@@ -11,8 +11,8 @@ from docopt import docopt
 
 from . import __version__
 from .configuration import Config
-from .core import bootstrap, connect, cleanup, run_plugin
-from .util import get_resource_content
+from .core import bootstrap, connect, cleanup, record, replay, run_plugin
+from .util import AsyncLogHandler, DebugSampler, JsonFormatter, get_resource_content
 
 
 log = logging.getLogger(__name__)
@@ -26,6 +26,8 @@ def run():
       {program} [make-config]
       {program} [make-samplefuncs]
       {program} [--plugin=] [--data=]
+      {program} record --out=<file>
+      {program} replay <file> [--speed=<speed>]
       {program} --version
       {program} (-h | --help)
 
@@ -33,6 +35,16 @@ def run():
       make-config               Will dump configuration file content to STDOUT,
                                 suitable for redirecting into a configuration file.
 
+    Record and replay options:
+      record                    Write messages received on the topics of all topic
+                                handlers to a capture file instead of handling them.
+      --out=<file>              Name of capture file to write.
+      replay                    Pass messages from a capture file through the
+                                message handling machinery without a broker.
+      --speed=<speed>           Replay speed relative to the original timing,
+                                e.g. "2x", or "max" for as fast as possible
+                                [default: 1x].
+
     Miscellaneous options:
       --version                 Show version information
       -h --help                 Show this screen
@@ -60,6 +72,17 @@ def run():
         # Launch service plugin in standalone mode
         launch_plugin_standalone(plugin, data)
 
+    elif options['record']:
+        run_record(os.path.abspath(options['--out']))
+
+    elif options['replay']:
+        try:
+            speed = parse_speed(options['--speed'])
+        except ValueError:
+            sys.exit("Invalid replay speed: %s" % options['--speed'])
+
+        run_replay(os.path.abspath(options['<file>']), speed)
+
     # Run mqttwarn in service mode when no command line arguments are given
     else:
         run_mqttwarn()
@@ -101,6 +124,35 @@ def run_mqttwarn():
     connect()
 
 
+def run_record(filename):
+    scriptname = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    config = load_configuration(name=scriptname)
+    setup_logging(config)
+    bootstrap(config=config, scriptname=scriptname)
+    record(filename)
+
+
+def run_replay(filename, speed):
+    scriptname = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    config = load_configuration(name=scriptname)
+    setup_logging(config)
+    bootstrap(config=config, scriptname=scriptname)
+    replay(filename, speed=speed)
+
+
+def parse_speed(value):
+    """Parse replay speed like "2x" or "0.5" into a float, or "max" into None."""
+    if value.lower() == 'max':
+        return None
+
+    speed = float(value.lower().rstrip('x'))
+
+    if speed <= 0:
+        raise ValueError("Speed must be positive.")
+
+    return speed
+
+
 def load_configuration(configfile=None, name=None):
     if configfile is None:
         configfile = os.getenv(name.upper() + 'INI', name + '.ini')
@@ -123,8 +175,28 @@ def setup_logging(config):
     # Send log messages to sys.stderr by configuring "logfile = stream://sys.stderr"
     if config.logfile.startswith('stream://sys.'):
         stream = getattr(sys, config.logfile.replace('stream://sys.', ''))
-        logging.basicConfig(stream=stream, level=level, format=config.logformat)
+        handler = logging.StreamHandler(stream)
 
     # Send log messages to file by configuring "logfile = 'mqttwarn.log'"
     else:
-        logging.basicConfig(filename=config.logfile, level=level, format=config.logformat)
+        handler = logging.FileHandler(config.logfile)
+
+    if config.logjson:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(config.logformat))
+
+    # Write log records in a background thread
+    if config.logasync:
+        handler = AsyncLogHandler(handler)
+
+    if config.logsample > 1:
+        handler.addFilter(DebugSampler(config.logsample))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+
+    # Per-subsystem log level overrides, e.g. {'mqttwarn.services.smtp': 'INFO'}
+    for name, sublevel in (config.loglevels or {}).items():
+        logging.getLogger(name).setLevel(sublevel.upper())
@@ -2,10 +2,16 @@
 # (c) 2014-2019 The mqttwarn developers
 
 import ast
+import hashlib
 import logging
-
+import os
+import pickle
+from collections import namedtuple
 from io import open
 
+from . import __version__
+from .util import is_funcspec
+
 try:
     from configparser import RawConfigParser, NoOptionError, _UNSET
 except ImportError:
@@ -26,6 +32,86 @@ except (AttributeError, ImportError):
 
 log = logging.getLogger(__name__)
 
+# Reference to an importable function, pre-parsed from a "module.path:func()" option value
+FuncSpec = namedtuple('FuncSpec', 'dottedpath funcname')
+
+# Sections, which are neither topic handler nor service sections
+RESERVED_SECTIONS = ('defaults', 'failover')
+RESERVED_PREFIXES = ('cron:', 'config:')
+
+
+def is_private(path):
+    """Return whether ``path`` is owned by the current user and not writable by others."""
+    if not hasattr(os, 'getuid'):
+        return True
+
+    st = os.stat(path)
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+class FrozenSettings(object):
+    """Slot-based container for the pre-evaluated options of a config section.
+
+    Subclasses list their option names in ``_fields``, which doubles as ``__slots__``.
+    Attributes cannot be reassigned, but option values (e.g. the dict of
+    ``targets``) are shared by all users of the settings and must not be
+    modified in place.
+
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def __init__(self, *args, **kwargs):
+        values = dict(zip(self._fields, args))
+        values.update(kwargs)
+
+        for name in self._fields:
+            object.__setattr__(self, name, values.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("'%s' object is immutable" % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("'%s' object is immutable" % type(self).__name__)
+
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, name) for name in self._fields))
+
+    def __repr__(self):
+        return "<%s('%s')>" % (type(self).__name__, self.section)
+
+
+class HandlerSettings(FrozenSettings):
+    """Typed options of a topic handler section.
+
+    Transformation options (``datamap``, ``format``, ``title``, ``image`` and
+    ``priority``) hold either a dict, a ``FuncSpec`` or a plain string. The
+    ``filter`` option holds a ``FuncSpec`` or None.
+
+    """
+    __slots__ = _fields = ('section', 'topic', 'targets', 'qos', 'filter', 'datamap', 'format',
+                           'title', 'image', 'priority', 'template')
+
+
+class ServiceSettings(FrozenSettings):
+    """Typed options of a ``[config:xxx]`` service section."""
+    __slots__ = _fields = ('section', 'name', 'module', 'targets', 'config')
+
+
+class ConfigSnapshot(object):
+    """Pre-compiled settings of all topic handler and service sections of a configuration."""
+
+    __slots__ = ('digest', 'handlers', 'services')
+
+    def __init__(self, digest, handlers, services):
+        self.digest = digest
+        # Ordered mappings of section / service name to settings object
+        self.handlers = handlers
+        self.services = services
+
+    def __reduce__(self):
+        return (type(self), (self.digest, self.handlers, self.services))
+
 
 class Config(RawConfigParser):
     """RawConfigParser wrapper providing defaults and custom config value access methods."""
@@ -39,6 +125,7 @@ class Config(RawConfigParser):
     def __init__(self, configuration_file, defaults=None):
         defaults = defaults or {}
         super(Config, self).__init__()
+        self.configuration_file = configuration_file
 
         with open(configuration_file, 'r', encoding='utf-8') as fp:
             self.readfp(fp)
@@ -54,12 +141,35 @@ class Config(RawConfigParser):
         self.skipretained = False
         self.clean_session = False
         self.protocol = 4
+        self.share_group = None
 
         self.logformat = '%(asctime)-15s %(levelname)-8s [%(name)-25s] %(message)s'
         self.logfile = None
         self.loglevel = 'DEBUG'
+        self.loglevels = None
+        self.logasync = False
+        self.logjson = False
+        self.logsample = 1
 
         self.num_workers = 1
+        self.num_processes = 0
+        self.ingest_buffer_size = 0
+        self.num_dispatchers = 1
+        self.ingest_overflow = 'drop'
+        self.cron_workers = 4
+        self.admin_address = None
+
+        self.drain_timeout = 30
+        self.spool_file = None
+
+        self.http_timeout = 10
+        self.http_retries = 2
+        self.dns_cache_ttl = 300
+
+        self.lazy_services = False
+        self.prefetch_services = True
+
+        self.config_cache = None
 
         self.directory = '.'
         self.ca_certs = None
@@ -155,3 +265,148 @@ class Config(RawConfigParser):
         if self.has_section(section):
             return {key: self.g(section, key)
                     for key in self.options(section) if key not in exclude_keys}
+
+    def is_handler_section(self, section):
+        return section not in RESERVED_SECTIONS and not section.startswith(RESERVED_PREFIXES)
+
+    def get_formatter(self, section, option):
+        """Return value of a transformation option as a dict, ``FuncSpec`` or string.
+
+        Returns None if the option is not present in the section.
+
+        """
+        if not self.has_option(section, option):
+            return None
+
+        value = self.g(section, option)
+
+        if isinstance(value, dict):
+            return value
+
+        return self.get_funcspec(section, option) or self.get(section, option)
+
+    def get_funcspec(self, section, option):
+        """Return value of given section and option as a ``FuncSpec``.
+
+        Returns None if the option is not present or no valid function reference.
+
+        """
+        value = self.get(section, option, fallback=None)
+
+        if is_funcspec(value):
+            return FuncSpec(*value.rstrip('()').split(':', 1))
+
+    def compile_handler(self, section):
+        return HandlerSettings(
+            section=section,
+            topic=self.get(section, 'topic', fallback=section),
+            targets=self.g(section, 'targets', fallback=None),
+            qos=self.getint(section, 'qos', fallback=0),
+            filter=self.get_funcspec(section, 'filter'),
+            datamap=self.get_formatter(section, 'datamap'),
+            format=self.get_formatter(section, 'format'),
+            title=self.get_formatter(section, 'title'),
+            image=self.get_formatter(section, 'image'),
+            priority=self.get_formatter(section, 'priority'),
+            template=self.g(section, 'template', fallback=None),
+        )
+
+    def compile_service(self, section):
+        name = section.split(':', 1)[1]
+
+        try:
+            targets = self.getdict(section, 'targets')
+        except Exception as exc:
+            log.debug("Invalid targets for service '%s': %s", name, exc)
+            targets = None
+
+        return ServiceSettings(
+            section=section,
+            name=name,
+            module=self.g(section, 'module', fallback=name),
+            targets=targets,
+            config=self.config(section),
+        )
+
+    def compile(self, digest=None):
+        """Turn all topic handler and service sections into a ``ConfigSnapshot``."""
+        handlers = {}
+        services = {}
+
+        for section in self.sections():
+            if section.startswith('config:'):
+                settings = self.compile_service(section)
+                services[settings.name] = settings
+            elif self.is_handler_section(section):
+                if self.has_option(section, 'targets'):
+                    handlers[section] = self.compile_handler(section)
+                else:
+                    log.warn("Section '%s' has no targets defined.", section)
+
+        return ConfigSnapshot(digest, handlers, services)
+
+    def get_digest(self):
+        """Return a hash identifying the contents of the configuration file."""
+        digest = hashlib.sha1(__version__.encode('ascii'))
+
+        with open(self.configuration_file, 'rb') as fp:
+            digest.update(fp.read())
+
+        return digest.hexdigest()
+
+    def snapshot(self, cachedir=None):
+        """Return a ``ConfigSnapshot`` of the configuration.
+
+        If ``cachedir`` is given, the snapshot is loaded from a cache file in
+        this directory, which is keyed by a hash of the configuration file
+        contents. On a cache miss, the configuration is compiled and the cache
+        file written. Since unpickling can run arbitrary code, the cache file
+        is only loaded if it and the directory are owned by the current user
+        and not writable by others.
+
+        """
+        if not cachedir:
+            return self.compile()
+
+        digest = self.get_digest()
+        basename = os.path.splitext(os.path.basename(self.configuration_file))[0]
+        cachefile = os.path.join(cachedir, '%s-%s.snapshot' % (basename, digest))
+
+        try:
+            if not (is_private(cachedir) and is_private(cachefile)):
+                raise ValueError("file or directory not owned by the current user or "
+                                 "writable by others")
+
+            with open(cachefile, 'rb') as fp:
+                snapshot = pickle.load(fp)
+        except FileNotFoundError:
+            pass
+        except Exception as exc:
+            log.warning("Cannot read configuration snapshot from '%s': %s", cachefile, exc)
+        else:
+            if isinstance(snapshot, ConfigSnapshot) and snapshot.digest == digest:
+                log.debug("Loaded configuration snapshot from '%s'.", cachefile)
+                return snapshot
+
+        snapshot = self.compile(digest)
+
+        try:
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir, mode=0o700)
+
+            tmpfile = cachefile + '.tmp'
+
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+
+            with os.fdopen(os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600),
+                           'wb') as fp:
+                pickle.dump(snapshot, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmpfile, cachefile)
+        except Exception as exc:
+            log.warning("Cannot write configuration snapshot to '%s': %s", cachefile, exc)
+        else:
+            log.debug("Wrote configuration snapshot to '%s'.", cachefile)
+
+        return snapshot
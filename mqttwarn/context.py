@@ -21,35 +21,24 @@ class RuntimeContext(object):
     """
     def __init__(self, config):
         self.config = config
+        self._snapshot = None
 
-    def get_handler_sections(self):
-        sections = []
-
-        for section in self.config.sections():
-            if section == 'defaults':
-                continue
-
-            if section.startswith('cron:'):
-                continue
+    @property
+    def snapshot(self):
+        """Pre-compiled handler and service settings (see ``Config.snapshot``)."""
+        if self._snapshot is None:
+            self._snapshot = self.config.snapshot(cachedir=self.config.config_cache)
 
-            if section == 'failover':
-                continue
+        return self._snapshot
 
-            if section.startswith('config:'):
-                continue
-
-            if self.config.has_option(section, 'targets'):
-                sections.append(section)
-            else:
-                log.warn("Section '%s' has no targets defined.", section)
+    def get_handler_sections(self):
+        return list(self.snapshot.handlers)
 
-        return sections
+    def get_handler_settings(self, section):
+        return self.snapshot.handlers[section]
 
     def get_handler_topic(self, section):
-        if self.config.has_option(section, 'topic'):
-            return self.config.get(section, 'topic')
-
-        return section
+        return self.snapshot.handlers[section].topic
 
     def get_config(self, section, name):
         if self.config.has_option(section, name):
@@ -73,7 +62,7 @@ class RuntimeContext(object):
         be imported.
 
         """
-        value = self.config.g(section, 'targets', fallback=None)
+        value = self.snapshot.handlers[section].targets
 
         if is_funcspec(value):
             dottedpath, funcname = value.split(':', 1)
@@ -100,6 +89,9 @@ class RuntimeContext(object):
 
             return value
         elif isinstance(value, dict):
+            # Don't modify the dict held by the settings snapshot, it is shared
+            value = dict(value)
+
             for topic, targetlist in list(value.items()):
                 value[topic] = []
 
@@ -123,13 +115,19 @@ class RuntimeContext(object):
         return self.config[section]
 
     def get_service_config(self, service):
-        return self.config.config('config:' + service)
+        settings = self.snapshot.services.get(service)
+
+        if settings is not None:
+            return dict(settings.config)
 
     def get_service_module(self, service):
-        return self.config.g('config:' + service, 'module', fallback=service)
+        settings = self.snapshot.services.get(service)
+        return settings.module if settings is not None else service
 
     def get_service_targets(self, service):
-        try:
-            return self.config.getdict('config:' + service, 'targets')
-        except Exception as exc:
-            log.error("No valid targets defined for service '%s': %s", service, exc)
+        settings = self.snapshot.services.get(service)
+
+        if settings is None or settings.targets is None:
+            log.error("No valid targets defined for service '%s'.", service)
+        else:
+            return settings.targets
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 # (c) 2014-2019 The mqttwarn developers
 
+import glob
 import logging
 import os
+import pickle
+import signal
 import socket
 import sys
 import threading
@@ -15,9 +18,15 @@ import paho.mqtt.client as paho
 import six
 import stopit
 
+from .admin import AdminServer
+from .capture import CaptureWriter, read_capture
+from .configuration import FuncSpec
 from .context import RuntimeContext
-from .cron import PeriodicThread
-from .util import Struct, is_funcspec, load_function
+from .cron import CronExpression, PeriodicTask, Scheduler
+from .httpclient import get_session
+from .sharding import PublishProxy, ShardRouter, shard_for
+from .util import (RingBuffer, Struct, load_function, set_shutdown_deadline, shutdown_timeout,
+                   stop_flushers)
 
 try:
     import json
@@ -41,6 +50,9 @@ else:
 
 log = logging.getLogger(__name__)
 
+# MQTT protocol version 5 (paho.MQTTv5 is not available in paho-mqtt < 1.5)
+MQTTv5 = 5
+
 # lwt values - may make these configurable later?
 LWTALIVE = "1"
 LWTDEAD = "0"
@@ -57,16 +69,49 @@ cf = None
 # Global handle to MQTT client
 mqttc = None
 
+# Functions called by the MQTT client callbacks, registered by service plugins
+connect_callbacks = []
+publish_callbacks = []
+
 # Initialize processor queue
 jobq = queue.Queue(maxsize=0)
 exit_flag = False
 
-# Instances of PeriodicThread objects
+# Serializes saving jobs left over when shutting down: the file given to drain()
+# and the records saved to it so far
+spill_lock = threading.RLock()
+spill_file = None
+spilled_records = {}
+
+# Instances of PeriodicTask objects
 ptlist = {}
 
+# Scheduler running the periodic tasks
+scheduler = None
+
 # Instances of loaded service plugins
 service_plugins = {}
 
+# Background thread importing lazily loaded service plugins
+prefetch_thread = None
+
+# Distributes messages to worker processes in multi-process mode
+router = None
+
+# Bounded buffers decoupling message handling from the MQTT network thread,
+# one per dispatcher thread
+ingest_buffers = []
+dispatcher_threads = []
+
+# What each worker thread is doing: None when idle, else tuple of
+# (service, target, topic, start time)
+worker_state = {}
+
+# Optional HTTP endpoint serving status information
+admin_server = None
+
+start_time = time.time()
+
 # Collection of static configuration data for each subscribed topic
 topichandlers = {}
 
@@ -87,6 +132,79 @@ class Service(object):
         # XXX: is this really needed in addition to service name?
         self.SCRIPTNAME = SCRIPTNAME
 
+    @property
+    def http(self):
+        """Shared HTTP client session (see ``mqttwarn.httpclient``)."""
+        return get_session(cf)
+
+    def add_connect_callback(self, callback):
+        """Call ``callback()`` whenever the connection to the broker has been established."""
+        connect_callbacks.append(callback)
+
+    def add_publish_callback(self, callback):
+        """Call ``callback(mid)`` whenever a message has been published by ``mqttc``."""
+        publish_callbacks.append(callback)
+
+
+class LazyPlugin(object):
+    """Proxy deferring import and construction of a service plugin until its first job."""
+
+    def __init__(self, service, modname, srv, config):
+        self.service = service
+        self.modname = modname
+        self.srv = srv
+        self.config = config
+        self.load_time = None
+        self._plugin = None
+        self._error = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<LazyPlugin('%s', loaded=%s)>" % (self.service, self.loaded)
+
+    @property
+    def loaded(self):
+        return self._plugin is not None
+
+    @property
+    def plugin(self):
+        """The plugin, if it was loaded already, else None."""
+        return self._plugin
+
+    def load(self):
+        """Import and construct the plugin (once) and return it.
+
+        If loading fails, the exception is re-raised on every subsequent call
+        without another import attempt, just like a service which failed to load
+        at startup stays unavailable. An interrupted import (e.g. by a timeout)
+        is attempted again with the next call.
+
+        """
+        if self._plugin is None:
+            with self._lock:
+                if self._plugin is None:
+                    if self._error is not None:
+                        raise self._error
+
+                    try:
+                        self._plugin, self.load_time = import_plugin(
+                            self.service, self.modname, self.srv, self.config)
+                    except stopit.TimeoutException:
+                        raise
+                    except Exception as exc:
+                        self._error = exc
+                        log.exception("Unable to load plugin module '%s' for service '%s': %s",
+                                      self.modname, self.service, exc)
+                        raise
+
+                    log.info("Loaded plugin module '%s' for service '%s' on demand in %.3fs.",
+                             self.modname, self.service, self.load_time)
+
+        return self._plugin
+
+    def __call__(self, srv, item):
+        return self.load()(srv, item)
+
 
 class Job(object):
     def __init__(self, prio, service, target, handler, msg, data):
@@ -103,34 +221,34 @@ class Job(object):
 
 
 class TopicHandler(object):
-    def __init__(self, section, subscription, targets, config):
+    def __init__(self, section, subscription, targets, settings):
         self.section = section
         self.subscription = subscription
-        self.config = config
+        # Pre-compiled handler section options (configuration.HandlerSettings)
+        self.settings = settings
         self.targets = targets
+        # Number of messages passed to this handler
+        self.messages = 0
 
     def __repr__(self):
         return "<TopicHandler('%s')>" % self.section
 
     @property
     def qos(self):
-        return self.config.getint(self.section, 'qos', fallback=0)
+        return self.settings.qos
 
     @lru_cache()
     def filter(self, topic, payload):
         if not hasattr(self, '_filter'):
-            _filter = self.config.get(self.section, 'filter', fallback=None)
-
-            if is_funcspec(_filter):
-                dottedpath, funcname = _filter.rstrip('()').split(':', 1)
+            funcspec = self.settings.filter
+            self._filter = None
 
+            if funcspec is not None:
                 try:
-                    self._filter = load_function(dottedpath, funcname)
+                    self._filter = load_function(*funcspec)
                 except Exception as exc:
                     log.warn("Could not import filter function '%s' from topic handler '%s': %s",
-                             funcname, self.section, exc)
-            else:
-                self._filter = None
+                             funcspec.funcname, self.section, exc)
 
         if self._filter:
             try:
@@ -184,17 +302,12 @@ class TopicHandler(object):
         if value is None:
             return None
 
-        try:
-            formatter = self.config.getdict(self.section, field, fallback=None)
-        except TypeError:
-            pass
-        else:
-            return formatter.get(value, value)
-
-        formatter = self.config.get(self.section, field, fallback=None)
+        formatter = getattr(self.settings, field)
 
-        if is_funcspec(formatter):
-            dottedpath, funcname = formatter.rstrip('()').split(':', 1)
+        if isinstance(formatter, dict):
+            return formatter.get(value, value)
+        elif isinstance(formatter, FuncSpec):
+            dottedpath, funcname = formatter
 
             try:
                 func = load_function(dottedpath, funcname)
@@ -272,7 +385,7 @@ class MQTTMessageWrapper(object):
 
 
 # MQTT broker callbacks
-def on_connect(mosq, userdata, flags, result_code):
+def on_connect(mosq, userdata, flags, result_code, properties=None):
     """Handle connections (or failures) to the broker.
 
     This is called after the client has received a CONNACK message
@@ -295,20 +408,19 @@ def on_connect(mosq, userdata, flags, result_code):
                 log.debug("clean_session==False; previous subscriptions for client_id '%s' remain "
                           "active on broker.", cf.client_id)
 
-            subscribed = set()
-            for handler in topichandlers.values():
-                topic = handler.subscription
-                qos = handler.qos
-
-                if topic in subscribed:
-                    continue
-
-                log.debug("Subscribing to '%s', QOS %d.", topic, qos)
-                mqttc.subscribe(topic, qos)
-                subscribed.add(topic)
+            subscribe_topics(mqttc)
 
             if cf.lwt is not None:
                 mqttc.publish(cf.lwt, LWTALIVE, qos=0, retain=True)
+
+            if cf.lazy_services and cf.prefetch_services:
+                start_prefetch()
+
+            for callback in list(connect_callbacks):
+                try:
+                    callback()
+                except Exception as exc:
+                    log.exception("Error in connect callback of service plugin: %s", exc)
         elif result_code == 1:
             log.error("Connection refused - unacceptable protocol version.")
         elif result_code == 2:
@@ -320,13 +432,13 @@ def on_connect(mosq, userdata, flags, result_code):
         elif result_code == 5:
             log.error("Connection refused - not authorised.")
         else:
-            log.error("Connection failed - result code %d.", result_code)
+            log.error("Connection failed - result code %s.", result_code)
     except Exception as exc:
         log.exception("Error in 'on_connect' callback: %s", exc)
         cleanup(1)
 
 
-def on_disconnect(mosq, userdata, result_code):
+def on_disconnect(mosq, userdata, result_code, properties=None):
     """Handle disconnections from the broker."""
     try:
         if result_code == 0:
@@ -339,31 +451,30 @@ def on_disconnect(mosq, userdata, result_code):
         log.exception("Error in 'on_disconnect' callback: %s", exc)
 
 
+def on_publish(mosq, userdata, mid):
+    """Notify service plugins about published messages."""
+    for callback in list(publish_callbacks):
+        try:
+            callback(mid)
+        except Exception as exc:
+            log.exception("Error in 'on_publish' callback: %s", exc)
+
+
 def on_message(mosq, userdata, msg):
     """Handle message received from the broker."""
     try:
-        log.debug("Message received on topic '%s': %r", msg.topic, msg.payload)
-        msg = MQTTMessageWrapper(msg)
-
-        if msg.retain == 1:
-            if cf.skipretained:
-                log.debug("Skipping retained message on topic '%s'.", msg.topic)
-                return
-
-        log.debug("Checking handlers...")
-        handlers = match_topic_handlers(msg.topic)
-        log.debug("Matching handlers: %r", handlers)
-
-        for handler in handlers:
-            # Check for any message filters
-            if handler.filter(msg.topic, msg.payload):
-                log.debug("Filter in section [%s] has skipped message on topic '%s'.",
-                          handler.section, msg.topic)
-                continue
+        if not ingest_buffers:
+            dispatch_message(msg)
+            return
 
-            # Send the message to any targets specified
-            log.debug("Passing message on topic '%s' to handler [%s].", msg.topic, handler.section)
-            send_to_targets(handler, msg)
+        # All messages on a topic are handled by the same dispatcher, in order
+        ingestq = ingest_buffers[shard_for(msg.topic, len(ingest_buffers))]
+
+        if not ingestq.put(msg, block=cf.ingest_overflow == 'block'):
+            dropped = sum(buf.dropped for buf in ingest_buffers)
+
+            if dropped == 1 or dropped % 1000 == 0:
+                log.warning("Ingest buffer full, dropped %i message(s) so far.", dropped)
     except Exception as exc:
         log.exception("Error in 'on_message' callback: %s", exc)
 
@@ -371,6 +482,119 @@ def on_message(mosq, userdata, msg):
 # End of MQTT broker callbacks
 
 
+def dispatch_message(msg):
+    """Pass received message to a worker process or handle it in this process."""
+    log.debug("Message received on topic '%s': %r", msg.topic, msg.payload)
+
+    if router is not None:
+        router.dispatch(msg)
+    else:
+        handle_message(msg)
+
+
+def dispatcher(ingestq, dispatcher_id=None):
+    """Take messages from the ingest buffer and dispatch them until it is closed."""
+    while True:
+        msg = ingestq.get()
+
+        if msg is None:
+            break
+
+        try:
+            dispatch_message(msg)
+        except Exception as exc:
+            log.exception("Error in dispatcher thread #%s: %s", dispatcher_id, exc)
+
+    log.debug("Dispatcher thread #%s exiting...", dispatcher_id)
+
+
+def start_dispatchers():
+    """Set up ingest buffers and launch the threads dispatching messages taken from them.
+
+    The ingest buffer is split evenly among the dispatcher threads, each of
+    them handles the messages on the topics hashed to its part.
+
+    """
+    if cf.ingest_overflow not in ('drop', 'block'):
+        raise ValueError("Invalid ingest_overflow '%s' (must be 'drop' or 'block')." %
+                         cf.ingest_overflow)
+
+    num_dispatchers = max(cf.num_dispatchers, 1)
+    size = max(-(-cf.ingest_buffer_size // num_dispatchers), 1)
+    log.info("Starting %s dispatcher threads with ingest buffer size %i...",
+             num_dispatchers, size * num_dispatchers)
+
+    for i in range(num_dispatchers):
+        ingestq = RingBuffer(size)
+        ingest_buffers.append(ingestq)
+        t = threading.Thread(target=dispatcher, args=(ingestq,), kwargs={'dispatcher_id': i},
+                             name='dispatcher-%i' % i)
+        t.daemon = True
+        t.start()
+        dispatcher_threads.append(t)
+
+
+def ingest_stats():
+    """Return the statistics of all ingest buffers added up."""
+    stats = {}
+
+    for buf in ingest_buffers:
+        for key, value in buf.stats().items():
+            stats[key] = stats.get(key, 0) + value
+
+    return stats
+
+
+def stop_dispatchers(timeout=None):
+    """Let dispatcher threads handle the messages left in the ingest buffer and exit.
+
+    Returns the messages, which were not handled within ``timeout`` seconds.
+
+    """
+    if not ingest_buffers:
+        return []
+
+    for ingestq in ingest_buffers:
+        ingestq.close()
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    for t in dispatcher_threads:
+        t.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+    leftover = [msg for ingestq in ingest_buffers for msg in ingestq.take_all()]
+    log.info("Ingest buffer statistics: %s.",
+             ", ".join("%s=%s" % item for item in sorted(ingest_stats().items())))
+    return leftover
+
+
+def handle_message(msg):
+    """Pass message to the topic handlers matching its topic."""
+    msg = MQTTMessageWrapper(msg)
+
+    if msg.retain == 1:
+        if cf.skipretained:
+            log.debug("Skipping retained message on topic '%s'.", msg.topic)
+            return
+
+    log.debug("Checking handlers...")
+    handlers = match_topic_handlers(msg.topic)
+    log.debug("Matching handlers: %r", handlers)
+
+    for handler in handlers:
+        handler.messages += 1
+
+        # Check for any message filters
+        if handler.filter(msg.topic, msg.payload):
+            log.debug("Filter in section [%s] has skipped message on topic '%s'.",
+                      handler.section, msg.topic)
+            continue
+
+        # Send the message to any targets specified
+        log.debug("Passing message on topic '%s' to handler [%s].", msg.topic, handler.section)
+        send_to_targets(handler, msg)
+
+
 def make_service(name, logname=None, mqttc=None):
     """Service object factory.
 
@@ -387,6 +611,36 @@ def make_service(name, logname=None, mqttc=None):
     return service
 
 
+def subscribe_topics(client, shared=True):
+    """Subscribe to the topics of all topic handlers."""
+    subscribed = set()
+    for handler in topichandlers.values():
+        topic = shared_subscription(handler.subscription) if shared else handler.subscription
+        qos = handler.qos
+
+        if topic in subscribed:
+            continue
+
+        log.debug("Subscribing to '%s', QOS %d.", topic, qos)
+        client.subscribe(topic, qos)
+        subscribed.add(topic)
+
+
+def shared_subscription(subscription):
+    """Return subscription topic filter, prefixed for the shared subscription group, if any.
+
+    With the ``share_group`` option set, the broker distributes messages
+    matching the subscription among all clients subscribed with the same group
+    name instead of delivering a copy to each of them. Handler matching is
+    still done against the unshared topic filter.
+
+    """
+    if cf.share_group:
+        return '$share/{}/{}'.format(cf.share_group, subscription)
+
+    return subscription
+
+
 @lru_cache()
 def match_topic_handlers(topic):
     """Return list of matching handlers for given topic."""
@@ -408,6 +662,12 @@ def render_template(filename, data):
 def send_failover(reason, message):
     # Make sure we dump this event to the log
     log.warn(message)
+
+    # In multi-process mode, service plugins only live in the worker processes
+    if router is not None:
+        router.dispatch_failover(reason, message)
+        return
+
     # Attempt to send the message to our failover targets
     if 'failover' in topichandlers:
         # create fake MQTTMessage
@@ -510,6 +770,8 @@ def processor(jobq, worker_id=None, job_timeout=10):
     of handling the service, and invoke the module's plugin to do so.
 
     """
+    worker_state[worker_id] = None
+
     while not exit_flag:
         log.debug('Job queue has %s items to process.', jobq.qsize())
         job = jobq.get()
@@ -517,11 +779,17 @@ def processor(jobq, worker_id=None, job_timeout=10):
         if job is None:
             break
 
+        if shutdown_timeout() == 0:
+            spill_late_job(job)
+            break
+
         service = job.service['name']
         handler = job.handler
         target = job.target
         topic = job.msg.topic
+        stats = job.service['stats']
         log.debug("Processor #%s is handling '%s:%s'.", worker_id, service, target)
+        worker_state[worker_id] = (service, target, topic, time.time())
 
         data = job.data.copy()
         # It's mportant to keep order of the following three calls, since they
@@ -550,7 +818,7 @@ def processor(jobq, worker_id=None, job_timeout=10):
             item.priority = 0
             log.debug("Failed to determine the priority, defaulting to zero.")
 
-        template = context.get_config(handler.section, 'template')
+        template = handler.settings.template
 
         if template is not None:
             if HAVE_JINJA:
@@ -564,32 +832,90 @@ def processor(jobq, worker_id=None, job_timeout=10):
             else:
                 log.warn("Templating not possible because Jinja2 is not installed.")
 
-        if item.message or isinstance(item.message, (float, int)):
+        plugin = job.service['plugin']
+
+        if not (item.message or isinstance(item.message, (float, int))):
+            plugin = None
+            log.warn("Notification of '%s' for '%s' suppressed: empty message.", service, topic)
+        elif isinstance(plugin, LazyPlugin):
+            # Not under the job timeout, slow imports must not be interrupted
+            try:
+                plugin = plugin.load()
+            except Exception:
+                plugin = None
+                stats['failure'] += 1
+                log.error("Service '%s:%s' for topic '%s' is not available.",
+                          service, target, topic)
+
+        if plugin is not None:
             # Run the plugin in a separate thread and kill it if it doesn't return in time
             with stopit.ThreadingTimeout(job_timeout):
                 try:
-                    result = job.service['plugin'](job.service['srv'], item)
+                    result = plugin(job.service['srv'], item)
                 except stopit.TimeoutException:
+                    stats['timeout'] += 1
                     log.warn("Service '%s:%s' for topic '%s' cancelled after %is timeout.",
                              service, target, topic, job_timeout)
                 except Exception as exc:
+                    stats['failure'] += 1
                     log.error("Error invoking service '%s:%s' for topic '%s': exc",
                               service, target, topic, exc)
                 else:
                     if isinstance(result, six.string_types):
+                        stats['success'] += 1
                         log.info("Service '%s:%s' for topic '%s' result: %s",
                                  service, target, topic, result)
                     elif not result:
+                        stats['failure'] += 1
                         log.warn("Service '%s:%s' for topic '%s' failed.", service, target, topic)
-        else:
-            log.warn("Notification of '%s' for '%s' suppressed: empty message.", service, topic)
+                    else:
+                        stats['success'] += 1
 
+        worker_state[worker_id] = None
         jobq.task_done()
 
     log.debug("Worker thread #%s exiting...", worker_id)
 
 
+def import_plugin(service, modname, srv, service_config):
+    """Import plugin module of a service and instantiate class-based plugins.
+
+    Returns a tuple of the plugin callable and the time in seconds it took to
+    import (and construct) it.
+
+    """
+    extra_pkgs = [] if '.' in modname[1:] else ['mqttwarn.services']
+    start = time.time()
+    plugin_func = load_function(modname, 'plugin', extra_pkgs=extra_pkgs)
+
+    if isclass(plugin_func):
+        plugin_func = plugin_func(srv, service_config)
+
+    return plugin_func, time.time() - start
+
+
+def log_plugin_load_times():
+    """Log a report of how long importing each loaded service plugin took, slowest first."""
+    load_times = []
+
+    for name, service in service_plugins.items():
+        plugin = service['plugin']
+        load_time = plugin.load_time if isinstance(plugin, LazyPlugin) else service['load_time']
+
+        if load_time is not None:
+            load_times.append((load_time, name))
+
+    load_times.sort(reverse=True)
+
+    if load_times:
+        log.info("Service plugin import times: %s (total: %.3fs).",
+                 ", ".join("%s=%.3fs" % (name, lt) for lt, name in load_times),
+                 sum(lt for lt, _ in load_times))
+
+
 def load_services(services, mqttc):
+    lazy = cf.lazy_services
+
     for service in services:
         service_config = context.get_service_config(service)
 
@@ -604,29 +930,67 @@ def load_services(services, mqttc):
             continue
 
         modname = context.get_service_module(service)
+        service_logger_name = 'mqttwarn.services.{}'.format(service)
+        srv = make_service(service, mqttc=mqttc, logname=service_logger_name)
+        load_time = None
 
-        extra_pkgs = [] if '.' in modname[1:] else ['mqttwarn.services']
+        if lazy:
+            plugin_func = LazyPlugin(service, modname, srv, service_config)
+            log.info("Deferred loading of plugin module '%s' for service '%s'.", modname, service)
+        else:
+            try:
+                plugin_func, load_time = import_plugin(service, modname, srv, service_config)
+            except Exception as exc:
+                log.exception("Unable to load plugin module '%s' for service '%s': %s",
+                              modname, service, exc)
+                continue
+            else:
+                log.info("Successfully loaded plugin module '%s' for service '%s' in %.3fs.",
+                         modname, service, load_time)
 
-        try:
-            plugin_func = load_function(modname, 'plugin', extra_pkgs=extra_pkgs)
-            service_logger_name = 'mqttwarn.services.{}'.format(service)
-            srv = make_service(service, mqttc=mqttc, logname=service_logger_name)
+        service_plugins[service] = {
+            'name': service,
+            'config': service_config,
+            'targets': service_targets,
+            'plugin': plugin_func,
+            'module': modname,
+            'srv': srv,
+            'load_time': load_time,
+            'stats': {'success': 0, 'failure': 0, 'timeout': 0},
+        }
 
-            if isclass(plugin_func):
-                plugin_func = plugin_func(srv, service_config)
-        except Exception as exc:
-            log.exception("Unable to load plugin module '%s' for service '%s': %s",
-                          modname, service, exc)
-        else:
-            log.info("Successfully loaded plugin module '%s' for service '%s'.", modname, service)
-            service_plugins[service] = {
-                'name': service,
-                'config': service_config,
-                'targets': service_targets,
-                'plugin': plugin_func,
-                'module': modname,
-                'srv': srv,
-            }
+    if not lazy:
+        log_plugin_load_times()
+
+
+def prefetch_services():
+    """Load all lazily loaded service plugins, which have not been used yet."""
+    log.debug("Prefetching service plugins in the background...")
+
+    for service in list(service_plugins.values()):
+        plugin = service['plugin']
+
+        if exit_flag:
+            break
+
+        if isinstance(plugin, LazyPlugin) and not plugin.loaded:
+            try:
+                plugin.load()
+            except Exception:
+                # Already logged by LazyPlugin.load()
+                pass
+
+    log_plugin_load_times()
+
+
+def start_prefetch():
+    """Start background thread for prefetching lazily loaded service plugins (once)."""
+    global prefetch_thread
+
+    if prefetch_thread is None:
+        prefetch_thread = threading.Thread(target=prefetch_services, name='prefetch')
+        prefetch_thread.daemon = True
+        prefetch_thread.start()
 
 
 def load_topichandlers(services):
@@ -655,15 +1019,162 @@ def load_topichandlers(services):
                 section=section,
                 subscription=subscription,
                 targets=targets,
-                config=context.config
+                settings=context.get_handler_settings(section)
             )
 
 
-def connect():
-    """Load service plugins, connect to the broker, launch daemon threads and listen forever."""
+def cache_stats(func):
+    info = func.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'size': info.currsize,
+        'hit_rate': info.hits / lookups if lookups else None,
+    }
+
+
+def get_status():
+    """Return dict with information about the internal state, served by the admin endpoint."""
+    now = time.time()
+    workers = {}
+
+    for worker_id, state in list(worker_state.items()):
+        if state is None:
+            workers[worker_id] = {'state': 'idle'}
+        else:
+            service, target, topic, since = state
+            workers[worker_id] = {
+                'state': 'busy',
+                'service': service,
+                'target': target,
+                'topic': topic,
+                'seconds': now - since,
+            }
+
+    services = {}
+
+    for name, service in list(service_plugins.items()):
+        plugin = service['plugin']
+        services[name] = dict(
+            service['stats'],
+            module=service['module'],
+            loaded=plugin.loaded if isinstance(plugin, LazyPlugin) else True,
+        )
+
+        # Class-based plugins may report statistics of their own
+        instance = plugin.plugin if isinstance(plugin, LazyPlugin) else plugin
+
+        if hasattr(instance, 'stats'):
+            services[name]['plugin_stats'] = instance.stats()
+
+    cron = {}
+
+    for name, task in list(ptlist.items()):
+        cron[name] = {
+            'next_fire': (datetime.fromtimestamp(task.next_fire).isoformat()
+                          if task.next_fire else None),
+            'running': task.running,
+            'runs': task.runs,
+            'skipped': task.skipped,
+        }
+
+    return {
+        'pid': os.getpid(),
+        'uptime': now - start_time,
+        'connected': mqttc.is_connected() if hasattr(mqttc, 'is_connected') else None,
+        'jobq': {'size': jobq.qsize(), 'unfinished': jobq.unfinished_tasks},
+        'ingest': ingest_stats() if ingest_buffers else None,
+        'processes': router.dispatched if router is not None else None,
+        'shards': router.get_status() if router is not None else None,
+        'workers': workers,
+        'handlers': {
+            handler.section: {'subscription': handler.subscription, 'messages': handler.messages}
+            for handler in list(topichandlers.values())
+        },
+        'services': services,
+        'cron': cron,
+        'caches': {
+            'match_topic_handlers': cache_stats(match_topic_handlers),
+            'filter': cache_stats(TopicHandler.filter),
+        },
+    }
+
+
+def start_workers():
+    """Launch worker threads to operate on queue."""
+    log.info('Starting %s worker threads...', cf.num_workers)
+    for i in range(cf.num_workers):
+        t = threading.Thread(target=processor, args=(jobq,), kwargs={'worker_id': i})
+        t.daemon = True
+        t.start()
+
+
+def shard_main(shard_id, inbox, outbox):
+    """Main function of a worker process in multi-process mode.
+
+    Loads its own service plugin instances and runs its own processor threads
+    for the messages passed in via ``inbox``. Messages published by plugins
+    are relayed via ``outbox`` to the process owning the broker connection.
+
+    """
     # FIXME: Remove global variables
-    global mqttc
+    global mqttc, router
+
+    # Signals are handled by the parent process, which shuts down its workers. Under
+    # systemd (KillMode=control-group), workers receive the SIGTERM of the parent as well,
+    # which must not kill them before they have finished their queued messages.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    router = None
+    mqttc = PublishProxy(outbox)
+    services = cf.getlist('defaults', 'launch', fallback=[])
+    load_services(services, mqttc)
+    load_topichandlers(services)
+    start_workers()
+    log.info("Worker process #%i ready.", shard_id)
+
+    if cf.lazy_services and cf.prefetch_services:
+        start_prefetch()
+
+    while True:
+        item = inbox.get()
+
+        if item[0] == 'stop':
+            deadline = item[1]
+            break
+
+        try:
+            if item[0] == 'status':
+                outbox.put(('status', item[1], shard_id, get_status()))
+            elif item[0] == 'failover':
+                send_failover(*item[1:])
+            elif item[0] == 'job':
+                restore_job(item[1])
+            else:
+                topic, payload, qos, retain = item[1:]
+                handle_message(Struct(topic=topic, payload=payload, qos=qos, retain=retain))
+        except Exception as exc:
+            log.exception("Error in worker process #%i: %s", shard_id, exc)
+
+    log.debug("Worker process #%i waiting for queue to drain...", shard_id)
+    spool_file = '%s.%i' % (cf.spool_file, shard_id) if cf.spool_file else None
+
+    if deadline is not None:
+        # Leave a second for saving the remaining jobs, before the parent process kills this one
+        set_shutdown_deadline(time.monotonic() + deadline - time.time() - 1)
+
+    drain(shutdown_timeout(), spool_file)
+    stop_flushers()
 
+    # Worker processes exit without running atexit handlers, so write the log records
+    # still queued for asynchronous logging (see ``logasync``) now
+    logging.shutdown()
+
+
+def get_services():
+    """Return names of services to launch and change to the configured working directory."""
     services = cf.getlist('defaults', 'launch', fallback=[])
 
     if not services:
@@ -678,57 +1189,117 @@ def connect():
         log.error(msg)
         sys.exit(msg)
 
-    # Initialize MQTT broker connection
-    mqttc = paho.Client(cf.client_id, clean_session=cf.clean_session, protocol=cf.protocol,
-                        transport=cf.transport)
+    return services
 
-    mqttc.on_connect = on_connect
-    mqttc.on_message = on_message
-    mqttc.on_disconnect = on_disconnect
 
-    # initialize service configurations
-    load_services(services, mqttc)
-    # and topic handler
-    load_topichandlers(services)
+def make_client(client_id=None, lwt=True):
+    """Create MQTT client object with credentials, LWT and TLS set up according to configuration."""
+    client_id = client_id or cf.client_id
+
+    if cf.protocol == MQTTv5:
+        # MQTT 5 replaces "clean session" with the "clean start" connect flag
+        client = paho.Client(client_id, protocol=cf.protocol, transport=cf.transport)
+    else:
+        client = paho.Client(client_id, clean_session=cf.clean_session, protocol=cf.protocol,
+                             transport=cf.transport)
 
     # check for authentication
     if cf.username:
-        mqttc.username_pw_set(cf.username, cf.password)
+        client.username_pw_set(cf.username, cf.password)
 
     # set the lwt before connecting
-    if cf.lwt is not None:
+    if lwt and cf.lwt is not None:
         log.debug("Setting Last Will and Testament to topic '%s', value %r.", cf.lwt, LWTDEAD)
-        mqttc.will_set(cf.lwt, payload=LWTDEAD, qos=0, retain=True)
+        client.will_set(cf.lwt, payload=LWTDEAD, qos=0, retain=True)
 
     # Delays will be: 3, 6, 12, 24, 30, 30, ...
-    # mqttc.reconnect_delay_set(delay=3, delay_max=30, exponential_backoff=True)
+    # client.reconnect_delay_set(delay=3, delay_max=30, exponential_backoff=True)
 
     if cf.tls:
-        mqttc.tls_set(cf.ca_certs, cf.certfile, cf.keyfile, tls_version=cf.tls_version)
+        client.tls_set(cf.ca_certs, cf.certfile, cf.keyfile, tls_version=cf.tls_version)
 
     if cf.tls_insecure:
-        mqttc.tls_insecure_set(True)
+        client.tls_insecure_set(True)
+
+    return client
+
+
+def connect_client(client):
+    """Connect MQTT client to broker, exit if this is not possible."""
+    connect_kwargs = {}
+
+    if cf.protocol == MQTTv5:
+        connect_kwargs['clean_start'] = cf.clean_session
 
     try:
         log.debug("Attempting connection to MQTT broker %s:%s...", cf.hostname, cf.port)
-        mqttc.connect(cf.hostname, int(cf.port), 60)
+        client.connect(cf.hostname, int(cf.port), 60, **connect_kwargs)
     except Exception as exc:
         msg = "Cannot connect to MQTT broker at %s:%s: %s" % (cf.hostname, cf.port, exc)
         log.exception(msg)
         sys.exit(msg)
 
-    # Launch worker threads to operate on queue
-    log.info('Starting %s worker threads...', cf.num_workers)
-    for i in range(cf.num_workers):
-        t = threading.Thread(target=processor, args=(jobq,), kwargs={'worker_id': i})
-        t.daemon = True
-        t.start()
+
+def start_processing(services, mqttc):
+    """Load service plugins and topic handlers and launch the message processing threads.
+
+    In multi-process mode, start the worker processes instead, which load the
+    service plugins themselves.
+
+    """
+    # FIXME: Remove global variables
+    global router
+
+    if cf.num_processes > 1:
+        # Worker processes must be forked before any other threads are started.
+        log.info("Starting %s worker processes...", cf.num_processes)
+        load_topichandlers(services)
+        router = ShardRouter(cf.num_processes, shard_main)
+        router.start()
+
+        if mqttc is not None:
+            router.start_relay(mqttc)
+    else:
+        # initialize service configurations
+        load_services(services, mqttc)
+        # and topic handler
+        load_topichandlers(services)
+        start_workers()
+
+    if cf.spool_file:
+        restore_jobs(cf.spool_file)
+
+    if cf.ingest_buffer_size > 0:
+        start_dispatchers()
+
+
+def connect():
+    """Load service plugins, connect to the broker, launch daemon threads and listen forever."""
+    # FIXME: Remove global variables
+    global mqttc, scheduler, admin_server
+
+    services = get_services()
+
+    # Initialize MQTT broker connection
+    mqttc = make_client()
+    mqttc.on_connect = on_connect
+    mqttc.on_message = on_message
+    mqttc.on_disconnect = on_disconnect
+    mqttc.on_publish = on_publish
+
+    start_processing(services, mqttc)
+
+    if cf.admin_address:
+        admin_server = AdminServer(cf.admin_address, get_status)
+        admin_server.start()
+
+    connect_client(mqttc)
 
     # If the config file has on ore more [cron:xxx] sections, these define
     # functions, which should be invoked periodically.
     #
-    # Each section must have at least two options named 'target' and
-    # 'interval'.
+    # Each section must have an option named 'target' and either an option
+    # named 'interval' or one named 'schedule'.
     #
     # The 'target' option specifies the function to run. The format of
     # of the value is the dotted package path of the module defining
@@ -737,10 +1308,16 @@ def connect():
     # The 'interval' option specifies the interval in seconds as an
     # integer or float at which the target function should be invoked.
     #
+    # The 'schedule' option specifies a crontab-style expression with five
+    # fields (minute, hour, day of month, month, day of week), e.g.
+    # '*/5 * * * *' for every five minutes.
+    #
     # Additionally, the following options are recognized but optional:
     #
     # 'now' (bool, default: False) - whether to run the function
     #     immediately on startup
+    # 'jitter' (float, default: 0) - delay each run by a random number
+    #     of seconds up to this value
     #
     # Example section:
     #
@@ -748,6 +1325,7 @@ def connect():
     # ; Define a function for publishing your public ip address to the MQTT bus each minute.
     # target = mymodule.customfuncs:publish_public_ip_address
     # interval = 60
+    # jitter = 10
     # now = false
 
     for section in cf.sections():
@@ -760,10 +1338,22 @@ def connect():
                 log.error("[cron:%s] section does not specify target function.", name)
                 continue
 
-            if cf.has_option(section, 'interval'):
+            interval = schedule = None
+
+            if cf.has_option(section, 'interval') and cf.has_option(section, 'schedule'):
+                log.error("[cron:%s] section must not specify both interval and schedule.", name)
+                continue
+            elif cf.has_option(section, 'interval'):
                 interval = cf.getfloat(section, 'interval')
+            elif cf.has_option(section, 'schedule'):
+                try:
+                    schedule = CronExpression(cf.get(section, 'schedule'))
+                except ValueError as exc:
+                    log.error("[cron:%s] invalid schedule: %s", name, exc)
+                    continue
             else:
-                log.error("[cron:%s] section does not specify execution interval.", name)
+                log.error("[cron:%s] section does not specify execution interval or schedule.",
+                          name)
                 continue
 
             try:
@@ -774,12 +1364,26 @@ def connect():
                 continue
 
             now = cf.getboolean(section, 'now', fallback=False)
-            log.debug("Scheduling function '%s' as periodic task to run every %s seconds via "
-                      "[cron:%s] section.", funcname, interval, name)
+            jitter = cf.getfloat(section, 'jitter', fallback=0)
+
+            if schedule is not None:
+                log.debug("Scheduling function '%s' as periodic task to run at '%s' via "
+                          "[cron:%s] section.", funcname, schedule.expression, name)
+            else:
+                log.debug("Scheduling function '%s' as periodic task to run every %s seconds via "
+                          "[cron:%s] section.", funcname, interval, name)
+
             service = make_service(name, mqttc=mqttc, logname='mqttwarn.cron.' + name)
-            ptlist[name] = PeriodicThread(callback=func, period=interval, name=name, srv=service,
-                                          now=now)
-            ptlist[name].start()
+            ptlist[name] = PeriodicTask(callback=func, period=interval, name=name, srv=service,
+                                        now=now, schedule=schedule, jitter=jitter)
+
+    if ptlist:
+        scheduler = Scheduler(max_workers=cf.cron_workers)
+
+        for task in ptlist.values():
+            scheduler.add(task)
+
+        scheduler.start()
 
     while not exit_flag:
         reconnect_interval = 5
@@ -796,12 +1400,296 @@ def connect():
             time.sleep(reconnect_interval)
 
 
+def record(filename):
+    """Connect to the broker and write all messages matching a topic handler to a capture file.
+
+    Service plugins are not loaded and no notifications are sent. Recording
+    stops on SIGINT or SIGTERM.
+
+    """
+    # FIXME: Remove global variables
+    global mqttc
+
+    writer = CaptureWriter(filename)
+    services = get_services()
+    load_topichandlers(services)
+
+    def on_connect_record(client, userdata, flags, result_code, properties=None):
+        if result_code == 0:
+            log.info("Connected to MQTT broker. Recording messages to '%s'...", filename)
+            subscribe_topics(client, shared=False)
+        else:
+            log.error("Connection failed - result code %s.", result_code)
+
+    def on_message_record(client, userdata, msg):
+        writer.write(msg.topic, msg.payload, msg.qos, msg.retain)
+
+    def stop_recording(signum, frame):
+        mqttc.disconnect()
+
+    # Use a distinct client id, so a running mqttwarn instance is not disconnected
+    mqttc = make_client(client_id=cf.client_id + '-record', lwt=False)
+    mqttc.on_connect = on_connect_record
+    mqttc.on_message = on_message_record
+    signal.signal(signal.SIGTERM, stop_recording)
+    signal.signal(signal.SIGINT, stop_recording)
+    connect_client(mqttc)
+
+    try:
+        mqttc.loop_forever()
+    finally:
+        writer.close()
+        log.info("Recorded %i messages to '%s'.", writer.count, filename)
+
+
+def replay(filename, speed=None):
+    """Pass the messages from a capture file through ``on_message`` without a broker connection.
+
+    :param filename: Capture file written by ``record()``
+    :param speed:    Factor by which to speed up the original message timing,
+                     or None to replay messages as fast as possible
+
+    """
+    services = get_services()
+    start_processing(services, None)
+
+    count = 0
+    first_timestamp = None
+    start = time.time()
+    log.info("Replaying messages from '%s' at %s speed...", filename,
+             'maximum' if speed is None else '%gx' % speed)
+
+    for msg in read_capture(filename):
+        if speed is not None:
+            if first_timestamp is None:
+                first_timestamp = msg.timestamp
+
+            delay = start + (msg.timestamp - first_timestamp) / speed - time.time()
+
+            if delay > 0:
+                time.sleep(delay)
+
+        on_message(None, None, msg)
+        count += 1
+
+    stop_dispatchers()
+
+    if router is not None:
+        router.stop()
+
+    jobq.join()
+    elapsed = time.time() - start
+    log.info("Replayed %i messages in %.3fs (%.1f messages/s).", count, elapsed,
+             count / elapsed if elapsed else 0.0)
+
+
+def message_to_record(msg):
+    """Return dict with the data of a received message, which has not been handled yet."""
+    return {
+        'topic': msg.topic,
+        'payload': msg.payload,
+        'qos': getattr(msg, 'qos', 0),
+        'retain': getattr(msg, 'retain', 0),
+    }
+
+
+def job_to_record(job):
+    """Return dict with the data needed for re-creating a job, suitable for pickling."""
+    return {
+        'section': job.handler.section,
+        'service': job.service['name'],
+        'target': job.target,
+        'topic': job.msg.topic,
+        'payload': job.msg.payload,
+        'qos': getattr(job.msg, 'qos', 0),
+        'retain': getattr(job.msg, 'retain', 0),
+        'data': job.data,
+    }
+
+
+def restore_job(record):
+    """Re-create job from a record written by ``spill_jobs()`` and put it in the job queue."""
+    if 'service' not in record:
+        # Message from the ingest buffer, which has not been handled yet
+        dispatch_message(Struct(topic=record['topic'], payload=record['payload'],
+                                qos=record['qos'], retain=record['retain']))
+        return
+
+    if router is not None:
+        router.dispatch_job(record)
+        return
+
+    service = service_plugins.get(record['service'])
+    handler = None
+
+    for candidate in topichandlers.values():
+        if candidate.section == record['section']:
+            handler = candidate
+            break
+
+    if service is None or handler is None or record['target'] not in service['targets']:
+        log.warning("Cannot restore job for '%s:%s' from section [%s]: no longer configured.",
+                    record['service'], record['target'], record['section'])
+        return
+
+    msg = MQTTMessageWrapper(Struct(topic=record['topic'], payload=record['payload'],
+                                    qos=record['qos'], retain=record['retain']))
+    jobq.put(Job(prio=1, service=service, target=record['target'], handler=handler, msg=msg,
+                 data=record['data']))
+
+
+def spill_jobs(filename, messages=(), jobs=()):
+    """Remove all jobs left in the job queue and save them to a file.
+
+    Received ``messages``, which have not been handled yet, and ``jobs``
+    already taken from the queue are saved along with them. Jobs saved to the
+    file by earlier calls are kept. Returns the number of jobs (and messages)
+    saved.
+
+    """
+    records = [message_to_record(msg) for msg in messages]
+    jobs = list(jobs)
+
+    while True:
+        try:
+            job = jobq.get_nowait()
+        except queue.Empty:
+            break
+
+        jobq.task_done()
+
+        if job is not None:
+            jobs.append(job)
+
+    for job in jobs:
+        record = job_to_record(job)
+
+        try:
+            pickle.dumps(record)
+        except Exception as exc:
+            log.warning("Cannot save job for '%s:%s' on topic '%s': %s", record['service'],
+                        record['target'], record['topic'], exc)
+        else:
+            records.append(record)
+
+    if records:
+        with spill_lock:
+            saved = spilled_records.setdefault(filename, [])
+            saved.extend(records)
+            tmpfile = filename + '.tmp'
+
+            with open(tmpfile, 'wb') as fp:
+                pickle.dump(saved, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmpfile, filename)
+
+    return len(records)
+
+
+def spill_late_job(job):
+    """Save job taken from the queue by a worker thread after the shutdown deadline."""
+    with spill_lock:
+        if not exit_flag:
+            # Saved by drain() along with the other jobs left in the queue
+            jobq.put(job)
+            jobq.task_done()
+            return
+
+        jobq.task_done()
+
+        if not spill_file:
+            log.warning("Discarding job for '%s:%s' on topic '%s', which could not be "
+                        "processed in time.", job.service['name'], job.target, job.msg.topic)
+            return
+
+        try:
+            spill_jobs(spill_file, jobs=[job])
+        except Exception as exc:
+            log.exception("Cannot save job for '%s:%s' on topic '%s' to '%s': %s",
+                          job.service['name'], job.target, job.msg.topic, spill_file, exc)
+
+
+def restore_jobs(filename):
+    """Put jobs saved by a previous run (in the main and any worker processes) in the job queue."""
+    for spool_file in [filename] + sorted(glob.glob(glob.escape(filename) + '.[0-9]*')):
+        if not os.path.exists(spool_file):
+            continue
+
+        try:
+            with open(spool_file, 'rb') as fp:
+                records = pickle.load(fp)
+
+            os.unlink(spool_file)
+        except Exception as exc:
+            log.error("Cannot restore jobs from '%s': %s", spool_file, exc)
+            continue
+
+        log.info("Restoring %i jobs left over from previous run from '%s'.", len(records),
+                 spool_file)
+
+        for record in records:
+            restore_job(record)
+
+
+def drain(timeout=None, spool_file=None, messages=()):
+    """Wait up to ``timeout`` seconds for the job queue to drain.
+
+    Signals worker threads to exit afterwards. Jobs still queued then (and
+    received ``messages``, which have not been handled) are saved to
+    ``spool_file``, if given, else they are discarded. So are jobs taken
+    from the queue by worker threads after the shutdown deadline.
+
+    """
+    global exit_flag, spill_file
+
+    start = time.time()
+    pending = jobq.unfinished_tasks
+    log.info("Waiting for queue to drain (%i jobs)...", pending)
+
+    with jobq.all_tasks_done:
+        while jobq.unfinished_tasks:
+            remaining = None if timeout is None else start + timeout - time.time()
+
+            if remaining is not None and remaining <= 0:
+                break
+
+            jobq.all_tasks_done.wait(remaining)
+
+    with spill_lock:
+        # Send exit signal to subsystems _after_ queue was drained
+        exit_flag = True
+        spill_file = spool_file
+        leftover = jobq.qsize()
+        in_flight = max(jobq.unfinished_tasks - leftover, 0)
+        spilled = 0
+
+        if leftover or messages:
+            if spool_file:
+                try:
+                    spilled = spill_jobs(spool_file, messages)
+                except Exception as exc:
+                    log.exception("Cannot save remaining jobs to '%s': %s", spool_file, exc)
+            else:
+                log.warning("Discarding %i jobs and %i received messages, which could not be "
+                            "processed in time.", leftover, len(messages))
+
+    log.info("Drained %i of %i jobs in %.1fs, %i still in progress, %i saved to '%s'.",
+             max(pending - leftover - in_flight, 0), pending, time.time() - start, in_flight,
+             spilled, spool_file)
+
+
 def cleanup(retcode=0, frame=None):
     """Signal handler to ensure we disconnect cleanly in the event of a SIGTERM or SIGINT."""
     for ptname in ptlist:
         log.debug("Cancelling %s timer...", ptname)
         ptlist[ptname].cancel()
 
+    if scheduler is not None:
+        scheduler.stop()
+
+    if admin_server is not None:
+        admin_server.stop()
+
     log.debug("Disconnecting from MQTT broker...")
     if cf.lwt is not None:
         mqttc.publish(cf.lwt, LWTDEAD, qos=0, retain=True)
@@ -809,12 +1697,18 @@ def cleanup(retcode=0, frame=None):
     mqttc.loop_stop()
     mqttc.disconnect()
 
-    log.info("Waiting for queue to drain...")
-    jobq.join()
+    # One deadline for all steps, including the final flushes of service plugins
+    # buffering data, so that their timeouts don't add up
+    set_shutdown_deadline(None if cf.drain_timeout is None else
+                          time.monotonic() + cf.drain_timeout)
+    messages = stop_dispatchers(shutdown_timeout())
+
+    if router is not None:
+        log.info("Waiting for worker processes to finish...")
+        router.stop(shutdown_timeout())
 
-    # Send exit signal to subsystems _after_ queue was drained
-    global exit_flag
-    exit_flag = True
+    drain(shutdown_timeout(), cf.spool_file, messages)
+    stop_flushers()
 
     if frame:
         log.debug("Exiting on signal %d.", retcode)
@@ -1,19 +1,170 @@
 # -*- coding: utf-8 -*-
 # (c) 2014-2019 The mqttwarn developers
 
+import heapq
+import itertools
 import logging
+import random
 import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 
 log = logging.getLogger(__name__)
 
 
-# This class, shamelessly stolen from https://gist.github.com/cypreess/5481681
-# The `srv' bits are added for mqttwarn
-class PeriodicThread(object):
-    """Python periodic Thread using Timer with instant cancellation."""
+class CronExpression(object):
+    """Five-field crontab expression with an efficient next fire time calculation.
+
+    The fields are minute, hour, day of month, month and day of week. Each
+    field is a comma-separated list of ``*``, single values or ranges
+    (``a-b``), optionally followed by a step (``/n``). Months and days of week
+    may also be given by their three-letter English names. Day of week 0 and 7
+    are both Sunday. As with cron, if both day of month and day of week are
+    restricted, i.e. do not start with ``*`` (like ``*/2``), a day matching
+    either field matches, else it has to match both. The shortcuts
+    ``@hourly``, ``@daily``, ``@weekly``, ``@monthly`` and ``@yearly`` are
+    supported as well. Times are local times.
+
+    """
+
+    ALIASES = {
+        '@hourly': '0 * * * *',
+        '@daily': '0 0 * * *',
+        '@midnight': '0 0 * * *',
+        '@weekly': '0 0 * * 0',
+        '@monthly': '0 0 1 * *',
+        '@yearly': '0 0 1 1 *',
+        '@annually': '0 0 1 1 *',
+    }
+    MONTHS = ('jan', 'feb', 'mar', 'apr', 'may', 'jun',
+              'jul', 'aug', 'sep', 'oct', 'nov', 'dec')
+    WEEKDAYS = ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat')
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = self.ALIASES.get(expression.strip().lower(), expression).split()
+
+        if len(fields) != 5:
+            raise ValueError("Crontab expression '%s' must have five fields." % expression)
+
+        self.minutes = self._parse(fields[0], 0, 59)
+        self.hours = self._parse(fields[1], 0, 23)
+        self.days = self._parse(fields[2], 1, 31)
+        self.months = self._parse(fields[3], 1, 12, self.MONTHS, 1)
+        # Sunday is 0 (and 7) in crontab, 6 in Python's weekday()
+        self.weekdays = sorted(set((day - 1) % 7 for day in
+                                   self._parse(fields[4], 0, 7, self.WEEKDAYS, 0)))
+        # As in Vixie cron, a field starting with "*" (e.g. "*/2") is unrestricted, so that
+        # a day has to match both fields
+        self.any_day = fields[2].startswith('*')
+        self.any_weekday = fields[4].startswith('*')
+
+    def __repr__(self):
+        return "<CronExpression('%s')>" % self.expression
+
+    @staticmethod
+    def _parse(field, low, high, names=(), offset=0):
+        def value(s):
+            if s.lower() in names:
+                return names.index(s.lower()) + offset
+
+            return int(s)
+
+        values = set()
+
+        for part in field.split(','):
+            rng, _, step = part.partition('/')
+            step = int(step) if step else 1
+
+            if rng == '*':
+                start, end = low, high
+            elif '-' in rng:
+                start, end = (value(s) for s in rng.split('-', 1))
+            else:
+                start = end = value(rng)
+                if step > 1:
+                    end = high
+
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError("Invalid crontab field '%s'." % field)
+
+            values.update(range(start, end + 1, step))
+
+        return sorted(values)
+
+    def _day_matches(self, dt):
+        day_match = dt.day in self.days
+        weekday_match = dt.weekday() in self.weekdays
+
+        if self.any_day or self.any_weekday:
+            return day_match and weekday_match
+
+        return day_match or weekday_match
+
+    def next_fire(self, after):
+        """Return first datetime matching the expression, which is later than ``after``."""
+        dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Give up if there is no match within the next five years (e.g. "0 0 30 2 *")
+        limit = dt.year + 5
+
+        while dt.year <= limit:
+            if dt.month not in self.months:
+                i = bisect_left(self.months, dt.month)
+
+                if i < len(self.months):
+                    dt = dt.replace(month=self.months[i], day=1, hour=0, minute=0)
+                else:
+                    dt = dt.replace(year=dt.year + 1, month=self.months[0], day=1, hour=0,
+                                    minute=0)
+                continue
+
+            if not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+
+            if dt.hour not in self.hours:
+                i = bisect_left(self.hours, dt.hour)
+
+                if i < len(self.hours):
+                    dt = dt.replace(hour=self.hours[i], minute=0)
+                else:
+                    dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+
+            if dt.minute not in self.minutes:
+                i = bisect_left(self.minutes, dt.minute)
+
+                if i < len(self.minutes):
+                    dt = dt.replace(minute=self.minutes[i])
+                else:
+                    dt = dt.replace(minute=0) + timedelta(hours=1)
+                continue
+
+            return dt
+
+        raise ValueError("Crontab expression '%s' never matches." % self.expression)
+
+
+class PeriodicTask(object):
+    """Callback to be run periodically by a ``Scheduler``.
+
+    The task runs either every ``period`` seconds at a fixed rate or at the
+    times matched by the ``CronExpression`` given as ``schedule``. Each run
+    may be delayed by a random amount of up to ``jitter`` seconds, so that
+    tasks of many instances with the same schedule do not all fire at once.
+
+    The `srv' bits are added for mqttwarn.
+
+    """
+
+    def __init__(self, callback=None, period=None, name=None, srv=None, now=False, schedule=None,
+                 jitter=0, *args, **kwargs):
+        if period is None and schedule is None:
+            raise ValueError("Either period or schedule is required.")
 
-    def __init__(self, callback=None, period=1, name=None, srv=None, now=False, *args, **kwargs):
         self.name = name
         self.srv = srv
         self.now = now
@@ -21,18 +172,54 @@ class PeriodicThread(object):
         self.kwargs = kwargs
         self.callback = callback
         self.period = period
+        self.schedule = schedule
+        self.jitter = jitter
         self.stop = False
-        self.current_timer = None
-        self.schedule_lock = threading.Lock()
+        # Whether the callback is currently queued or running on the executor
+        self.running = False
+        # Monotonic time of the current scheduled run, without jitter
+        self.deadline = None
+        # Wall clock time of the next scheduled run (None if not scheduled)
+        self.next_fire = None
+        self.runs = 0
+        self.skipped = 0
+        # Local time of the current scheduled run of a crontab schedule
+        self._cron_time = None
 
-    def start(self):
-        """Mimic Thread standard start method."""
-        if self.now:
-            # Schedule periodic task to run right now
-            self._run()
+    def schedule_next(self, now):
+        """Advance to the next run and return the (jittered) monotonic time it is due."""
+        if self.deadline is None and self.now:
+            self.deadline = now
+        elif self.schedule is not None:
+            wall = datetime.now()
+            next_time = self.schedule.next_fire(self._cron_time or wall)
+
+            if next_time < wall:
+                # Fell behind, skip the missed runs
+                next_time = self.schedule.next_fire(wall)
+
+            self._cron_time = next_time
+            self.deadline = now + (next_time - wall).total_seconds()
+        elif self.deadline is None:
+            self.deadline = now + self.period
         else:
-            # Schedule periodic task with designated interval
-            self.schedule_timer()
+            # Fixed-rate: next deadline is relative to the previous one. If we
+            # fell behind by more than one period, coalesce the missed runs.
+            self.deadline += self.period
+
+            if self.deadline <= now:
+                missed = int((now - self.deadline) // self.period) + 1
+                log.warning("Periodic task '%s' missed %i run(s).", self.name, missed)
+                self.deadline += missed * self.period
+
+        if self.jitter:
+            return self.deadline + random.uniform(0, self.jitter)
+
+        return self.deadline
+
+    def __repr__(self):
+        return "<PeriodicTask('%s', period=%s, schedule=%r)>" % (self.name, self.period,
+                                                                 self.schedule)
 
     def run(self):
         """By default run callback.
@@ -43,31 +230,99 @@ class PeriodicThread(object):
         if self.callback is not None:
             self.callback(self.srv, *self.args, **self.kwargs)
 
-    def _run(self):
-        """Run desired callback and then reschedule Timer (if thread is not stopped)."""
+    def execute(self):
+        """Run the task, called by the scheduler's executor."""
         try:
             self.run()
         except Exception as exc:
-            log.exception("Exception in running periodic thread: %s", exc)
+            log.exception("Exception in running periodic task '%s': %s", self.name, exc)
         finally:
-            with self.schedule_lock:
-                if not self.stop:
-                    self.schedule_timer()
-
-    def schedule_timer(self):
-        """Schedule next Timer run."""
-        self.current_timer = threading.Timer(self.period, self._run)
-        if self.name:
-            self.current_timer.name = self.name
-        self.current_timer.start()
+            self.runs += 1
+            self.running = False
 
     def cancel(self):
-        """Mimic Timer standard cancel method."""
-        with self.schedule_lock:
-            self.stop = True
-            if self.current_timer is not None:
-                self.current_timer.cancel()
-
-    def join(self):
-        """Mimic Thread standard join method."""
-        self.current_timer.join()
+        """Prevent any further runs of the task."""
+        self.stop = True
+        self.next_fire = None
+
+
+class Scheduler(object):
+    """Run periodic tasks from a single thread using a heap of deadlines.
+
+    Deadlines of tasks with a fixed period advance by the period from the
+    previous deadline, not from the time the task ran, so schedules do not
+    drift. Callbacks run on a thread pool of bounded size. A task, which is
+    still running when it is due again, is skipped for that run, and runs
+    missed because the scheduler fell behind are coalesced into one.
+
+    """
+
+    def __init__(self, max_workers=4, name='scheduler'):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix=name + '-worker')
+        self.stopped = False
+        self.thread = None
+        self._heap = []
+        # Tie-breaker for tasks with identical deadlines
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    def add(self, task):
+        """Schedule task to run when it is first due (right away if its ``now`` flag is set)."""
+        with self._cond:
+            self._push(task.schedule_next(time.monotonic()), task)
+            self._cond.notify()
+
+    def _push(self, due, task):
+        heapq.heappush(self._heap, (due, next(self._counter), task))
+        task.next_fire = time.time() + due - time.monotonic()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        with self._cond:
+            while not self.stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                due, _, task = self._heap[0]
+                now = time.monotonic()
+
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+
+                heapq.heappop(self._heap)
+
+                if task.stop:
+                    continue
+
+                self._fire(task)
+                self._push(task.schedule_next(now), task)
+
+    def _fire(self, task):
+        if task.running:
+            task.skipped += 1
+            log.warning("Periodic task '%s' is still running, skipping this run.", task.name)
+            return
+
+        task.running = True
+
+        try:
+            self.executor.submit(task.execute)
+        except RuntimeError:
+            # Executor was shut down
+            task.running = False
+
+    def stop(self):
+        """Stop scheduling tasks. Tasks already running are not interrupted."""
+        with self._cond:
+            self.stopped = True
+            self._cond.notify()
+
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# (c) 2014-2019 The mqttwarn developers
+"""Shared HTTP client for service plugins.
+
+Service plugins use the session returned by ``Service.http`` instead of the
+module-level functions of ``requests``, so that connections (and TLS
+sessions) to the same host are kept alive and reused across notifications.
+The session applies a default timeout to all requests, retries failed
+connection attempts and caches host name lookups.
+
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import connection as urllib3_connection
+from urllib3 import connectionpool
+from urllib3.util.retry import Retry
+
+
+log = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class DNSCache(object):
+    """Cache results of host name lookups for ``ttl`` seconds."""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.entries = {}
+
+    def resolve(self, host, port):
+        """Return (first) IP address for host, or host itself if it cannot be resolved."""
+        key = (host, port)
+        entry = self.entries.get(key)
+
+        if entry is not None and time.monotonic() < entry[1]:
+            return entry[0]
+
+        try:
+            addrinfo = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except socket.gaierror:
+            # Let the connection attempt report the error
+            return host
+
+        address = addrinfo[0][4][0]
+        self.entries[key] = (address, time.monotonic() + self.ttl)
+        return address
+
+    def invalidate(self, host, port):
+        self.entries.pop((host, port), None)
+
+
+dns_cache = DNSCache()
+
+
+class CachedDNSMixin(object):
+    """Connect to the cached address of the host (TLS verification still uses the host name)."""
+
+    def _new_conn(self):
+        host = self._dns_host
+        self._dns_host = dns_cache.resolve(host, self.port)
+
+        try:
+            return super()._new_conn()
+        except Exception:
+            # Address may be outdated, look it up again for the next attempt
+            dns_cache.invalidate(host, self.port)
+            raise
+        finally:
+            self._dns_host = host
+
+
+class CachedDNSHTTPConnection(CachedDNSMixin, urllib3_connection.HTTPConnection):
+    pass
+
+
+class CachedDNSHTTPSConnection(CachedDNSMixin, urllib3_connection.HTTPSConnection):
+    pass
+
+
+class CachedDNSHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+    ConnectionCls = CachedDNSHTTPConnection
+
+
+class CachedDNSHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+
+class CachedDNSAdapter(HTTPAdapter):
+    """Transport adapter using connection pools, which look up host names via ``dns_cache``."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CachedDNSHTTPConnectionPool,
+            'https': CachedDNSHTTPSConnectionPool,
+        }
+
+
+class HTTPSession(requests.Session):
+    """``requests`` session with keep-alive connection pools, retries and a default timeout.
+
+    ``pool_size`` is the maximum number of connections kept open per host and
+    should match the number of threads using the session concurrently.
+    Connection errors and responses with status 502, 503 or 504 to idempotent
+    requests are retried up to ``retries`` times with exponential backoff.
+
+    """
+
+    def __init__(self, pool_size=10, retries=2, timeout=10, dns_cache_ttl=300):
+        super().__init__()
+        self.timeout = timeout
+        dns_cache.ttl = dns_cache_ttl
+        retry = Retry(total=retries, read=0, backoff_factor=0.5,
+                      status_forcelist=(502, 503, 504), raise_on_status=False)
+        adapter_class = CachedDNSAdapter if dns_cache_ttl else HTTPAdapter
+        adapter = adapter_class(pool_connections=32, pool_maxsize=pool_size, max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        return super().request(method, url, **kwargs)
+
+
+def get_session(config=None):
+    """Return the shared ``HTTPSession``, creating it according to ``config`` if needed.
+
+    ``config`` is the mqttwarn ``Config`` object, whose ``num_workers``,
+    ``http_retries``, ``http_timeout`` and ``dns_cache_ttl`` attributes are
+    used, if present.
+
+    """
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                pool_size = max(getattr(config, 'num_workers', 1), 1)
+                _session = HTTPSession(
+                    pool_size=pool_size,
+                    retries=getattr(config, 'http_retries', 2),
+                    timeout=getattr(config, 'http_timeout', 10),
+                    dns_cache_ttl=getattr(config, 'dns_cache_ttl', 300))
+                log.debug("Created shared HTTP session (pool size %i).", pool_size)
+
+    return _session
+
+
+def _reset_session():
+    global _session
+    # Connections of the parent process must not be shared with a child process
+    _session = None
+    dns_cache.entries.clear()
+
+
+os.register_at_fork(after_in_child=_reset_session)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# (c) 2014-2019 The mqttwarn developers
+"""Connection pooling and batched inserts for the MySQL service plugins."""
+
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import MySQLdb
+
+from mqttwarn.util import shutdown_event, start_flusher
+
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of MySQLdb connections.
+
+    At most ``maxconn`` connections are in use at the same time, further
+    requests for a connection block until one is returned to the pool.
+    Connections, which were idle for more than ``ping_interval`` seconds, are
+    checked (and reconnected, if necessary) before they are handed out again.
+    Connections are created on demand with the given connection parameters.
+
+    """
+
+    def __init__(self, maxconn=4, ping_interval=30, **params):
+        self.maxconn = maxconn
+        self.ping_interval = ping_interval
+        self.params = params
+        self._idle = deque()
+        self._semaphore = threading.BoundedSemaphore(maxconn)
+
+    def _getconn(self):
+        try:
+            conn, last_used = self._idle.pop()
+        except IndexError:
+            return MySQLdb.connect(**self.params)
+
+        if time.monotonic() - last_used > self.ping_interval:
+            try:
+                conn.ping()
+            except MySQLdb.Error:
+                conn.close()
+                return MySQLdb.connect(**self.params)
+
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Context manager returning a connection, which is put back in the pool afterwards.
+
+        If an exception occurs, the current transaction is rolled back. If the
+        exception is a ``MySQLdb.OperationalError``, e.g. because the server
+        went away, the connection is discarded.
+
+        """
+        self._semaphore.acquire()
+        conn = None
+
+        try:
+            conn = self._getconn()
+            yield conn
+        except MySQLdb.OperationalError:
+            if conn is not None:
+                try:
+                    conn.close()
+                except MySQLdb.Error:
+                    pass
+
+                conn = None
+            raise
+        except Exception:
+            if conn is not None:
+                conn.rollback()
+            raise
+        finally:
+            if conn is not None:
+                self._idle.append((conn, time.monotonic()))
+
+            self._semaphore.release()
+
+    def closeall(self):
+        while self._idle:
+            conn, _ = self._idle.pop()
+            conn.close()
+
+
+class BatchInserter(object):
+    """Execute INSERT statements via a ``ConnectionPool``, optionally in batches.
+
+    With ``batch_size`` of 0, ``insert()`` executes a statement right away.
+    Otherwise statements are buffered and executed with one ``executemany()``
+    call per distinct SQL statement, when ``batch_size`` rows were buffered
+    for a statement or every ``flush_interval`` seconds, whichever comes
+    first.
+
+    With ``prepare`` given, ``insert()`` buffers arbitrary rows under a key
+    instead, e.g. dicts by table name, and ``prepare(key, rows)`` returns the
+    list of (SQL statement, row values) tuples to execute for them.
+
+    Statements passed to ``defer()`` are always executed with the next
+    periodic flush. If a statement is deferred again under the same key
+    before then, only the latest one is executed.
+
+    ``on_error`` is called with the exception, when a write fails. If it
+    returns True, e.g. after refreshing cached column names, the write is
+    retried once (with statements prepared again). If the write still fails,
+    and not because of the connection, the rows are written one at a time,
+    so that only the offending rows are lost.
+
+    Buffered statements are written when mqttwarn shuts down, unless that
+    takes longer than its ``drain_timeout``.
+
+    """
+
+    def __init__(self, pool, batch_size=0, flush_interval=1.0, on_error=None,
+                 name='mysql-flusher', prepare=None):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self.prepare = prepare
+        # Buffered row values by SQL statement (or rows by key, see ``prepare``)
+        self.buffers = {}
+        # Deferred (SQL statement, values) tuples by key
+        self.deferred = {}
+        self.lock = threading.Lock()
+        self.thread = start_flusher(self._run, name)
+
+    def insert(self, sql, values):
+        """Execute or buffer INSERT statement ``sql`` with ``values``.
+
+        With ``prepare``, ``sql`` and ``values`` are the key and the row to
+        pass to it. Returns False, if the statement (or the batch it
+        completed) could not be executed, True otherwise.
+
+        """
+        if self.batch_size <= 0:
+            return self.write({sql: [values]})
+
+        with self.lock:
+            rows = self.buffers.setdefault(sql, [])
+            rows.append(values)
+
+            if len(rows) < self.batch_size:
+                return True
+
+            del self.buffers[sql]
+
+        return self.write({sql: rows})
+
+    def defer(self, key, sql, values):
+        """Execute ``sql`` with ``values`` with the next flush, replacing older ones for ``key``."""
+        with self.lock:
+            self.deferred[key] = (sql, values)
+
+    def flush(self):
+        """Execute all buffered and deferred statements."""
+        with self.lock:
+            buffers, self.buffers = self.buffers, {}
+            deferred, self.deferred = self.deferred, {}
+
+        if buffers or deferred:
+            self.write(buffers, list(deferred.values()))
+
+    def statements(self, buffers, deferred=()):
+        """Return list of (SQL statement, list of row values) tuples to write."""
+        if self.prepare is None:
+            statements = list(buffers.items())
+        else:
+            statements = []
+
+            for key, rows in buffers.items():
+                for sql, values in self.prepare(key, rows):
+                    if statements and statements[-1][0] == sql:
+                        statements[-1][1].append(values)
+                    else:
+                        statements.append((sql, [values]))
+
+        return statements + [(sql, [values]) for sql, values in deferred]
+
+    def execute(self, statements):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            try:
+                for sql, rows in statements:
+                    log.debug("Query: %s (%i rows)", sql, len(rows))
+                    cursor.executemany(sql, rows)
+
+                conn.commit()
+            finally:
+                cursor.close()
+
+    def write(self, buffers, deferred=()):
+        """Write buffered rows and deferred (SQL statement, values) tuples.
+
+        Returns False, if any of them could not be written.
+
+        """
+        count = sum(len(rows) for rows in buffers.values()) + len(deferred)
+
+        for attempt in (1, 2):
+            try:
+                self.execute(self.statements(buffers, deferred))
+                return True
+            except Exception as exc:
+                error = exc
+
+                if not (self.on_error is not None and self.on_error(exc) and attempt == 1):
+                    break
+
+                log.debug("Retrying to write %i rows to MySQL database: %s", count, exc)
+
+        # Client errors (2000-2999), e.g. no connection to the server, affect all rows alike
+        if (count == 1 or not isinstance(error, MySQLdb.Error) or
+                (error.args and isinstance(error.args[0], int) and
+                 2000 <= error.args[0] < 3000)):
+            log.error("Cannot write %i rows to MySQL database: %s", count, error)
+            return False
+
+        log.debug("Cannot write %i rows to MySQL database at once, writing them one at a "
+                  "time: %s", count, error)
+        singles = [({key: [row]}, ()) for key, rows in buffers.items() for row in rows]
+        singles.extend(({}, (statement,)) for statement in deferred)
+        failed = 0
+
+        for single_buffers, single_deferred in singles:
+            try:
+                self.execute(self.statements(single_buffers, single_deferred))
+            except Exception as exc:
+                failed += 1
+                error = exc
+
+        if failed:
+            log.error("Cannot write %i of %i rows to MySQL database: %s", failed, count, error)
+
+        return not failed
+
+    def _run(self):
+        while not shutdown_event.wait(self.flush_interval):
+            self.flush()
+
+        self.flush()
@@ -4,12 +4,200 @@ __author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
 __copyright__ = 'Copyright 2014 Jan-Piet Mens'
 __license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
 
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from mqttwarn.util import shutdown_event, start_flusher
+
 HAVE_PUKA=True
 try:
     import puka
 except ImportError:
     HAVE_PUKA=False
 
+log = logging.getLogger(__name__)
+
+HEADERS = {
+    'content_type'    : 'text/plain',
+    'x-agent'         : 'mqttwarn',
+    'delivery_mode'   : 1,
+}
+
+# Publishers by URI
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+
+class AMQPPublisher(object):
+    """Publish to an AMQP broker through a persistent connection.
+
+    Messages are published with publisher confirms (if supported by the
+    broker). With ``batch_size`` greater than zero, messages are buffered and
+    published by a background thread in batches of up to ``batch_size``
+    messages, waiting for the confirms of a whole batch at once, at the
+    latest every ``flush_interval`` seconds. A batch, which could not be
+    published, is retried with the next flush. At most ``max_buffered``
+    messages are kept, the oldest are dropped first.
+
+    If publishing fails on an established connection, e.g. because the broker
+    closed it while idle, the messages are published again on a new
+    connection right away. Failed attempts to connect are repeated with an
+    increasing delay (up to a minute).
+
+    """
+
+    def __init__(self, uri, batch_size=0, flush_interval=1.0, max_buffered=10000, timeout=10):
+        self.uri = uri
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.client = None
+        # The puka client is not thread-safe
+        self.lock = threading.Lock()
+        self.retry_after = 0
+        self.retry_delay = 0
+        self.buffer = deque(maxlen=max_buffered)
+        self.buffer_lock = threading.Lock()
+        self.dropped = 0
+        self.wakeup = threading.Event()
+        self.flusher = None
+
+        if batch_size > 0:
+            self.flusher = start_flusher(self.run_flusher, 'amqp-flusher', self.wakeup)
+
+    def connect(self):
+        client = puka.Client(self.uri)
+
+        if client.wait(client.connect(), timeout=self.timeout) is None:
+            client.close()
+            raise IOError("timeout connecting to AMQP broker")
+
+        self.client = client
+        log.debug("Connected to AMQP broker.")
+
+    def close(self):
+        if self.client is not None:
+            try:
+                self.client.close()
+            except Exception:
+                pass
+
+            self.client = None
+
+    def publish_batch(self, messages):
+        """Publish (exchange, routing key, body) tuples and wait for their confirms."""
+        with self.lock:
+            for attempt in (1, 2):
+                reused = self.client is not None
+
+                if not reused:
+                    if time.monotonic() < self.retry_after:
+                        raise IOError("not connected to AMQP broker, next attempt in %.0fs" %
+                                      (self.retry_after - time.monotonic()))
+
+                    try:
+                        self.connect()
+                    except Exception:
+                        self.retry_delay = min(max(self.retry_delay * 2, 1), 60)
+                        self.retry_after = time.monotonic() + self.retry_delay
+                        raise
+
+                try:
+                    promises = [self.client.basic_publish(exchange=exchange,
+                                                          routing_key=routing_key,
+                                                          headers=HEADERS, body=body)
+                                for exchange, routing_key, body in messages]
+
+                    for promise in promises:
+                        if self.client.wait(promise, timeout=self.timeout) is None:
+                            raise IOError("timeout waiting for confirmation by AMQP broker")
+                except Exception as exc:
+                    # Start over with a new connection (and channel)
+                    self.close()
+
+                    if not (reused and attempt == 1):
+                        raise
+
+                    # Messages confirmed before the failure are published twice
+                    log.debug("Lost connection to AMQP broker, reconnecting: %s", exc)
+                    continue
+
+                break
+
+            self.retry_delay = 0
+
+    def publish(self, exchange, routing_key, body):
+        if self.flusher is None:
+            self.publish_batch([(exchange, routing_key, body)])
+            return
+
+        with self.buffer_lock:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+
+                if self.dropped % 1000 == 1:
+                    log.warning("AMQP buffer full, dropped %i messages so far.", self.dropped)
+
+            self.buffer.append((exchange, routing_key, body))
+
+            if len(self.buffer) >= self.batch_size:
+                self.wakeup.set()
+
+    def flush(self):
+        """Publish buffered messages. Return False if this failed."""
+        while True:
+            with self.buffer_lock:
+                batch = [self.buffer.popleft()
+                         for _ in range(min(self.batch_size, len(self.buffer)))]
+
+            if not batch:
+                return True
+
+            try:
+                self.publish_batch(batch)
+            except Exception as exc:
+                log.warning("Cannot publish %i messages to AMQP broker: %s", len(batch), exc)
+
+                # Keep messages for the next attempt, unless newer ones took their place
+                with self.buffer_lock:
+                    space = self.buffer.maxlen - len(self.buffer)
+                    self.dropped += max(len(batch) - space, 0)
+                    self.buffer.extendleft(reversed(batch[max(len(batch) - space, 0):]))
+
+                return False
+
+    def run_flusher(self):
+        while not shutdown_event.is_set():
+            self.wakeup.wait(max(self.flush_interval, self.retry_after - time.monotonic()))
+            self.wakeup.clear()
+            self.flush()
+
+        self.flush()
+
+        with self.lock:
+            self.close()
+
+
+def get_publisher(uri, config=None):
+    """Return the ``AMQPPublisher`` for given URI, creating it if needed."""
+    config = config or {}
+
+    with _publishers_lock:
+        publisher = _publishers.get(uri)
+
+        if publisher is None:
+            publisher = _publishers[uri] = AMQPPublisher(
+                uri,
+                batch_size=config.get('batch_size', 0),
+                flush_interval=config.get('flush_interval', 1.0),
+                max_buffered=config.get('max_buffered', 10000),
+                timeout=config.get('timeout', 10))
+
+    return publisher
+
 
 def plugin(srv, item):
 
@@ -23,24 +211,20 @@ def plugin(srv, item):
 
     exchange, routing_key = item.addrs
 
+    # Exchange and routing key may contain transformation data
+    if item.data is not None:
+        try:
+            exchange = exchange.format(**item.data)
+            routing_key = routing_key.format(**item.data)
+        except Exception as exc:
+            srv.log.debug("Message not published. Exchange or routing key cannot be formatted: "
+                          "%s", exc)
+            return False
+
     try:
         srv.log.debug("AMQP publish to %s [%s/%s]..." % (item.target, exchange, routing_key))
 
-        client = puka.Client(uri)
-        promise = client.connect()
-        client.wait(promise)
-
-        headers = {
-                'content_type'    : 'text/plain',
-                'x-agent'         : 'mqttwarn',
-                'delivery_mode'   : 1,
-             }
-        promise = client.basic_publish(exchange=exchange,
-                        routing_key=routing_key,
-                        headers=headers,
-                        body=item.message)
-        client.wait(promise)
-        client.close()
+        get_publisher(uri, item.config).publish(exchange, routing_key, item.message)
 
         srv.log.debug("Successfully published AMQP notification")
     except Exception as exc:
@@ -48,3 +232,7 @@ def plugin(srv, item):
         return False
 
     return True
+
+
+# Connections of the parent process are not usable after a fork
+os.register_at_fork(after_in_child=_publishers.clear)
@@ -13,9 +13,6 @@ __copyright__ = 'Copyright 2018 Michael Brougham'
 __license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
 
 
-#import json
-import requests
-
 def plugin(srv, item):
     ''' expects (apikey, password, target, group, ttl) in addrs '''
 
@@ -23,11 +20,19 @@ def plugin(srv, item):
 
     try:
         srv.log.debug("Sending to autoremote service")
-        url = "https://" + item.addrs[0] + ":" + item.addrs[1]
-        requests.get('https://autoremotejoaomgcd.appspot.com/sendmessage?key=' + item.addrs[0] + '&message=' + item.message + '&target=' + item.addrs[2] + '&sender=' + item.topic + '&password=' + item.addrs[1] + '&ttl=' + item.addrs[4] + '&collapseKey=' + item.addrs[3])
-	srv.log.debug("Successfully sent to autoremote service")
+        params = {
+            'key': item.addrs[0],
+            'message': item.message,
+            'target': item.addrs[2],
+            'sender': item.topic,
+            'password': item.addrs[1],
+            'ttl': item.addrs[4],
+            'collapseKey': item.addrs[3],
+        }
+        srv.http.get('https://autoremotejoaomgcd.appspot.com/sendmessage', params=params)
+        srv.log.debug("Successfully sent to autoremote service")
     except Exception as exc:
-        srv.log.warning("Failed to send message to autoremote service", exc)
+        srv.log.warning("Failed to send message to autoremote service: %s", exc)
         return False
 
     return True
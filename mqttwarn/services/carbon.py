@@ -4,8 +4,155 @@ __author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
 __copyright__ = 'Copyright 2014 Jan-Piet Mens'
 __license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
 
+import logging
+import os
+import pickle
 import socket
+import struct
+import threading
 import time
+from collections import deque
+
+from mqttwarn.util import shutdown_event, start_flusher
+
+log = logging.getLogger(__name__)
+
+# Carbon clients by (host, port, protocol)
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class CarbonClient(object):
+    """Send metrics to a carbon server over a persistent TCP connection.
+
+    Metrics are buffered and sent from a background thread, in batches of up
+    to ``batch_size`` metrics, using either the plaintext or the pickle
+    protocol. While the server is unreachable, the thread tries to reconnect
+    with an increasing delay (up to a minute) and metrics are kept in the
+    buffer. At most ``max_buffered`` metrics are kept, the oldest are dropped
+    first.
+
+    Buffered metrics are sent (if possible) when mqttwarn shuts down, unless
+    that takes longer than its ``drain_timeout``.
+
+    """
+
+    def __init__(self, host, port, protocol='plaintext', batch_size=500, flush_interval=1.0,
+                 max_buffered=10000, timeout=10):
+        if protocol not in ('plaintext', 'pickle'):
+            raise ValueError("Invalid carbon protocol '%s'." % protocol)
+
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.buffer = deque(maxlen=max_buffered)
+        self.dropped = 0
+        self.sock = None
+        self.retry_delay = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = start_flusher(self._run, 'carbon-%s:%i' % (host, port), self.wakeup)
+
+    def send(self, metric, value, timestamp):
+        """Queue metric to be sent."""
+        with self.lock:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+
+                if self.dropped % 1000 == 1:
+                    log.warning("Carbon buffer for %s:%i full, dropped %i metrics so far.",
+                                self.host, self.port, self.dropped)
+
+            self.buffer.append((metric, (timestamp, value)))
+
+            if len(self.buffer) >= self.batch_size:
+                self.wakeup.set()
+
+    def encode(self, batch):
+        if self.protocol == 'pickle':
+            payload = pickle.dumps(batch, protocol=2)
+            return struct.pack('!L', len(payload)) + payload
+
+        return ''.join('%s %s %d\n' % (metric, value, timestamp)
+                       for metric, (timestamp, value) in batch).encode('utf-8')
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        log.debug("Connected to carbon server %s:%i.", self.host, self.port)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+            self.sock = None
+
+    def flush(self):
+        """Send buffered metrics. Return False if the server is unreachable."""
+        while True:
+            with self.lock:
+                batch = [self.buffer.popleft()
+                         for _ in range(min(self.batch_size, len(self.buffer)))]
+
+            if not batch:
+                return True
+
+            try:
+                if self.sock is None:
+                    self.connect()
+
+                self.sock.sendall(self.encode(batch))
+            except OSError as exc:
+                log.warning("Cannot send to carbon service %s:%d: %s", self.host, self.port,
+                            exc)
+                self.close()
+
+                # Keep metrics for the next attempt, unless newer ones took their place
+                with self.lock:
+                    space = self.buffer.maxlen - len(self.buffer)
+                    self.dropped += max(len(batch) - space, 0)
+                    self.buffer.extendleft(reversed(batch[max(len(batch) - space, 0):]))
+
+                return False
+
+    def _run(self):
+        while not shutdown_event.is_set():
+            self.wakeup.wait(max(self.flush_interval, self.retry_delay))
+            self.wakeup.clear()
+
+            if self.flush():
+                self.retry_delay = 0
+            else:
+                self.retry_delay = min(max(self.retry_delay * 2, 1), 60)
+
+        self.flush()
+        self.close()
+
+
+def get_client(host, port, config=None):
+    """Return the ``CarbonClient`` for given server, creating it if needed."""
+    config = config or {}
+    protocol = config.get('protocol', 'plaintext')
+    key = (host, port, protocol)
+
+    with _clients_lock:
+        client = _clients.get(key)
+
+        if client is None:
+            client = _clients[key] = CarbonClient(
+                host, port, protocol,
+                batch_size=config.get('batch_size', 500),
+                flush_interval=config.get('flush_interval', 1.0),
+                max_buffered=config.get('max_buffered', 10000))
+
+    return client
+
 
 def plugin(srv, item):
 
@@ -19,7 +166,8 @@ def plugin(srv, item):
     try:
         carbon_host, carbon_port = item.addrs
         carbon_port = int(carbon_port)
-    except:
+        client = get_client(carbon_host, carbon_port, config)
+    except Exception:
         srv.log.error("Configuration for target `carbon' is incorrect")
         return False
 
@@ -37,29 +185,33 @@ def plugin(srv, item):
         metric_name = item.data.get('topic', 'ohno').replace('/', '.')
         value = parts[0]
         tics = int(time.time())
+    elif len(parts) == 2:
+        metric_name = parts[0]
+        value = parts[1]
+        tics = int(time.time())
+    elif len(parts) == 3:
+        metric_name = parts[0]
+        value = parts[1]
+        tics = int(parts[2])
     else:
-        if len(parts) == 2:
-            metric_name = parts[0]
-            value = parts[1]
-            tics = int(time.time())
-        else:
-            if len(parts) == 3:
-                metric_name = parts[0]
-                value = parts[1]
-                tics = int(parts[2])
+        srv.log.error("target `carbon': message must have one to three parts: %s", text)
+        return False
+
+    if client.protocol == 'pickle':
+        try:
+            value = float(value)
+        except ValueError:
+            srv.log.error("target `carbon': value is not a number: %s", value)
+            return False
 
     if metric_name.startswith('.'):     # omit dot there caused by useless leading slash in topic
         metric_name = metric_name[1:]
-    carbon_msg = "%s %s %d" % (metric_name, value, tics)
-    srv.log.debug("Sending to carbon: %s" % (carbon_msg))
-    carbon_msg = carbon_msg + "\n"
-    try:
-        sock = socket.socket()
-        sock.connect((carbon_host, carbon_port))
-        sock.sendall(carbon_msg)
-        sock.close()
-    except Exception as exc:
-        srv.log.warning("Cannot send to carbon service %s:%d: %s" % (carbon_host, carbon_port, exc))
-        return False
 
+    srv.log.debug("Sending to carbon: %s %s %d" % (metric_name, value, tics))
+    # Sent in the background, errors are logged by the client
+    client.send(metric_name, value, tics)
     return True
+
+
+# Clients (and their threads) of the parent process are not usable after a fork
+os.register_at_fork(after_in_child=_clients.clear)
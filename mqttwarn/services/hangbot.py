@@ -14,7 +14,6 @@ __license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/
 
 
 import json
-import requests
 
 def plugin(srv, item):
     ''' expects (url,port,apikey, convid) in addrs '''
@@ -30,7 +29,7 @@ def plugin(srv, item):
         srv.log.debug("Sending to hangoutsbot")
         url = "https://" + item.addrs[0] + ":" + item.addrs[1]
         headers = {'content-type': 'application/json'}
-        requests.post(url, data = json.dumps(payload), headers = headers, verify=False)
+        srv.http.post(url, data = json.dumps(payload), headers = headers, verify=False)
         srv.log.debug("Successfully sent to hangoutsbot")
     except Exception as exc:
         srv.log.warning("Failed to send message to hangoutsbot", exc)
@@ -5,7 +5,6 @@ __copyright__ = "2019 Christopher Arndt"
 __license__ = "MIT License"
 
 
-import requests
 import six
 
 
@@ -116,7 +115,7 @@ def plugin(srv, item):
 
     try:
         srv.log.debug("kwargs: %r", kwargs)
-        response = requests.request(method, url, timeout=timeout, **kwargs)
+        response = srv.http.request(method, url, timeout=timeout, **kwargs)
         response.raise_for_status()
     except Exception as exc:
         srv.log.warn("%s request to %s failed: %s", method, url, exc)
@@ -79,7 +79,7 @@ def plugin(srv, item):
 
     try:
         url = "%s:%d/v1/actions/process-check-result" % (host, port)
-        r = requests.post(url, **kwargs)
+        r = srv.http.post(url, **kwargs)
         if r.status_code != requests.codes.ok:
             srv.log.warning("Invalid response from icinga2 REST API at `%s`: %s" % (host, r.text))
             return False
@@ -4,8 +4,6 @@ __author__    = 'Bram Hendrickx'
 __copyright__ = 'Copyright 2016 Bram Hendrickx'
 __license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
 
-import requests
-
 def plugin(srv, item):
     ''' expects (apikey, event) in adddrs '''
 
@@ -27,7 +25,7 @@ def plugin(srv, item):
     try:
         srv.log.debug("Sending ifttt event")
         url = "https://maker.ifttt.com/trigger/" + event + "/with/key/" + apikey
-        requests.post(url, data=payload)
+        srv.http.post(url, data=payload)
         srv.log.debug("Successfully sent ifttt event")
     except Exception as exc:
         srv.log.warning("Cannot send ifttt event: %s", exc)
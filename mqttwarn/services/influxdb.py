@@ -4,47 +4,250 @@ __author__    = 'Ben Jones <ben.jones12()gmail.com>'
 __copyright__ = 'Copyright 2016 Ben Jones'
 __license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
 
-import requests
+import gzip
 import logging
+import threading
+import time
+from collections import deque
+
+import requests
+import six
+
+from mqttwarn.util import shutdown_event, start_flusher
 
 # disable info logging in requests module (e.g. connection pool message for every post request)
 logging.getLogger("requests").setLevel(logging.WARNING)
 
-def plugin(srv, item):
-    ''' addrs: (measurement) '''
-
-    srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service, item.target)
-
-    host        = item.config['host']
-    port        = item.config['port']
-    username    = item.config['username']
-    password    = item.config['password']
-    database    = item.config['database']
-
-    measurement = item.addrs[0]
-    tag         = "topic=" + item.topic.replace('/', '_')
-    value       = item.message
-    
-    try:
-        url = "http://%s:%d/write?db=%s" % (host, port, database)
-        data = measurement + ',' + tag + ' value=' + value
-        
-        if username is None:
-            r = requests.post(url, data=data)
+# Timestamp multipliers for the supported write precisions
+PRECISIONS = {
+    'ns': 10 ** 9,
+    'u': 10 ** 6,
+    'ms': 10 ** 3,
+    's': 1,
+    'm': 1 / 60.0,
+    'h': 1 / 3600.0,
+}
+
+# Transformation data, which is never mapped to fields
+META_KEYS = ('payload', 'raw_payload', 'topic')
+
+
+def escape_key(s):
+    """Escape measurement names, tag keys, tag values and field keys for the line protocol."""
+    return six.text_type(s).replace(',', r'\,').replace('=', r'\=').replace(' ', r'\ ')
+
+
+def format_field(value, integer=False):
+    """Return value formatted as a line protocol field value.
+
+    Numbers are written as floats, since InfluxDB rejects points changing the
+    type of a field (e.g. ``21`` followed by ``21.5``), unless ``integer``.
+
+    """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    elif integer and isinstance(value, six.integer_types):
+        return '%ii' % value
+    elif isinstance(value, (float, six.integer_types)):
+        return repr(float(value))
+
+    return '"%s"' % six.text_type(value).replace('\\', '\\\\').replace('"', r'\"')
+
+
+class Plugin:
+    """influxdb service plugin.
+
+    Writes to the InfluxDB HTTP API using the shared HTTP session. With
+    ``batch_size`` greater than zero, lines are buffered and written in
+    batches of up to ``batch_size`` lines, at the latest every
+    ``flush_interval`` seconds. If a batch cannot be written because the
+    server is unreachable or returns a server error, it is retried with the
+    next flush. At most ``max_buffered`` lines are kept, the oldest are
+    dropped first.
+
+    addrs: (measurement[, tag keys[, field keys[, integer field keys]]])
+
+    """
+
+    def __init__(self, srv=None, config=None):
+        self.srv = srv
+        self.log = srv.log
+        conf = config.get
+        host = conf('host')
+        port = conf('port')
+        self.database = conf('database')
+        self.precision = conf('precision', 'ns')
+        self.gzip = conf('gzip', False)
+        self.batch_size = conf('batch_size', 0)
+        self.flush_interval = conf('flush_interval', 1.0)
+        self.max_buffered = conf('max_buffered', 10000)
+        self.timeout = conf('timeout', 10)
+
+        if self.precision not in PRECISIONS:
+            raise ValueError("Invalid precision '%s' (must be one of %s)." %
+                             (self.precision, ", ".join(PRECISIONS)))
+
+        self.url = "http://%s:%d/write" % (host, port)
+        self.params = {'db': self.database, 'precision': self.precision}
+        self.auth = None
+        self.headers = {}
+
+        if conf('username') is not None:
+            self.auth = (conf('username'), conf('password'))
+
+        if self.gzip:
+            self.headers['Content-Encoding'] = 'gzip'
+
+        self.buffer = deque()
+        self.lock = threading.Lock()
+        # Serializes writes of buffered lines, so that batches stay in order
+        self.write_lock = threading.Lock()
+        self.dropped = 0
+        # Monotonic time before which a failed write is not retried
+        self.retry_after = 0
+        self.flusher = None
+
+        if self.batch_size > 0:
+            self.flusher = start_flusher(self.run_flusher, 'influxdb-flusher')
+
+    def make_line(self, item):
+        """Return line protocol representation of a notification."""
+        measurement = item.addrs[0]
+        tags = [('topic', item.topic.replace('/', '_'))]
+
+        if len(item.addrs) > 1:
+            # Tag and field keys are mapped from the (JSON) data of the message
+            tag_keys = item.addrs[1]
+            tags.extend((key, item.data[key]) for key in tag_keys if key in item.data)
+
+            if len(item.addrs) > 2:
+                field_keys = [key for key in item.addrs[2] if key in item.data]
+            else:
+                field_keys = sorted(key for key in item.data
+                                    if key not in tag_keys and key not in META_KEYS and
+                                    not key.startswith('_') and
+                                    isinstance(item.data[key], (six.string_types, int, float)))
+
+            integer_keys = item.addrs[3] if len(item.addrs) > 3 else ()
+            fields = ','.join('%s=%s' % (escape_key(key),
+                                         format_field(item.data[key], key in integer_keys))
+                              for key in field_keys)
         else:
-            r = requests.post(url, data=data, auth=(username, password))
-        
+            fields = 'value=%s' % item.message
+
+        if not fields:
+            raise ValueError("No fields in data of message on topic '%s'." % item.topic)
+
+        # Not ``_dtepoch``, which is derived from a naive UTC datetime and thus off by the
+        # host's UTC offset
+        timestamp = int(time.time() * PRECISIONS[self.precision])
+        return '%s,%s %s %i' % (escape_key(measurement),
+                                ','.join('%s=%s' % (escape_key(key), escape_key(value))
+                                         for key, value in tags),
+                                fields, timestamp)
+
+    def post(self, lines):
+        """Write lines to the database.
+
+        Returns True on success, False if the request failed permanently and
+        None if it should be retried.
+
+        """
+        data = '\n'.join(lines).encode('utf-8')
+
+        if self.gzip:
+            data = gzip.compress(data)
+
+        try:
+            r = self.srv.http.post(self.url, params=self.params, data=data, auth=self.auth,
+                                   headers=self.headers, timeout=self.timeout)
+        except requests.RequestException as exc:
+            self.log.warn("Failed to send POST request to InfluxDB server using %s: %s" %
+                          (self.url, exc))
+            return None
+
         # success
         if r.status_code == 204:
             return True
-            
+
         # request accepted but couldn't be completed (200) or failed (otherwise)
         if r.status_code == 200:
-            srv.log.warn("POST request could not be completed: %s" % (r.text))
+            self.log.warn("POST request could not be completed: %s" % (r.text))
         else:
-            srv.log.warn("POST request failed: (%s) %s" % (r.status_code, r.text))
-        
-    except Exception as exc:
-        srv.log.warn("Failed to send POST request to InfluxDB server using %s: %s" % (url, exc))
+            self.log.warn("POST request failed: (%s) %s" % (r.status_code, r.text))
+
+        return None if r.status_code >= 500 else False
+
+    def buffer_line(self, line):
+        with self.lock:
+            if len(self.buffer) >= self.max_buffered:
+                self.buffer.popleft()
+                self.dropped += 1
+
+                if self.dropped % 1000 == 1:
+                    self.log.warn("InfluxDB write buffer full, dropped %i lines so far.",
+                                  self.dropped)
+
+            self.buffer.append(line)
+            full = len(self.buffer) >= self.batch_size
+
+        if full and time.monotonic() >= self.retry_after:
+            self.flush(blocking=False)
+
+    def flush(self, blocking=True):
+        """Write buffered lines in batches of ``batch_size``.
+
+        With ``blocking`` False, return immediately if another thread is
+        already writing.
+
+        """
+        if not self.write_lock.acquire(blocking):
+            return
+
+        try:
+            while True:
+                with self.lock:
+                    batch = [self.buffer.popleft()
+                             for _ in range(min(self.batch_size, len(self.buffer)))]
+
+                if not batch:
+                    break
+
+                if self.post(batch) is None:
+                    # Retry with the next periodic flush, keeping the order of lines
+                    self.retry_after = time.monotonic() + self.flush_interval
+
+                    with self.lock:
+                        self.buffer.extendleft(reversed(batch))
+
+                        while len(self.buffer) > self.max_buffered:
+                            self.buffer.popleft()
+                            self.dropped += 1
+                    break
+        finally:
+            self.write_lock.release()
+
+    def run_flusher(self):
+        while not shutdown_event.wait(self.flush_interval):
+            self.flush()
+
+        self.flush()
+
+    def plugin(self, srv, item):
+        srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service,
+                      item.target)
+
+        try:
+            line = self.make_line(item)
+        except Exception as exc:
+            srv.log.warn("Cannot build InfluxDB line for target '%s': %s", item.target, exc)
+            return False
+
+        if self.batch_size > 0:
+            # Written by a flush, errors are logged there
+            self.buffer_line(line)
+            return True
+
+        return bool(self.post([line]))
 
-    return False
+    __call__ = plugin
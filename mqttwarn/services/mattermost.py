@@ -75,7 +75,7 @@ def plugin(srv, item):
         }
 
     try:
-        r = requests.post(hook_url, data=json.dumps(payload), headers=headers)
+        r = srv.http.post(hook_url, data=json.dumps(payload), headers=headers)
         if r.status_code != requests.codes.ok:
             srv.log.warning("Invalid response from Mattermost Webhook: %s" % (r.text))
             return False
@@ -4,14 +4,31 @@ __author__ = "Jan-Piet Mens <jpmens()gmail.com>"
 __copyright__ = "Copyright 2014 Jan-Piet Mens"
 __license__ = "Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"
 
-import paho.mqtt.publish as mqtt  # pip install --upgrade paho-mqtt
+import logging
+import os
+import threading
+import time
+
+import paho.mqtt.client as paho  # pip install --upgrade paho-mqtt
 import six
 
+from mqttwarn.configuration import TLS_VERSIONS
+from mqttwarn.util import shutdown_event, shutdown_timeout, start_flusher
+
 try:
     from configparser import RawConfigParser
 except ImportError:
     from ConfigParser import RawConfigParser
 
+log = logging.getLogger(__name__)
+
+# Publishers by broker parameters
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+# Parameters read from INI files by file name: (modification time, params)
+_ini_cache = {}
+
 
 def read_conf(ini_file, params):
     c = RawConfigParser()
@@ -37,6 +54,202 @@ def read_conf(ini_file, params):
         params['tls'] = dict(c.items('tls'))
 
 
+def read_conf_cached(ini_file, params):
+    """Like ``read_conf``, but parse the INI file again only after it has been modified."""
+    try:
+        mtime = os.stat(ini_file).st_mtime
+    except OSError:
+        # Missing files are ignored by read_conf as well
+        mtime = None
+
+    cached = _ini_cache.get(ini_file)
+
+    if cached is None or cached[0] != mtime:
+        ini_params = {}
+        read_conf(ini_file, ini_params)
+        cached = _ini_cache[ini_file] = (mtime, ini_params)
+
+    params.update(cached[1])
+
+
+class Publisher(object):
+    """Publish to an MQTT broker through a persistent connection.
+
+    The client runs its own network loop and reconnects automatically. At
+    most ``inflight`` messages are waiting to be sent or acknowledged by the
+    broker at a time; ``publish`` waits up to ``timeout`` seconds for a free
+    slot. While the connection is down, QoS 0 messages wait up to ``timeout``
+    seconds for it to be re-established, QoS 1 and 2 messages are queued by
+    the client and sent after reconnecting.
+
+    When mqttwarn shuts down, outstanding messages are given ``timeout``
+    seconds (at most until its ``drain_timeout`` has passed) to be sent before
+    disconnecting.
+
+    QoS 0 messages, which have not been sent when the connection is lost, are
+    discarded by the client without a publish callback, so they give up their
+    slot on connect and disconnect.
+
+    """
+
+    def __init__(self, hostname='localhost', port=1883, client_id=None, auth=None, tls=None,
+                 keepalive=60, inflight=20, timeout=10):
+        self.address = '%s:%s' % (hostname, port)
+        self.timeout = timeout
+        self.window = threading.Semaphore(inflight)
+        # Messages holding a slot: {mid: (qos, MQTTMessageInfo)}
+        self.outstanding = {}
+        # Mids published before ``publish`` could record them
+        self.published = set()
+        self.lock = threading.Lock()
+        self.connected = threading.Event()
+
+        self.client = paho.Client(client_id or '')
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+        self.client.max_inflight_messages_set(inflight)
+        self.client.reconnect_delay_set(1, 60)
+
+        if auth:
+            self.client.username_pw_set(auth['username'], auth.get('password'))
+
+        if tls:
+            tls = dict(tls)
+            insecure = tls.pop('insecure', False)
+
+            # Values from INI files are strings
+            if 'tls_version' in tls:
+                tls['tls_version'] = TLS_VERSIONS.get(tls['tls_version'], tls['tls_version'])
+
+            self.client.tls_set(**tls)
+
+            if RawConfigParser.BOOLEAN_STATES.get(str(insecure).lower()):
+                self.client.tls_insecure_set(True)
+
+        self.client.connect_async(hostname, port, keepalive)
+        self.client.loop_start()
+
+        self.closer = start_flusher(self._close_at_exit, 'mqtt-publisher-%s' % self.address)
+
+    @property
+    def pending(self):
+        return len(self.outstanding)
+
+    def release(self, mid):
+        """Give up the slot of a message, return False if it doesn't hold one."""
+        with self.lock:
+            if self.outstanding.pop(mid, None) is None:
+                return False
+
+        self.window.release()
+        return True
+
+    def drop_lost(self):
+        """Release the slots of QoS 0 messages, which the client discards on reconnect."""
+        with self.lock:
+            lost = [mid for mid, (qos, info) in self.outstanding.items()
+                    if qos == 0 and not info.is_published()]
+
+        dropped = sum(self.release(mid) for mid in lost)
+
+        if dropped:
+            log.warning("Lost %i unsent messages to MQTT broker %s.", dropped, self.address)
+
+    def on_connect(self, client, userdata, flags, result_code):
+        self.drop_lost()
+
+        if result_code == 0:
+            log.debug("Connected to MQTT broker %s.", self.address)
+            self.connected.set()
+        else:
+            log.warning("Connection to MQTT broker %s refused: %s", self.address,
+                        paho.connack_string(result_code))
+
+    def on_disconnect(self, client, userdata, result_code):
+        self.connected.clear()
+        self.drop_lost()
+
+        if result_code != 0:
+            log.warning("Lost connection to MQTT broker %s, reconnecting.", self.address)
+
+    def on_publish(self, client, userdata, mid):
+        if not self.release(mid):
+            # Published before ``publish`` could record it
+            with self.lock:
+                self.published.add(mid)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        """Queue message for publishing, raise ``IOError`` if this is not possible."""
+        if not self.window.acquire(timeout=self.timeout):
+            raise IOError("%i messages to %s still outstanding after %ss" %
+                          (self.pending, self.address, self.timeout))
+
+        try:
+            if qos == 0 and not self.connected.wait(self.timeout):
+                raise IOError("not connected to %s" % self.address)
+
+            info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        except Exception:
+            self.window.release()
+            raise
+
+        # Unless they have been sent, QoS 1 and 2 messages are queued by the client
+        if info.rc != paho.MQTT_ERR_SUCCESS and not (qos > 0 and info.rc == paho.MQTT_ERR_NO_CONN):
+            self.window.release()
+            raise IOError(paho.error_string(info.rc))
+
+        with self.lock:
+            if info.mid in self.published:
+                self.published.discard(info.mid)
+                done = True
+            else:
+                self.outstanding[info.mid] = (qos, info)
+                done = False
+
+        if done:
+            self.window.release()
+
+    def close(self):
+        deadline = time.monotonic() + min(self.timeout, shutdown_timeout(self.timeout))
+
+        while self.pending > 0 and self.connected.is_set() and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        if self.pending > 0:
+            log.warning("Discarding %i unsent messages to MQTT broker %s.", self.pending,
+                        self.address)
+
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def _close_at_exit(self):
+        shutdown_event.wait()
+        self.close()
+
+
+def get_publisher(params, config=None):
+    """Return the ``Publisher`` for given broker parameters, creating it if needed."""
+    config = config or {}
+    auth = params.get('auth')
+    tls = params.get('tls')
+    key = (params['hostname'], params['port'], params.get('client_id'),
+           tuple(sorted(auth.items())) if auth else None,
+           tuple(sorted(tls.items())) if tls else None)
+
+    with _publishers_lock:
+        publisher = _publishers.get(key)
+
+        if publisher is None:
+            publisher = _publishers[key] = Publisher(
+                params['hostname'], params['port'], params.get('client_id'), auth, tls,
+                keepalive=int(config.get('keepalive', 60)),
+                inflight=int(config.get('inflight', 20)),
+                timeout=config.get('timeout', 10))
+
+    return publisher
+
+
 def plugin(srv, item):
     srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service, item.target)
 
@@ -69,7 +282,7 @@ def plugin(srv, item):
     else:
         if ini_file is not None:
             try:
-                read_conf(ini_file, params)
+                read_conf_cached(ini_file, params)
             except Exception as exc:
                 srv.log.error("Target mqtt cannot load/parse INI file `%s': %s", ini_file, exc)
                 return False
@@ -88,9 +301,15 @@ def plugin(srv, item):
         outgoing_payload = outgoing_payload.encode('utf-8')
 
     try:
-        mqtt.single(outgoing_topic, outgoing_payload, **params)
+        publisher = get_publisher(params, item.config)
+        publisher.publish(outgoing_topic, outgoing_payload, qos=params['qos'],
+                          retain=bool(params['retain']))
     except Exception as exc:
         srv.log.warning("Cannot PUBlish via 'mqtt:%s': %s", item.target, exc)
         return False
 
     return True
+
+
+# Publishers (and their network threads) of the parent process are not usable after a fork
+os.register_at_fork(after_in_child=_publishers.clear)
@@ -4,36 +4,224 @@ __author__ = "Jan-Piet Mens <jpmens()gmail.com>"
 __copyright__ = "Copyright 2014 Jan-Piet Mens"
 __license__ = "Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"
 
+import threading
+import time
+from collections import deque
+
+import paho.mqtt.client as paho
 import six
 
+from mqttwarn.util import shutdown_event, shutdown_timeout, start_flusher
+
+# What to do with a message when the outbound buffer is full
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_new', 'block')
+
 
-def plugin(srv, item):
+class Plugin:
     """Publish via MQTT to the same broker connection.
 
     Requires topic, qos and retain flag to be specified in target address.
 
+    Messages are put into a buffer of up to ``max_buffered`` messages and
+    published by a background thread, as long as the broker connection is up
+    and less than ``inflight`` messages are waiting to be sent or
+    acknowledged. Messages buffered while the connection is down are
+    published after reconnecting. When the buffer is full, ``overflow``
+    decides whether the oldest buffered message is dropped (``drop_oldest``),
+    the new message is dropped (``drop_new``), or the new message waits up to
+    ``timeout`` seconds for space (``block``).
+
+    In worker processes (``num_processes``), messages are relayed to the main
+    process and published there without buffering.
+
     """
-    srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service, item.target)
 
-    outgoing_topic, qos, retain = item.addrs[:3]
+    def __init__(self, srv=None, config=None):
+        self.srv = srv
+        conf = (config or {}).get
+        self.max_buffered = int(conf('max_buffered', 10000))
+        self.inflight = int(conf('inflight', 20))
+        self.overflow = conf('overflow', 'drop_oldest')
+        self.timeout = conf('timeout', 10)
 
-    # Attempt to interpolate data into topic name.
-    # If it isn't possible ignore messsage, and return without publishing.
-    if item.data is not None:
-        try:
-            outgoing_topic = outgoing_topic.format(**item.data)
-        except:
-            srv.log.debug("Outgoing topic cannot be formatted; not published.")
-            return False
+        if self.overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Invalid overflow policy '%s' (must be one of %s)." %
+                             (self.overflow, ", ".join(OVERFLOW_POLICIES)))
+
+        self.buffer = deque()
+        # Messages handed to the client, which have not been published yet: (qos, info)
+        self.outstanding = deque()
+        self.lock = threading.Condition()
+        self.wakeup = threading.Event()
+        self.published = 0
+        self.dropped = 0
+        self.replayed = 0
+        # Whether messages were buffered while the connection was down
+        self.backlog = False
+        # Whether the connection was re-established since the last send
+        self.reconnected = False
+        self.sender = None
+
+        # Only the client owning the broker connection can report its state
+        if hasattr(srv.mqttc, 'is_connected'):
+            srv.add_connect_callback(self.on_connect)
+            srv.add_publish_callback(self.on_publish)
+            self.sender = start_flusher(self.run_sender, 'mqttpub-sender', self.wakeup)
+
+    def stats(self):
+        return {
+            'buffered': len(self.buffer),
+            'outstanding': len(self.outstanding),
+            'published': self.published,
+            'dropped': self.dropped,
+            'replayed': self.replayed,
+        }
+
+    def on_connect(self):
+        if self.buffer:
+            self.srv.log.info("Connected, publishing %i buffered messages.", len(self.buffer))
+
+        self.reconnected = True
+        self.wakeup.set()
+
+    def on_publish(self, mid):
+        # Called in the network thread of the client, so do not touch the lock here
+        self.wakeup.set()
+
+    def enqueue(self, message):
+        """Add message to the outbound buffer, return False if it was dropped."""
+        with self.lock:
+            if len(self.buffer) >= self.max_buffered:
+                if self.overflow == 'block':
+                    self.lock.wait_for(lambda: len(self.buffer) < self.max_buffered,
+                                       self.timeout)
+
+                if len(self.buffer) >= self.max_buffered:
+                    self.dropped += 1
+
+                    if self.dropped % 1000 == 1:
+                        self.srv.log.warning("Outbound buffer full, dropped %i messages so far.",
+                                             self.dropped)
+
+                    if self.overflow != 'drop_oldest':
+                        return False
+
+                    self.buffer.popleft()
+
+            self.buffer.append(message)
+
+            if not self.srv.mqttc.is_connected():
+                self.backlog = True
+
+        self.wakeup.set()
+        return True
+
+    def send(self):
+        """Publish buffered messages while the connection is up and the inflight window allows."""
+        while True:
+            with self.lock:
+                if self.reconnected:
+                    # The client discards unsent QoS 0 messages when reconnecting,
+                    # without ever reporting them as published
+                    self.reconnected = False
+                    lost = sum(1 for qos, info in self.outstanding
+                               if qos == 0 and not info.is_published())
+
+                    if lost:
+                        self.srv.log.warning("Lost %i unsent messages on reconnect.", lost)
 
-    outgoing_payload = item.message
-    if isinstance(outgoing_payload, six.string_types):
-        outgoing_payload = outgoing_payload.encode('utf-8')
+                    self.outstanding = deque((qos, info) for qos, info in self.outstanding
+                                             if qos > 0 and not info.is_published())
+
+                if any(info.is_published() for qos, info in self.outstanding):
+                    self.outstanding = deque((qos, info) for qos, info in self.outstanding
+                                             if not info.is_published())
+
+                if (not self.buffer or len(self.outstanding) >= self.inflight or
+                        not self.srv.mqttc.is_connected()):
+                    if not self.buffer:
+                        self.backlog = False
+
+                    return
+
+                message = self.buffer.popleft()
+                self.lock.notify()
+
+            topic, payload, qos, retain = message
+
+            try:
+                info = self.srv.mqttc.publish(topic, payload, qos=qos, retain=retain)
+            except Exception as exc:
+                self.srv.log.warning("Cannot PUBlish to '%s': %s", topic, exc)
+                continue
+
+            with self.lock:
+                if info.rc == paho.MQTT_ERR_NO_CONN and qos == 0:
+                    # Connection was lost in the meantime, retry after reconnecting
+                    self.buffer.appendleft(message)
+                    self.backlog = True
+                    return
+
+                if info.rc not in (paho.MQTT_ERR_SUCCESS, paho.MQTT_ERR_NO_CONN):
+                    self.srv.log.warning("Cannot PUBlish to '%s': %s", topic,
+                                         paho.error_string(info.rc))
+                    continue
+
+                self.outstanding.append((qos, info))
+                self.published += 1
+
+                if self.backlog:
+                    self.replayed += 1
+
+    def run_sender(self):
+        while not shutdown_event.is_set():
+            # Published messages are detected by polling, in case notifications are missed
+            self.wakeup.wait(1.0)
+            self.wakeup.clear()
+            self.send()
+
+        deadline = time.monotonic() + min(self.timeout, shutdown_timeout(self.timeout))
+
+        while self.buffer and self.srv.mqttc.is_connected() and time.monotonic() < deadline:
+            self.send()
+            self.wakeup.wait(0.1)
+            self.wakeup.clear()
+
+        if self.buffer:
+            self.srv.log.warning("Discarding %i buffered messages.", len(self.buffer))
+
+    def plugin(self, srv, item):
+        srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service,
+                      item.target)
+
+        outgoing_topic, qos, retain = item.addrs[:3]
+
+        # Attempt to interpolate data into topic name.
+        # If it isn't possible ignore messsage, and return without publishing.
+        if item.data is not None:
+            try:
+                outgoing_topic = outgoing_topic.format(**item.data)
+            except:
+                srv.log.debug("Outgoing topic cannot be formatted; not published.")
+                return False
+
+        outgoing_payload = item.message
+        if isinstance(outgoing_payload, six.string_types):
+            outgoing_payload = outgoing_payload.encode('utf-8')
+
+        if self.sender is None:
+            try:
+                srv.mqttc.publish(outgoing_topic, outgoing_payload, qos=qos, retain=retain)
+            except Exception as exc:
+                srv.log.warning("Cannot PUBlish via 'mqttpub:%s': %s", item.target, exc)
+                return False
+
+            return True
+
+        if not self.enqueue((outgoing_topic, outgoing_payload, qos, retain)):
+            srv.log.warning("Cannot PUBlish via 'mqttpub:%s': outbound buffer full", item.target)
+            return False
 
-    try:
-        srv.mqttc.publish(outgoing_topic, outgoing_payload, qos=qos, retain=retain)
-    except Exception as exc:
-        srv.log.warning("Cannot PUBlish via 'mqttpub:%s': %s", item.target, exc)
-        return False
+        return True
 
-    return True
+    __call__ = plugin
@@ -4,87 +4,139 @@ __author__ = "Jan-Piet Mens <jpmens()gmail.com>"
 __copyright__ = "Copyright 2014 Jan-Piet Mens"
 __license__ = "Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"
 
-import MySQLdb
-
-
-# https://mail.python.org/pipermail/tutor/2010-December/080701.html
-def add_row(cursor, tablename, rowdict):
-    # XXX tablename not sanitized
-    # XXX test for allowed keys is case-sensitive
-    unknown_keys = None
-
-    # filter out keys that are not column names
-    cursor.execute("describe %s" % tablename)
-    allowed_keys = set(row[0] for row in cursor.fetchall())
-    keys = allowed_keys.intersection(rowdict)
-
-    if len(rowdict) > len(keys):
-        unknown_keys = set(rowdict) - allowed_keys
-
-    columns = ", ".join(keys)
-    values_template = ", ".join(["%s"] * len(keys))
-
-    sql = "insert into %s (%s) values (%s)" % (
-        tablename, columns, values_template)
-    values = tuple(rowdict[key] for key in keys)
-    cursor.execute(sql, values)
-
-    return unknown_keys
-
+import time
 
-def plugin(srv, item):
-    srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service, item.target)
+import MySQLdb
 
-    conf = item.config.get
-    host = conf('host', 'localhost')
-    port = conf('port', 3306)
-    user = conf('user')
-    passwd = conf('pass')
-    dbname = conf('dbname')
+from mqttwarn.mysqlpool import BatchInserter, ConnectionPool
+
+# MySQL error code for "Unknown column"
+ER_BAD_FIELD_ERROR = 1054
+
+
+class Plugin:
+    def __init__(self, srv=None, config=None):
+        self.srv = srv
+        self.log = srv.log
+        conf = config.get
+        self.host = conf('host', 'localhost')
+        self.port = conf('port', 3306)
+        self.dbname = conf('dbname')
+        # Number of rows to insert at once per table (0: insert each row immediately)
+        self.batch_size = conf('batch_size', 0)
+        # Seconds after which the cached column names of a table are looked up again
+        self.column_cache_ttl = conf('column_cache_ttl', 300)
+        self.pool = ConnectionPool(maxconn=conf('maxconn', 4), host=self.host, port=self.port,
+                                   user=conf('user'), passwd=conf('pass'), db=self.dbname)
+        # Rows are buffered by table and turned into statements when they are written, so
+        # that they can be retried with fresh column names
+        self.inserter = BatchInserter(self.pool, self.batch_size, conf('flush_interval', 1.0),
+                                      on_error=self.handle_error, prepare=self.prepare_rows)
+        # Column names by table, with the time they were looked up
+        self.columns = {}
+
+    def close(self):
+        self.pool.closeall()
+
+    __del__ = close
+
+    def get_columns(self, tablename):
+        """Return set of column names of a table, cached for ``column_cache_ttl`` seconds."""
+        cached = self.columns.get(tablename)
+
+        if cached is not None and (self.column_cache_ttl is None or
+                                   time.monotonic() - cached[1] < self.column_cache_ttl):
+            return cached[0]
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
 
-    try:
-        table_name = item.addrs[0].format(**item.data).encode('utf-8')
-        fallback_col = item.addrs[1].format(**item.data).encode('utf-8')
-    except Exception as exc:
-        srv.log.warn("'mysql' service incorrectly configured: %s", exc)
-        return False
+            try:
+                # XXX tablename not sanitized
+                cursor.execute("describe %s" % tablename)
+                allowed_keys = set(row[0] for row in cursor.fetchall())
+            finally:
+                cursor.close()
+
+        self.columns[tablename] = (allowed_keys, time.monotonic())
+        return allowed_keys
+
+    def handle_error(self, exc):
+        """Return True if writing should be retried, since a table was changed."""
+        if isinstance(exc, MySQLdb.Error) and exc.args and exc.args[0] == ER_BAD_FIELD_ERROR:
+            # A table was changed since its columns were cached
+            self.columns.clear()
+            return True
 
-    try:
-        conn = MySQLdb.connect(host=host, port=port, user=user, passwd=passwd, db=dbname)
-        cursor = conn.cursor()
-    except Exception as exc:
-        srv.log.warn("Cannot connect to MySQL server: %s", exc)
         return False
 
-    text = item.message
-
-    # Create new dict for column data. First add fallback column
-    # with full payload. Then attempt to use formatted JSON values
-    col_data = {
-        fallback_col: text
-    }
+    def prepare_rows(self, tablename, rows):
+        """Return (SQL statement, values) tuples inserting row dicts into a table."""
+        allowed_keys = self.get_columns(tablename)
+        statements = []
+
+        for rowdict in rows:
+            keys = sorted(allowed_keys.intersection(rowdict))
+            sql = "insert into %s (%s) values (%s)" % (tablename, ", ".join(keys),
+                                                       ", ".join(["%s"] * len(keys)))
+            statements.append((sql, tuple(rowdict[key] for key in keys)))
+
+        # Rows with the same columns are inserted with one executemany()
+        statements.sort(key=lambda statement: statement[0])
+        return statements
+
+    # https://mail.python.org/pipermail/tutor/2010-December/080701.html
+    def add_row(self, tablename, rowdict):
+        # XXX test for allowed keys is case-sensitive
+        unknown_keys = None
+
+        # filter out keys that are not column names
+        allowed_keys = self.get_columns(tablename)
+
+        if not allowed_keys.issuperset(rowdict):
+            unknown_keys = set(rowdict) - allowed_keys
+
+        return self.inserter.insert(tablename, rowdict), unknown_keys
+
+    def plugin(self, srv, item):
+        srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service,
+                      item.target)
+
+        try:
+            table_name = item.addrs[0].format(**item.data)
+            fallback_col = item.addrs[1].format(**item.data)
+        except Exception as exc:
+            srv.log.warn("'mysql' service incorrectly configured: %s", exc)
+            return False
+
+        text = item.message
+
+        # Create new dict for column data. First add fallback column
+        # with full payload. Then attempt to use formatted JSON values
+        col_data = {
+            fallback_col: text
+        }
+
+        if fallback_col == 'NOP':
+            del col_data[fallback_col]
+
+        if item.data is not None:
+            for key in item.data.keys():
+                try:
+                    col_data[key] = item.data[key].format(**item.data).encode('utf-8')
+                except Exception:
+                    col_data[key] = item.data[key]
+
+        try:
+            result, unknown_keys = self.add_row(table_name, col_data)
+        except Exception as exc:
+            srv.log.warn("Cannot add mysql row: %s", exc)
+            return False
 
-    if fallback_col == 'NOP':
-        del(col_data['fallback_col'])
-
-    if item.data is not None:
-        for key in item.data.keys():
-            try:
-                col_data[key] = item.data[key].format(**item.data).encode('utf-8')
-            except Exception:
-                col_data[key] = item.data[key]
-
-    try:
-        unknown_keys = add_row(cursor, table_name, col_data)
         if unknown_keys is not None:
             srv.log.debug("Skipping unused keys %s" % ",".join(unknown_keys))
 
-        conn.commit()
-    except Exception as exc:
-        srv.log.warn("Cannot add mysql row: %s", exc)
-        return False
-    finally:
-        cursor.close()
-        conn.close()
+        # Errors were logged by the inserter
+        return result
 
-    return True
+    __call__ = plugin
@@ -21,6 +21,12 @@ same way. Here's an example service configuration section in ``mqttwarn.ini``:
     minconn = 0
     ; maximum number of concurrent database pool connections
     maxconn = 4
+    ; number of rows to insert at once per table (default: 0, insert immediately)
+    batch_size = 0
+    ; max. seconds to buffer rows before inserting them (default: 1.0)
+    flush_interval = 1.0
+    ; seconds to cache the column names of a table (default: 300)
+    column_cache_ttl = 300
     targets = {
             'table1': ['public.person', 'message']
         }
@@ -88,6 +94,19 @@ to the _fallback column_:
 You can add columns with the names of the built-in transformation data (e.g.
 ``_dthhmmss``) to have those values stored automatically.
 
+The column names of each table are looked up once and cached for
+``column_cache_ttl`` seconds (set it to ``None`` to cache them until the table
+is changed). When an insert fails because a cached column no longer exists, the
+column names are looked up again and the insert is retried.
+
+With ``batch_size`` set to a number greater than zero, rows are not inserted
+immediately, but buffered per table and inserted with one multi-row ``INSERT``
+statement per set of columns when ``batch_size`` rows are buffered or after
+``flush_interval`` seconds, whichever comes first. Since the plugin then does
+not wait for the rows to be inserted, errors are only logged. Rows still
+buffered when _mqttwarn_ exits are inserted before the process ends, as far as
+``drain_timeout`` allows.
+
 """
 
 __author__ = """\
@@ -100,13 +119,19 @@ __license__ = "Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-
 
 
 import json
+import threading
+import time
 from contextlib import contextmanager
 from threading import BoundedSemaphore
 
 # http://initd.org/psycopg/
 import psycopg2
+from psycopg2 import errorcodes
+from psycopg2.extras import execute_values
 from psycopg2.pool import ThreadedConnectionPool
 
+from mqttwarn.util import shutdown_event, start_flusher
+
 META_KEYS = set([
     '_dt',
     '_dtepoch',
@@ -154,6 +179,13 @@ class Plugin:
         self.database = conf("database")
         self.minconn = conf("minconn", 0)
         self.maxconn = conf("maxconn", 4)
+        # Number of rows to buffer per table before inserting them at once
+        # (0: insert each row immediately)
+        self.batch_size = conf("batch_size", 0)
+        # Max. seconds rows are buffered before they are inserted
+        self.flush_interval = conf("flush_interval", 1.0)
+        # Seconds after which the cached column names of a table are looked up again
+        self.column_cache_ttl = conf("column_cache_ttl", 300)
         self.db = BlockingThreadedConnectionPool(
             minconn=self.minconn,
             maxconn=self.maxconn,
@@ -163,6 +195,15 @@ class Plugin:
             user=self.user,
             password=self.password
         )
+        # Column names by (schema, table), with the time they were looked up
+        self.columns = {}
+        # Buffered rows by (schema, table)
+        self.buffers = {}
+        self.lock = threading.Lock()
+        self.flusher = None
+
+        if self.batch_size > 0:
+            self.flusher = start_flusher(self.run_flusher, 'postgres-flusher')
 
     def close(self):
         self.db.closeall()
@@ -177,8 +218,15 @@ class Plugin:
         finally:
             self.db.putconn(con)
 
-    def add_row(self, cursor, schema, tablename, rowdata, message, fallback_col):
-        # filter out keys that are not column names
+    def get_columns(self, cursor, schema, tablename):
+        """Return set of (lower-case) column names of a table, cached for ``column_cache_ttl``."""
+        key = (schema, tablename)
+        cached = self.columns.get(key)
+
+        if cached is not None and (self.column_cache_ttl is None or
+                                   time.monotonic() - cached[1] < self.column_cache_ttl):
+            return cached[0]
+
         cursor.execute(
             """
             SELECT column_name
@@ -191,11 +239,17 @@ class Plugin:
 
         if not allowed_keys:
             raise ConfigurationError("No columns found in table '%s.%s': unable to proceed." %
-                                     (schema, table_name))
+                                     (schema, tablename))
+
+        self.columns[key] = (allowed_keys, time.monotonic())
+        return allowed_keys
 
+    def prepare_row(self, allowed_keys, schema, tablename, rowdata, message, fallback_col):
+        """Return column names, values and keys without a column for a row to be inserted."""
         # We want neither the global transformation data (META_KEYS) in the
         # fallback column nor the data for keys, which match columns present
         # in the table.
+        rowdata = dict(rowdata)
         data_keys = set(key.lower() for key in rowdata)
         payload_keys = data_keys.difference(META_KEYS)
         usable_keys = allowed_keys.intersection(data_keys)
@@ -215,16 +269,141 @@ class Plugin:
                               fallback_col, schema, tablename)
             unknown_keys.add(fallback_col)
 
-        columns = ", ".join('"%s"' % name for name in usable_keys)
-        values_template = ", ".join(["%s"] * len(usable_keys))
+        columns = tuple(sorted(usable_keys))
+        return columns, tuple(rowdata[key] for key in columns), unknown_keys
 
-        sql = 'INSERT INTO %s.%s (%s) values (%s);' % (schema, tablename, columns, values_template)
-        values = tuple(rowdata[key] for key in usable_keys)
+    def add_row(self, cursor, schema, tablename, rowdata, message, fallback_col):
+        # filter out keys that are not column names
+        allowed_keys = self.get_columns(cursor, schema, tablename)
+        columns, values, unknown_keys = self.prepare_row(allowed_keys, schema, tablename,
+                                                         rowdata, message, fallback_col)
+        sql = 'INSERT INTO %s.%s (%s) values (%s);' % (
+            schema, tablename, ", ".join('"%s"' % name for name in columns),
+            ", ".join(["%s"] * len(columns)))
 
         self.srv.log.debug("Query: %s values: %r unknown keys: %r", sql, values, unknown_keys)
         cursor.execute(sql, values)
         return unknown_keys
 
+    def add_rows(self, cursor, schema, tablename, rows, log_unknown=True):
+        """Insert buffered rows with one multi-row INSERT statement per set of columns."""
+        allowed_keys = self.get_columns(cursor, schema, tablename)
+        values_by_columns = {}
+
+        for rowdata, message, fallback_col in rows:
+            columns, values, unknown_keys = self.prepare_row(allowed_keys, schema, tablename,
+                                                             rowdata, message, fallback_col)
+            values_by_columns.setdefault(columns, []).append(values)
+
+            if unknown_keys and log_unknown:
+                self.log_unknown_keys(unknown_keys, schema, tablename, rowdata, fallback_col)
+
+        for columns, values in values_by_columns.items():
+            sql = 'INSERT INTO %s.%s (%s) values %%s;' % (
+                schema, tablename, ", ".join('"%s"' % name for name in columns))
+            self.srv.log.debug("Query: %s (%i rows)", sql, len(values))
+            execute_values(cursor, sql, values, page_size=len(values))
+
+    def write_rows(self, schema, tablename, rows):
+        """Insert rows, retrying once with fresh column names if the table was changed.
+
+        If the rows cannot be inserted together for another reason (e.g. a
+        constraint violation), they are inserted one at a time, so that only
+        the offending rows are lost.
+
+        """
+        for attempt in (1, 2):
+            try:
+                with self.get_connection() as conn:
+                    try:
+                        with conn.cursor() as cursor:
+                            self.add_rows(cursor, schema, tablename, rows)
+
+                        conn.commit()
+                        return True
+                    except psycopg2.Error as exc:
+                        conn.rollback()
+
+                        if attempt == 1 and exc.pgcode == errorcodes.UNDEFINED_COLUMN:
+                            self.log.debug("Columns of table '%s.%s' changed: %s", schema,
+                                           tablename, exc)
+                            self.columns.pop((schema, tablename), None)
+                            continue
+
+                        if len(rows) == 1:
+                            raise
+
+                        self.log.debug("Could not add %i postgres rows to table '%s.%s' at once, "
+                                       "adding them one at a time: %s", len(rows), schema,
+                                       tablename, exc)
+                        return self.write_rows_singly(conn, schema, tablename, rows)
+            except Exception as exc:
+                self.log.error("Could not add %i postgres rows to table '%s.%s': %s", len(rows),
+                               schema, tablename, exc)
+                return False
+
+    def write_rows_singly(self, conn, schema, tablename, rows):
+        """Insert rows in a transaction each, return False if any of them failed."""
+        failed = 0
+
+        for row in rows:
+            try:
+                with conn.cursor() as cursor:
+                    self.add_rows(cursor, schema, tablename, [row], log_unknown=False)
+
+                conn.commit()
+            except psycopg2.Error as exc:
+                conn.rollback()
+                failed += 1
+                error = exc
+
+        if failed:
+            self.log.error("Could not add %i of %i postgres rows to table '%s.%s': %s", failed,
+                           len(rows), schema, tablename, error)
+
+        return not failed
+
+    def buffer_row(self, schema, tablename, rowdata, message, fallback_col):
+        """Buffer row for inserting it together with others into the same table."""
+        with self.lock:
+            rows = self.buffers.setdefault((schema, tablename), [])
+            rows.append((rowdata, message, fallback_col))
+
+            if len(rows) < self.batch_size:
+                return
+
+            del self.buffers[(schema, tablename)]
+
+        self.write_rows(schema, tablename, rows)
+
+    def flush(self):
+        """Insert all buffered rows."""
+        with self.lock:
+            buffers = self.buffers
+            self.buffers = {}
+
+        for (schema, tablename), rows in buffers.items():
+            self.write_rows(schema, tablename, rows)
+
+    def run_flusher(self):
+        while not shutdown_event.wait(self.flush_interval):
+            self.flush()
+
+        self.flush()
+
+    def log_unknown_keys(self, unknown_keys, schema, tablename, rowdata, fallback_col):
+        if fallback_col in unknown_keys:
+            self.log.error("Fallback column '%s' not found in table '%s.%s'. "
+                           "*Dropped* values of the following data keys: %s",
+                           fallback_col, schema, tablename, ", ".join(unknown_keys))
+        elif fallback_col in rowdata:
+            self.log.error("Data for fallback column '%s' already present in payload. "
+                           "*Dropped* values of the following data keys: %s",
+                           fallback_col, ", ".join(unknown_keys))
+        else:
+            self.log.warn("Data for keys '%s' written to fallback column '%s'.",
+                          ", ".join(unknown_keys), fallback_col)
+
     def plugin(self, srv, item):
         srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service, item.target)
 
@@ -251,12 +430,29 @@ class Plugin:
                 except Exception:
                     pass
 
+        if self.batch_size > 0:
+            # Inserted by a flush, errors are logged there
+            self.buffer_row(schema, table_name, item.data, item.message, fallback_col)
+            return True
+
         try:
             with self.get_connection() as conn:
                 try:
                     cursor = conn.cursor()
-                    unknown_keys = self.add_row(cursor, schema, table_name, item.data,
-                                                item.message, fallback_col)
+
+                    try:
+                        unknown_keys = self.add_row(cursor, schema, table_name, item.data,
+                                                    item.message, fallback_col)
+                    except psycopg2.Error as exc:
+                        if exc.pgcode != errorcodes.UNDEFINED_COLUMN:
+                            raise
+
+                        # Table was changed since its columns were cached
+                        conn.rollback()
+                        self.columns.pop((schema, table_name), None)
+                        unknown_keys = self.add_row(cursor, schema, table_name, item.data,
+                                                    item.message, fallback_col)
+
                     conn.commit()
                 except Exception as exc:
                     self.log.error("Could not add postgres row: %s", exc)
@@ -269,17 +465,7 @@ class Plugin:
             return False
 
         if unknown_keys:
-            if fallback_col in unknown_keys:
-                self.log.error("Fallback column '%s' not found in table '%s.%s'. "
-                               "*Dropped* values of the following data keys: %s",
-                               fallback_col, schema, table_name, ", ".join(unknown_keys))
-            elif fallback_col in item.data:
-                self.log.error("Data for fallback column '%s' already present in payload. "
-                               "*Dropped* values of the following data keys: %s",
-                               fallback_col, ", ".join(unknown_keys))
-            else:
-                self.log.warn("Data for keys '%s' written to fallback column '%s'.",
-                              ", ".join(unknown_keys), fallback_col)
+            self.log_unknown_keys(unknown_keys, schema, table_name, item.data, fallback_col)
 
         return True
 
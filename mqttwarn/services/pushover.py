@@ -16,16 +16,17 @@ __license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/
 #              of the json payload.
 
 import base64
-import requests
-import urlparse
 import json
 import os
 
+import requests
+from six.moves.urllib.parse import urljoin
+
 PUSHOVER_API = "https://api.pushover.net/1/"
 
 class PushoverError(Exception): pass
 
-def pushover(image, **kwargs):
+def pushover(image, session=requests, **kwargs):
     assert 'message' in kwargs
 
     if not 'token' in kwargs:
@@ -33,17 +34,17 @@ def pushover(image, **kwargs):
     if not 'user' in kwargs:
         kwargs['user'] = os.environ['PUSHOVER_USER']
 
-    url = urlparse.urljoin(PUSHOVER_API, "messages.json")
+    url = urljoin(PUSHOVER_API, "messages.json")
     headers = { 'User-Agent': 'mqttwarn' }
 
     if image:
         attachment = { "attachment": ( "image.jpg", image, "image/jpeg" )}
-        r = requests.post(url, data=kwargs, files=attachment, headers=headers)
+        r = session.post(url, data=kwargs, files=attachment, headers=headers)
     else:
-        r = requests.post(url, data=kwargs, headers=headers)
+        r = session.post(url, data=kwargs, headers=headers)
 
     if r.json()['status'] != 1:
-        raise PushoverError(output)
+        raise PushoverError(r.text)
 
 def plugin(srv, item):
 
@@ -97,15 +98,15 @@ def plugin(srv, item):
     if 'imageurl' in item.data:
         imageurl = item.data['imageurl']
         srv.log.debug("Image url detected - %s" % imageurl)
-        image = requests.get(imageurl, stream=True).raw
+        image = srv.http.get(imageurl, stream=True).raw
     elif 'imagebase64' in item.data:
         imagebase64 = item.data['imagebase64']
         srv.log.debug("Image (base64 encoded) detected")
-        image = base64.decodestring(imagebase64)
+        image = base64.b64decode(imagebase64)
 
     try:
         srv.log.debug("Sending pushover notification to %s [%s]...." % (item.target, params))
-        pushover(image=image, user=userkey, token=appkey, **params)
+        pushover(image=image, session=srv.http, user=userkey, token=appkey, **params)
         srv.log.debug("Successfully sent pushover notification")
     except Exception as exc:
         srv.log.warn("Error sending pushover notification: %s", exc)
@@ -5,17 +5,29 @@ __copyright__ = "Copyright 2014 Jan-Piet Mens, 2019 Christopher Arndt"
 __license__ = "Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"
 
 
+import threading
+from collections import defaultdict
+
 import redis
 
+from mqttwarn.util import shutdown_event, start_flusher
+
 
-def plugin(srv, item):
+class Plugin:
     """mqttwarn ``redispub`` service plugin.
 
     Forwards the MQTT message payload (possibly formatted) to a Redis
-    subscripition channel.
+    subscripition channel or, if the second target address item is
+    ``stream``, appends it to a Redis stream with ``XADD``. Streams are
+    trimmed to about ``maxlen`` entries, if set.
 
-    Expects the service target addresses to contain the Redis channel name as
-    the first and only item.
+    Expects the service target addresses to contain the Redis channel (or
+    stream) name as the first item.
+
+    Connections are taken from one connection pool per (host, port, db).
+    With ``batch_size`` greater than zero, commands are buffered and sent in
+    pipelines of up to ``batch_size`` commands, at the latest every
+    ``flush_interval`` seconds.
 
     Example configuration:
 
@@ -26,7 +38,8 @@ def plugin(srv, item):
         db = 0
         password =
         targets = {
-                'my-channel': ['my-channel']
+                'my-channel': ['my-channel'],
+                'my-stream': ['my-stream', 'stream'],
             }
 
         [redis/my-channel]
@@ -34,38 +47,127 @@ def plugin(srv, item):
         format = Message received via MQTT at {_ltiso}: {payload}
 
     """
-    srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service, item.target)
-
-    if not item.addrs or not item.addrs[0]:
-        srv.log.error("Invalid configuration for service target '%s:%s': "
-                      "Redis channel may not be null.")
-        return False
-
-    channel = item.addrs[0]
-    conf = item.config.get
-    host = conf('host', 'localhost')
-    password = conf('password')
-
-    try:
-        port = int(conf('port'))
-    except (TypeError, ValueError):
-        port = 6379
-
-    try:
-        db = int(conf('db'))
-    except (TypeError, ValueError):
-        db = 0
 
-    try:
-        rp = redis.Redis(host=host, port=port, db=db or 0, password=password or None)
-        # The redis client creates the connection on demand. There's no need to
-        # put the creation of the Redis instance in a separate try/except block
-        rp.publish(channel, item.message)
-    except Exception as exc:
-        srv.log.warn("Could not publish to Redis channel '%s' on %s:%s db=%i: %s",
-                     channel, host, port, db, exc)
-        return False
-    else:
-        srv.log.debug("Sucessfully published message on Redis channel '%s'.", channel)
-
-    return True
+    def __init__(self, srv=None, config=None):
+        self.srv = srv
+        conf = (config or {}).get
+        self.host = conf('host', 'localhost')
+        self.password = conf('password')
+
+        try:
+            self.port = int(conf('port'))
+        except (TypeError, ValueError):
+            self.port = 6379
+
+        try:
+            self.db = int(conf('db'))
+        except (TypeError, ValueError):
+            self.db = 0
+
+        self.maxlen = conf('maxlen')
+        self.batch_size = conf('batch_size', 0)
+        self.flush_interval = conf('flush_interval', 1.0)
+        # Connection pools by (host, port, db)
+        self.pools = {}
+        self.buffer = defaultdict(list)
+        self.lock = threading.Lock()
+        # Serializes flushes, so that buffered commands are sent in order
+        self.write_lock = threading.Lock()
+        self.flusher = None
+
+        if self.batch_size > 0:
+            self.flusher = start_flusher(self.run_flusher, 'redispub-flusher')
+
+    def get_client(self, host, port, db):
+        key = (host, port, db)
+
+        with self.lock:
+            pool = self.pools.get(key)
+
+            if pool is None:
+                pool = self.pools[key] = redis.ConnectionPool(
+                    host=host, port=port, db=db, password=self.password or None)
+
+        return redis.Redis(connection_pool=pool)
+
+    def send(self, client, command, name, value):
+        if command == 'xadd':
+            client.xadd(name, value, maxlen=self.maxlen, approximate=True)
+        else:
+            client.publish(name, value)
+
+    def flush(self):
+        """Send buffered commands in pipelines of up to ``batch_size`` commands."""
+        with self.write_lock:
+            with self.lock:
+                buffered = self.buffer
+                self.buffer = defaultdict(list)
+
+            for key, commands in buffered.items():
+                sent = 0
+
+                try:
+                    pipe = self.get_client(*key).pipeline(transaction=False)
+
+                    for i in range(0, len(commands), self.batch_size):
+                        for command in commands[i:i + self.batch_size]:
+                            self.send(pipe, *command)
+
+                        pipe.execute()
+                        sent = min(i + self.batch_size, len(commands))
+                except Exception as exc:
+                    # Pipelines, which were executed before, are not affected
+                    self.srv.log.warn("Could not send %i of %i buffered commands to Redis on "
+                                      "%s:%s db=%i, discarding them: %s", len(commands) - sent,
+                                      len(commands), key[0], key[1], key[2], exc)
+
+    def run_flusher(self):
+        while not shutdown_event.wait(self.flush_interval):
+            self.flush()
+
+        self.flush()
+
+    def plugin(self, srv, item):
+        srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service,
+                      item.target)
+
+        if not item.addrs or not item.addrs[0]:
+            srv.log.error("Invalid configuration for service target '%s:%s': "
+                          "Redis channel may not be null.", item.service, item.target)
+            return False
+
+        channel = item.addrs[0]
+        stream = len(item.addrs) > 1 and item.addrs[1] == 'stream'
+
+        if stream:
+            command = ('xadd', channel, {'topic': item.topic, 'message': item.message})
+        else:
+            command = ('publish', channel, item.message)
+
+        key = (self.host, self.port, self.db)
+
+        if self.batch_size > 0:
+            # Sent by the flusher thread, errors are logged there
+            with self.lock:
+                self.buffer[key].append(command)
+                full = len(self.buffer[key]) >= self.batch_size
+
+            if full:
+                self.flush()
+
+            return True
+
+        try:
+            self.send(self.get_client(*key), *command)
+        except Exception as exc:
+            srv.log.warn("Could not publish to Redis %s '%s' on %s:%s db=%i: %s",
+                         'stream' if stream else 'channel', channel, self.host, self.port,
+                         self.db, exc)
+            return False
+        else:
+            srv.log.debug("Sucessfully published message on Redis %s '%s'.",
+                          'stream' if stream else 'channel', channel)
+
+        return True
+
+    __call__ = plugin
@@ -1,34 +1,205 @@
 # -*- coding: utf-8 -*-
 
 import re
+import threading
+import time
+from collections import OrderedDict
+
 import rrdtool
 
+from mqttwarn.util import shutdown_event, start_flusher
+
 
 __author__ = "devsaurus <devsaurus@users.noreply.github.com>"
 __copyright__ = "Copyright 2015"
 __license__  = "Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"
 
+# Update values, e.g. "N:42", "1433496000:21.5:U" or "1433496000@21.5"
+VALUE_RE = re.compile(r'^(N|\d+(\.\d*)?)[:@]')
+
+# Options of "rrdtool update" taking an argument
+OPTIONS_WITH_ARG = ('-t', '--template', '-d', '--daemon')
 
-def plugin(srv, item):
-    srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service, item.target)
 
-    # If the incoming payload has been transformed, use that,
-    # else the original payload
-    text = item.message
+def split_args(args):
+    """Split ``rrdtool update`` arguments into (file name and options, update values)."""
+    options = []
+    values = []
+    args = iter(args)
 
-    try:
-        # addrs is a list[] associated with a particular target.
-        # it can contain an arbitrary amount of entries that are just
-        # passed along to rrdtool
-        # mofified by otfdr @ github to accept abitray arguments with
-        # the payload and to not always add the 'N' in front
-        # 2017-06-05 - fix/enhancement for https://github.com/jpmens/mqttwarn/issues/248
-        if re.match(r"^\d+$", text):
-            rrdtool.update(item.addrs, "N:" + text)
+    for arg in args:
+        if arg in OPTIONS_WITH_ARG:
+            options.extend((arg, next(args, '')))
+        elif VALUE_RE.match(arg):
+            values.append(arg)
         else:
-            rrdtool.update(item.addrs + text.split())
-    except Exception as exc:
-        srv.log.warning("Cannot call rrdtool: %s", exc)
-        return False
+            options.append(arg)
+
+    return tuple(options), values
+
+
+def count_written(values, last):
+    """Return the number of leading ``values`` written by an update, which failed after them.
+
+    rrdtool stops at the first value it rejects. The values before it have
+    strictly increasing times, the last of them being ``last``, the time of
+    the last update of the file (in whole seconds).
+
+    """
+    written = 0
+    previous = None
+
+    for index, value in enumerate(values):
+        try:
+            timestamp = float(VALUE_RE.match(value).group(1))
+        except ValueError:
+            break
+
+        if int(timestamp) > last or (previous is not None and timestamp <= previous):
+            break
+
+        previous = timestamp
+
+        if int(timestamp) == last:
+            written = index + 1
+
+    return written
+
+
+class Plugin:
+    """rrdtool service plugin.
+
+    With ``flush_interval`` greater than zero, update values are buffered per
+    RRD file (and options) and written with one ``rrdtool update`` call per
+    file every ``flush_interval`` seconds. If rrdtool rejects such a call
+    (e.g. because of a value older than the last update of the file), the
+    values are written one at a time, so that only the offending ones are
+    lost, just like without buffering. With ``daemon`` set, updates are
+    passed to ``rrdcached`` at this address.
+
+    """
+
+    def __init__(self, srv=None, config=None):
+        self.srv = srv
+        conf = (config or {}).get
+        self.flush_interval = conf('flush_interval', 0)
+        self.daemon = conf('daemon')
+        self.buffer = OrderedDict()
+        self.lock = threading.Lock()
+        self.flusher = None
+
+        if self.flush_interval > 0:
+            self.flusher = start_flusher(self.run_flusher, 'rrdtool-flusher')
+
+    def update(self, args):
+        if self.daemon:
+            args = ['--daemon', self.daemon] + args
+
+        rrdtool.update(args)
+
+    def last_update(self, options):
+        """Return the time of the last update of the RRD file in ``options``, None on errors."""
+        args = ['--daemon', self.daemon] if self.daemon else []
+        options = iter(options)
+
+        for arg in options:
+            if arg in ('-d', '--daemon'):
+                args.extend((arg, next(options, '')))
+            elif arg in OPTIONS_WITH_ARG:
+                next(options, None)
+            elif not arg.startswith('-'):
+                args.append(arg)
+
+        try:
+            return rrdtool.last(args)
+        except Exception as exc:
+            self.srv.log.debug("Cannot get time of last update for %s: %s", " ".join(args), exc)
+            return None
+
+    def buffer_update(self, args):
+        options, values = split_args(args)
+
+        if not values:
+            raise ValueError("no update values in %r" % (args,))
+
+        # "N" must be the time of the message, not the time of the flush. Like "N",
+        # with sub-second resolution, so that updates within a second are all kept.
+        now = '%.6f' % time.time()
+        values = [now + value[1:] if value.startswith('N') else value for value in values]
+
+        with self.lock:
+            self.buffer.setdefault(options, []).extend(values)
+
+    def flush(self):
+        """Write buffered values with one update per RRD file."""
+        with self.lock:
+            buffered = self.buffer
+            self.buffer = OrderedDict()
+
+        for options, values in buffered.items():
+            try:
+                self.update(list(options) + values)
+                continue
+            except Exception as exc:
+                if len(values) == 1:
+                    self.srv.log.warning("Cannot call rrdtool: %s", exc)
+                    continue
+
+                self.srv.log.debug("Cannot call rrdtool with %i buffered values for %s, "
+                                   "writing them one at a time: %s",
+                                   len(values), " ".join(options), exc)
+
+            # Values before the rejected one have been written already
+            last = self.last_update(options)
+            written = 0 if last is None else count_written(values, last)
+            rejected = 0
+
+            for value in values[written:]:
+                try:
+                    self.update(list(options) + [value])
+                except Exception as exc:
+                    rejected += 1
+                    error = exc
+
+            if rejected:
+                self.srv.log.warning("rrdtool rejected %i of %i buffered values for %s: %s",
+                                     rejected, len(values), " ".join(options), error)
+
+    def run_flusher(self):
+        while not shutdown_event.wait(self.flush_interval):
+            self.flush()
+
+        self.flush()
+
+    def plugin(self, srv, item):
+        srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service,
+                      item.target)
+
+        # If the incoming payload has been transformed, use that,
+        # else the original payload
+        text = item.message
+
+        try:
+            # addrs is a list[] associated with a particular target.
+            # it can contain an arbitrary amount of entries that are just
+            # passed along to rrdtool
+            # mofified by otfdr @ github to accept abitray arguments with
+            # the payload and to not always add the 'N' in front
+            # 2017-06-05 - fix/enhancement for https://github.com/jpmens/mqttwarn/issues/248
+            if re.match(r"^\d+$", text):
+                args = item.addrs + ["N:" + text]
+            else:
+                args = item.addrs + text.split()
+
+            if self.flusher is not None:
+                # Written by the flusher thread, errors are logged there
+                self.buffer_update(args)
+            else:
+                self.update(args)
+        except Exception as exc:
+            srv.log.warning("Cannot call rrdtool: %s", exc)
+            return False
+
+        return True
 
-    return True
+    __call__ = plugin
@@ -51,7 +51,7 @@ def plugin(srv, item):
     text = item.message
 
     try:
-        slack = Slacker(token)
+        slack = Slacker(token, session=srv.http)
         slack.chat.post_message(channel, text, as_user=as_user, username=username, icon_emoji=icon)
     except Exception as exc:
         srv.log.error("Cannot post to slack %s: %s", channel, exc)
@@ -6,6 +6,7 @@ __license__ = "Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-
 
 try:
     import sqlite3
+    from mqttwarn.sqlitewriter import get_writer
 except ImportError:
     sqlite3 = None
 
@@ -17,6 +18,10 @@ def plugin(srv, item):
 
     Expects addrs to contain (path, tablename).
 
+    Rows are written in batches by a writer thread shared by all targets using the same
+    database file. The service options ``synchronous`` (SQLite's ``PRAGMA synchronous``,
+    default: ``NORMAL``) and ``batch_size`` (default: 500) configure the writer.
+
     """
     srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service, item.target)
 
@@ -28,25 +33,12 @@ def plugin(srv, item):
     table = item.addrs[1]
 
     try:
-        conn = sqlite3.connect(path)
-    except sqlite3.Error as exc:
+        writer = get_writer(path, item.config)
+    except (sqlite3.Error, ValueError) as exc:
         srv.log.warn("Cannot connect to sqlite at '%s': %s", path, exc)
         return False
 
-    try:
-        with conn:
-            conn.execute('CREATE TABLE IF NOT EXISTS "%s" (payload TEXT)' % table)
-    except sqlite3.Error as exc:
-        srv.log.warn("Cannot create sqlite table '%s' in '%s': %s", table, path, exc)
-        conn.close()
-        return False
-
-    try:
-        with conn:
-            conn.execute('INSERT INTO "%s" VALUES (?)' % table, (item.message,))
-    except sqlite3.Error as exc:
-        srv.log.warn("Cannot INSERT INTO sqlite table '%s': %s", table, exc)
-    finally:
-        conn.close()
-
+    # Written asynchronously in batches, errors are logged by the writer
+    writer.insert(['CREATE TABLE IF NOT EXISTS "%s" (payload TEXT)' % table],
+                  'INSERT INTO "%s" VALUES (?)' % table, (item.message,))
     return True
@@ -6,26 +6,121 @@ __license__ = "Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-
 
 # Based on the great SQLITE code by Jan-Piet Mens
 
+import os
+import threading
 import unicodedata
 
 import six
 
 try:
     import sqlite3
+    from mqttwarn.sqlitewriter import get_writer
 except ImportError:
     sqlite3 = None
 
 
+# Column catalogs of the tables written to, by (database path, table name)
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
 def normalize_unicode(s, encoding='ascii'):
     return unicodedata.normalize('NFKD', s).strip().encode(encoding, 'ignore').decode(encoding)
 
 
+class TableCatalog(object):
+    """Known columns of a table and the statements needed to create them.
+
+    The catalog is initialized from the database once and then kept up to
+    date in memory. Like in SQLite, column names are case-insensitive. Each
+    (lower-case) column name maps to the ``ALTER TABLE ... ADD COLUMN``
+    statement which creates it, or to None, if it already existed in the
+    database or is created by ``CREATE TABLE``. An INSERT into a set of columns must be preceded by the schema
+    statements of these columns (and ``CREATE TABLE``, if the table did not
+    exist), which the SQLite writer executes only once. Since another
+    process may have added a column in the meantime, the writer ignores
+    ``ADD COLUMN`` statements for columns, which already exist.
+
+    """
+
+    def __init__(self, path, table):
+        self.table = table
+        self.columns = {}
+        self.create = None
+        # INSERT statement and its schema statements by (sorted) column names
+        self.inserts = {}
+        self.lock = threading.Lock()
+
+        conn = sqlite3.connect(path)
+
+        try:
+            for row in conn.execute('PRAGMA table_info("%s")' % table):
+                self.columns[row[1].lower()] = None
+        finally:
+            conn.close()
+
+    def get_insert(self, col_types):
+        """Return INSERT statement and schema statements for given column name/type mapping."""
+        key = tuple(sorted(col_types))
+
+        try:
+            return self.inserts[key]
+        except KeyError:
+            pass
+
+        with self.lock:
+            if not self.columns and self.create is None:
+                self.create = 'CREATE TABLE IF NOT EXISTS "%s" (%s);' % (
+                    self.table, ", ".join('"%s" %s' % (name, col_types[name]) for name in key))
+
+                # Created along with the table
+                for name in key:
+                    self.columns[name.lower()] = None
+
+            for name in key:
+                if name.lower() not in self.columns:
+                    self.columns[name.lower()] = 'ALTER TABLE "%s" ADD COLUMN "%s" %s;' % (
+                        self.table, name, col_types[name])
+
+            schema = []
+
+            if self.create is not None:
+                schema.append(self.create)
+
+            for name in key:
+                if self.columns[name.lower()] is not None:
+                    schema.append(self.columns[name.lower()])
+
+            query = 'INSERT INTO "%s" (%s) VALUES (%s);' % (
+                self.table, ", ".join('"%s"' % name for name in key), ", ".join(["?"] * len(key)))
+            self.inserts[key] = (query, schema)
+
+        return query, schema
+
+
+def get_catalog(path, table):
+    key = (os.path.abspath(path), table)
+
+    with _catalogs_lock:
+        catalog = _catalogs.get(key)
+
+        if catalog is None:
+            catalog = _catalogs[key] = TableCatalog(path, table)
+
+    return catalog
+
+
 def plugin(srv, item):
     """sqlite_json2cols service plugin.
 
     Expects addrs to contain (path, tablename) and payload to be a JSON dict with string
     or numeric values.
 
+    The table is created with a column for each key of the first payload. Columns for keys
+    not seen before are added to the table when they first occur.
+
+    See the ``sqlite`` service plugin for the options of the shared writer.
+
     """
     srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service, item.target)
 
@@ -39,79 +134,60 @@ def plugin(srv, item):
 
     if not data or not isinstance(data, dict):
         srv.log.warn("Incorrect payload format (must be dict).")
+        return False
 
-    col_names = []
-    col_definitions = []
-    col_values = []
+    col_types = {}
+    col_values = {}
+    seen = set()
 
     # Determine column types from MQTT payload JSON data.
     # Data is expected to be a dict mapping column names to values, e.g.
     # {"sensor_id": "testsensor", "whatdata": "hello", "data": 1}
     for key in data:
-        srv.log.debug("Key: %r", key)
         key = key.strip()
 
-        if not key or key.startswith('_') or key in ('payload', 'topic'):
+        if not key or key.startswith('_') or key in ('payload', 'raw_payload', 'topic'):
             # We just want to save the payload.
             # There is probably a better way
             continue
 
         value = data[key]
 
-        if isinstance(value, six.integer_types):
+        if isinstance(value, (six.integer_types, float)):
             col_type = 'float'
         elif isinstance(value, six.string_types):
             col_type = 'varchar(20)'
+        else:
+            srv.log.debug("Ignoring key %r with value of unsupported type %s.", key,
+                          type(value).__name__)
+            continue
 
         col_name = normalize_unicode(key)
 
-        if col_name:
-            col_definitions.append('"%s" %s' % (col_name, col_type))
-            col_names.append(col_name)
-            col_values.append(value)
+        # Column names only differing in case are the same column in SQLite
+        if col_name and col_name.lower() not in seen:
+            seen.add(col_name.lower())
+            col_types[col_name] = col_type
+            col_values[col_name] = value
 
-    if not col_names:
+    if not col_types:
         srv.log.warn("No valid column fields found in payload")
         return False
 
-    # Derive SQL table column definition string in case the table has to be created
-    # i.e. 'key1 varchar(20), key2 varchar(20), key3 float'
-    col_definitions = ", ".join(col_definitions)
-
-    # Collect column names for INSERT query string
-    col_names = ', '.join('"%s"' % name for name in col_names)
-
-    # Collect column values and build INSERT query placeholder string
-    col_placeholders = ", ".join(["?"] * len(col_values))
-
     try:
-        conn = sqlite3.connect(path)
-    except sqlite3.Error as exc:
+        writer = get_writer(path, item.config)
+        catalog = get_catalog(path, table)
+    except (sqlite3.Error, ValueError) as exc:
         srv.log.warn("Cannot connect to sqlite at '%s': %s", path, exc)
         return False
 
-    try:
-        query = 'CREATE TABLE IF NOT EXISTS "%s" (%s);' % (table, col_definitions)
-        srv.log.debug("Creating SQLite table: %s", query)
-        with conn:
-            conn.execute(query)
-    except sqlite3.Error as exc:
-        srv.log.warn("Cannot create sqlite table '%s' in '%s': %s", table, path, exc)
-        conn.close()
-        return False
-    else:
-        srv.log.debug("SQLite CREATE TABLE sucessful")
+    query, schema = catalog.get_insert(col_types)
+    params = tuple(col_values[name] for name in sorted(col_values))
+    srv.log.debug("Insert into SQLite: %s %% %r", query, params)
+    # Written asynchronously in batches, errors are logged by the writer
+    writer.insert(schema, query, params)
+    return True
 
-    try:
-        query = 'INSERT INTO "%s" (%s) VALUES (%s);' % (table, col_names, col_placeholders)
-        srv.log.debug("Insert into SQLite: %s %% %r", query, tuple(col_values))
-        with conn:
-            conn.execute(query, col_values)
-    except sqlite3.Error as exc:
-        srv.log.warn("Cannot INSERT INTO sqlite table '%s': %s", table, exc)
-    else:
-        srv.log.debug("SQLite INSERT successful.")
-    finally:
-        conn.close()
 
-    return True
+# Catalogs of the parent process may be outdated after a fork
+os.register_at_fork(after_in_child=_catalogs.clear)
@@ -10,6 +10,7 @@ from datetime import datetime
 
 try:
     import sqlite3
+    from mqttwarn.sqlitewriter import get_writer
 except ImportError:
     sqlite3 = None
 
@@ -19,10 +20,12 @@ def plugin(srv, item):
 
     Records MQTT payload in an SQLite database table with an auto-incrementing integer 'id' column,
     a column called 'payload' of type TEXT and a 'timestamp' column of type 'DATETIME', with
-    the UTC timestamp of when the record is written.
+    the UTC timestamp of when the record is queued for writing.
 
     Expects addrs to contain (path, tablename).
 
+    See the ``sqlite`` service plugin for the options of the shared writer.
+
     """
     srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service, item.target)
 
@@ -34,27 +37,14 @@ def plugin(srv, item):
     table = item.addrs[1]
 
     try:
-        conn = sqlite3.connect(path)
-    except sqlite3.Error as exc:
+        writer = get_writer(path, item.config)
+    except (sqlite3.Error, ValueError) as exc:
         srv.log.warn("Cannot connect to sqlite at %s: %s", path, exc)
         return False
 
-    try:
-        with conn:
-            conn.execute('CREATE TABLE IF NOT EXISTS "%s" (id INTEGER PRIMARY KEY AUTOINCREMENT, '
-                         'payload TEXT, timestamp DATETIME NOT NULL)' % table)
-    except sqlite3.Error as exc:
-        srv.log.warn('Cannot create sqlite table "%s" in %s : %s', table, path, exc)
-        conn.close()
-        return False
-
-    try:
-        with conn:
-            conn.execute('INSERT INTO "%s" VALUES (NULL, ?, ?)' % table,
-                         (item.message, datetime.utcnow()))
-    except sqlite3.Error as exc:
-        srv.log.warn("Cannot INSERT INTO sqlite table '%s': %s", table, exc)
-    finally:
-        conn.close()
-
+    # Written asynchronously in batches, errors are logged by the writer
+    writer.insert(['CREATE TABLE IF NOT EXISTS "%s" (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                   'payload TEXT, timestamp DATETIME NOT NULL)' % table],
+                  'INSERT INTO "%s" VALUES (NULL, ?, ?)' % table,
+                  (item.message, datetime.utcnow()))
     return True
@@ -1,11 +1,5 @@
 # -*- coding: utf-8 -*-
 
-import requests
-try:
-    import json
-except ImportError:
-    import simplejson as json
-
 __author__    = 'Artem Alexandrov <qk4l@tem4uk.ru>'
 __copyright__ = 'Copyright 2016 Artem Alexandrov'
 __license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
@@ -34,10 +28,8 @@ def plugin(srv, item):
             self.tg_url_bot_general = "https://api.telegram.org/bot"
 
         def http_get(self, url):
-            res = requests.get(url)
-            answer = res.text
-            answer_json = json.loads(answer.decode('utf8'))
-            return answer_json
+            res = srv.http.get(url)
+            return res.json()
 
         def get_updates(self):
             """
@@ -93,9 +85,8 @@ def plugin(srv, item):
                       "parse_mode": self.parse_mode, "disable_notification": self.disable_notification}
             srv.log.debug("Trying to /sendMessage: {url}".format(url=url))
             srv.log.debug("post params: " + str(params))
-            res = requests.post(url, params=params)
-            answer = res.text
-            answer_json = json.loads(answer.decode('utf8'))
+            res = srv.http.post(url, params=params)
+            answer_json = res.json()
             if not answer_json["ok"]:
                 srv.log.warn(answer_json)
                 return False
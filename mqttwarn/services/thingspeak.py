@@ -1,9 +1,8 @@
 # -*- coding: utf-8 -*-
 # The code for thingspeak plugin for mqttwarn is based on other plugins
 
-from urllib import urlencode
-from httplib import HTTPSConnection, HTTPException
-from ssl import SSLError
+import requests
+import six
 
 __author__    = 'Marcel Verpaalen'
 __copyright__ = 'Copyright 2015 Marcel Verpaalen'
@@ -29,45 +28,39 @@ def plugin(srv, item):
         srv.log.warn("thingspeak target is incorrectly configured")
         return False
 
-    if isinstance(field_id, basestring):
+    if isinstance(field_id, six.string_types):
         # field_id is an actual thingspeak field
-        builddata.update({field_id: message.encode('utf-8')})
+        builddata.update({field_id: message})
     else:
         # field_id is an ordered list of parsed message data field names
         try:
             for n, f in enumerate(field_id):
                 field = "field%s" % (n+1)
-                value = ("{%s}" % f).format(**item.data).encode('utf-8')
+                value = ("{%s}" % f).format(**item.data)
                 builddata.update({field: value})
         except Exception as exc:
             srv.log.warn("unable to extract fields or values, skipping: %s / %s: %s", field_id, message, exc)
             return False
 
     if build == "true":
-        srv.log.debug("thingspeak content building. Update %s to '%s' stored for later submission." , field_id, message.encode('utf-8'))
+        srv.log.debug("thingspeak content building. Update %s to '%s' stored for later submission." , field_id, message)
         return True
 
     data = {'api_key': apikey}
     data.update(builddata)
     builddata.clear()
 
-    http_handler = HTTPSConnection("api.thingspeak.com")
-
     try:
-        http_handler.request("POST", "/update",
-                         headers={'Content-type': "application/x-www-form-urlencoded"},
-                         body=urlencode(sorted(data.items()))
-                         )
-    except (SSLError, HTTPException), e:
+        response = srv.http.post("https://api.thingspeak.com/update", data=sorted(data.items()))
+    except requests.RequestException as exc:
         srv.log.warn("Thingspeak update failed: %s" % exc)
         return False
 
-    response = http_handler.getresponse()
-    body = response.read()
+    body = response.text
 
     if body == '0':
-        srv.log.warn("Thingspeak channel '%s' field '%s' update failed. Reponse: %s, %s, %s" % (item.target, field_id, response.status, response.reason, body))
+        srv.log.warn("Thingspeak channel '%s' field '%s' update failed. Reponse: %s, %s, %s" % (item.target, field_id, response.status_code, response.reason, body))
     else:
-        srv.log.debug("Reponse: %s, %s, update: %s" % (response.status, response.reason, body))
+        srv.log.debug("Reponse: %s, %s, update: %s" % (response.status_code, response.reason, body))
 
     return True
@@ -6,8 +6,182 @@ __license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/
 
 # this is basically the file.py service but declined for websockets, not more than s/file/websocket/g
 
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 import websocket # pip install websocket-client
 
+from mqttwarn.util import shutdown_event, shutdown_timeout, start_flusher
+
+log = logging.getLogger(__name__)
+
+# Senders by URI, least recently used first
+_senders = OrderedDict()
+_senders_lock = threading.Lock()
+
+
+class WebSocketSender(object):
+    """Send messages to a websocket server through a persistent connection.
+
+    Messages are put into a queue of up to ``max_queued`` messages, which is
+    drained by a thread of its own. The thread sends a ping frame when no
+    message has been sent for ``ping_interval`` seconds and reconnects after
+    errors, with an increasing delay (up to a minute). The message, which
+    could not be sent, is sent again after reconnecting.
+
+    The sender stops, after sending the queued messages, when ``send()``
+    makes room for another sender or when no message has been queued for
+    ``idle_timeout`` seconds.
+
+    """
+
+    def __init__(self, uri, max_queued=10000, ping_interval=30, timeout=10, idle_timeout=300):
+        self.uri = uri
+        self.ping_interval = ping_interval
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.ws = None
+        self.retry_delay = 0
+        self.last_sent = 0
+        self.last_queued = time.monotonic()
+        self.dropped = 0
+        self.stopped = False
+        self.thread = start_flusher(self._run, 'websocket-%s' % uri)
+
+    def send(self, text):
+        """Queue message to be sent, return False if the queue is full."""
+        try:
+            self.queue.put_nowait(text)
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+        self.last_queued = time.monotonic()
+        return True
+
+    def stop_if_idle(self):
+        with _senders_lock:
+            if (self.queue.empty() and
+                    time.monotonic() - self.last_queued >= self.idle_timeout):
+                log.debug("Closing idle connection to websocket `%s'.", self.uri)
+                self.stopped = True
+
+                if _senders.get(self.uri) is self:
+                    del _senders[self.uri]
+
+    def connect(self):
+        self.ws = websocket.create_connection(self.uri, timeout=self.timeout)
+        log.debug("Connected to websocket `%s'.", self.uri)
+
+    def close(self):
+        if self.ws is not None:
+            try:
+                self.ws.close()
+            except Exception:
+                pass
+
+            self.ws = None
+
+    def _send(self, text):
+        """Send message (or ping frame, if ``text`` is None), return False on errors."""
+        try:
+            if self.ws is None:
+                self.connect()
+
+            if text is None:
+                self.ws.ping()
+            else:
+                self.ws.send(text)
+        except Exception as exc:
+            log.warning("Cannot write to websocket `%s': %s", self.uri, exc)
+            self.close()
+            self.retry_delay = min(max(self.retry_delay * 2, 1), 60)
+            return False
+
+        self.retry_delay = 0
+        return True
+
+    def _run(self):
+        text = None
+        deadline = None
+
+        while True:
+            if text is None:
+                try:
+                    text = self.queue.get(timeout=1.0)
+                except queue.Empty:
+                    idle = time.monotonic() - self.last_sent
+
+                    if self.ws is not None and idle >= self.ping_interval:
+                        self._send(None)
+                        self.last_sent = time.monotonic()
+
+                    self.stop_if_idle()
+
+            if self.stopped or shutdown_event.is_set():
+                if deadline is None:
+                    deadline = time.monotonic() + min(self.timeout,
+                                                      shutdown_timeout(self.timeout))
+
+                if (text is None and self.queue.empty()) or time.monotonic() > deadline:
+                    break
+
+            if text is None:
+                continue
+
+            if self._send(text):
+                self.last_sent = time.monotonic()
+                text = None
+            else:
+                # Keep the message for the next attempt
+                shutdown_event.wait(self.retry_delay)
+
+        if text is not None or not self.queue.empty():
+            log.warning("Discarding %i unsent messages to websocket `%s'.",
+                        self.queue.qsize() + (text is not None), self.uri)
+
+        self.close()
+
+
+def send(uri, text, config=None):
+    """Queue message for the ``WebSocketSender`` of given URI, creating it if needed.
+
+    At most ``max_connections`` senders are kept, the least recently used one
+    is stopped to make room for a new one. Returns False if the message could
+    not be queued.
+
+    """
+    config = config or {}
+
+    # Queue the message while holding the lock, so that the sender is not stopped in between
+    with _senders_lock:
+        sender = _senders.get(uri)
+
+        if sender is None:
+            sender = _senders[uri] = WebSocketSender(
+                uri,
+                max_queued=config.get('max_queued', 10000),
+                ping_interval=config.get('ping_interval', 30),
+                timeout=config.get('timeout', 10),
+                idle_timeout=config.get('idle_timeout', 300))
+
+            while len(_senders) > config.get('max_connections', 20):
+                _senders.popitem(last=False)[1].stopped = True
+        else:
+            _senders.move_to_end(uri)
+
+        return sender.send(text)
+
+
 def plugin(srv, item):
 
     srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service, item.target)
@@ -19,19 +193,19 @@ def plugin(srv, item):
     # addrs is a list[] associated with a particular target.
     # While it may contain more than one item (e.g. pushover)
     # the `websocket' service carries one only, i.e. a ws:// or wss:// uri
-    uri = item.addrs[0].format(**item.data).encode('utf-8')
+    uri = item.addrs[0].format(**item.data)
 
     # If the incoming payload has been transformed, use that,
     # else the original payload
     text = item.message
 
-    try:
-        ws = websocket.WebSocket()
-        ws.connect(uri)
-        ws.send(text)
-        ws.close()
-    except Exception as exc:
-        srv.log.warning("Cannot write to websocket `%s': %s" % (uri, exc))
+    # Sent in the background, errors are logged by the sender
+    if not send(uri, text, config):
+        srv.log.warning("Cannot write to websocket `%s': send queue full" % (uri))
         return False
 
     return True
+
+
+# Connections (and their threads) of the parent process are not usable after a fork
+os.register_at_fork(after_in_child=_senders.clear)
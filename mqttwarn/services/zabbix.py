@@ -9,84 +9,149 @@ try:
 except ImportError:
     import simplejson as json
 from vendor import ZabbixSender
+import threading
 import time
 
-def plugin(srv, item):
+from mqttwarn.util import shutdown_event, start_flusher
 
-    srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service, item.target)
 
-    try:
-        trapper, port = item.addrs
-    except:
-        srv.log.error("Module target is incorrectly configured")
-        return False
+class Plugin:
+    """zabbix service plugin.
 
-    host = item.config.get('host', 'MQTT_BUS')
-    discovery_key = item.config.get('discovery_key', 'mqtt.discovery')
+    Items are sent to the trapper in the background, in requests of up to
+    ``batch_size`` items, every ``flush_interval`` seconds.
 
-    client = item.data.get('client', None)
-    if client is None:
-        srv.log.warn("No client in item; ignoring")
-        return False
+    Clients, which have been added to Zabbix LLD, are remembered, so that LLD
+    is only sent when a new client appears. The status of a new client is
+    sent ``status_delay`` seconds after its LLD, since Zabbix fails the value
+    if the LLD for the host hasn't been recorded yet.
 
-    # If status_key is in item (set by function ZabbixData()), then we have to
-    # add a host to Zabbix LLD, and the value of the message is 0/1 to indicate
-    # host down/up
-    status_key = item.data.get('status_key', None)
-    if status_key is not None:
-        status = item.message
+    """
 
-        clients = []
-        clients.append( { '{#MQTTHOST}' : client } )
+    def __init__(self, srv=None, config=None):
+        self.srv = srv
+        conf = (config or {}).get
+        self.host = conf('host', 'MQTT_BUS')
+        self.discovery_key = conf('discovery_key', 'mqtt.discovery')
+        self.status_delay = conf('status_delay', 3)
+        self.flush_interval = conf('flush_interval', 1.0)
+        self.batch_size = conf('batch_size', 250)
+        self.timeout = conf('timeout', 10)
+        # Discovered clients by trapper (host, port): {client: time of discovery}
+        self.discovered = {}
+        # Items to send by trapper: lists of (due time, (host, key, value, clock))
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.sender = start_flusher(self.run_sender, 'zabbix-sender', self.wakeup)
 
-        # {"data": [{"{#MQTTHOST}": "jog02"}]}
-        lld_payload = json.dumps(dict(data = clients))
+    def add(self, trapper, due, host, key, value):
+        with self.lock:
+            pending = self.pending.setdefault(trapper, [])
+            pending.append((due, (host, key, value, int(time.time()))))
 
-        try:
-            # Add LLD for the client host to Zabbix
-            sender = ZabbixSender.ZabbixSender(trapper, server_port = int(port))
-            sender.AddData(host=host, key=discovery_key, value=lld_payload)
-            res = sender.Send()
-            sender.ClearData()
-
-            if res and 'info' in res:
-                srv.log.debug("Trapper for LLD responds with %s" % res['info'])
-
-                # Add status to the "status key". This must not happen too early,
-                # or Zabbix will fail this value if the LLD for the host hasn't
-                # been recorded. Attempt a sleep. FIXME
-                time.sleep(3)  # FIXME
-                sender.AddData(host=client, key=status_key, value=status)
-                res = sender.Send()
-                sender.ClearData()
-                if res and 'info' in res:
-                    srv.log.debug("Trapper for STATUS responds with %s" % res['info'])
-
-                return True
-        except Exception as exc:
-            srv.log.warn("Trapper responded: %s", exc)
-            return False
+            if len(pending) >= self.batch_size:
+                self.wakeup.set()
+
+    def discover(self, trapper, client):
+        """Send LLD with all clients seen so far if ``client`` is new.
+
+        Returns the time, after which the status of the client may be sent.
 
-    # We are adding a normal item/value via the trapper
-    key = item.data.get('key', None)
-    if client is None or key is None:
-        srv.log.warn("Client or Key missing in item; ignoring")
-        return False
+        """
+        with self.lock:
+            clients = self.discovered.setdefault(trapper, {})
 
-    value = item.message
+            if client in clients:
+                return clients[client] + self.status_delay
 
-    try:
-        # Send item/value for host to the trapper
-        sender = ZabbixSender.ZabbixSender(trapper, server_port = int(port))
-        sender.AddData(host=client, key=key, value=value)
+            discovered_at = clients[client] = time.time()
+            # {"data": [{"{#MQTTHOST}": "jog02"}, ...]}
+            lld_payload = json.dumps(dict(data=[{'{#MQTTHOST}': c} for c in sorted(clients)]))
+
+        self.add(trapper, 0, self.host, self.discovery_key, lld_payload)
+        return discovered_at + self.status_delay
+
+    def send(self, trapper, items):
+        sender = ZabbixSender.ZabbixSender(trapper[0], server_port=trapper[1],
+                                           timeout=self.timeout)
+        sender.AddItems(items)
         res = sender.Send()
-        sender.ClearData()
 
         if res and 'info' in res:
-            srv.log.debug("Trapper for client=%s, item=%s, value=%s responds with %s" % (client, key, value, res['info']))
+            self.srv.log.debug("Trapper for %i items responds with %s", len(items), res['info'])
+
+    def flush(self, final=False):
+        """Send pending items, which are due (all of them, if ``final``)."""
+        now = time.time()
+
+        with self.lock:
+            due = {}
+
+            for trapper, pending in self.pending.items():
+                due[trapper] = [item for due_time, item in pending if final or due_time <= now]
+                self.pending[trapper] = [entry for entry in pending
+                                         if not (final or entry[0] <= now)]
+
+        for trapper, items in due.items():
+            for i in range(0, len(items), self.batch_size):
+                batch = items[i:i + self.batch_size]
+
+                try:
+                    self.send(trapper, batch)
+                except Exception as exc:
+                    self.srv.log.warn("Trapper %s:%s responded: %s", trapper[0], trapper[1], exc)
+
+                    if any(item[1] == self.discovery_key for item in batch):
+                        # Send LLD again with the next status of each client
+                        with self.lock:
+                            self.discovered.pop(trapper, None)
+
+    def run_sender(self):
+        while not shutdown_event.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
 
+        self.flush(final=True)
+
+    def plugin(self, srv, item):
+
+        srv.log.debug("*** MODULE=%s: service=%s, target=%s", __file__, item.service,
+                      item.target)
+
+        try:
+            trapper, port = item.addrs
+            trapper = (trapper, int(port))
+        except:
+            srv.log.error("Module target is incorrectly configured")
+            return False
+
+        client = item.data.get('client', None)
+        if client is None:
+            srv.log.warn("No client in item; ignoring")
+            return False
+
+        # If status_key is in item (set by function ZabbixData()), then we have to
+        # add a host to Zabbix LLD, and the value of the message is 0/1 to indicate
+        # host down/up
+        status_key = item.data.get('status_key', None)
+        if status_key is not None:
+            status = item.message
+
+            # Add status to the "status key". This must not happen too early after
+            # adding the LLD for a new client, or Zabbix will fail this value.
+            self.add(trapper, self.discover(trapper, client), client, status_key, status)
             return True
-    except Exception as exc:
-        srv.log.warn("Trapper responded: %s", exc)
 
-    return False
+        # We are adding a normal item/value via the trapper
+        key = item.data.get('key', None)
+        if client is None or key is None:
+            srv.log.warn("Client or Key missing in item; ignoring")
+            return False
+
+        # Sent in the background, errors are logged by the sender thread
+        self.add(trapper, 0, client, key, item.message)
+        return True
+
+    __call__ = plugin
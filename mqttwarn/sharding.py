@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# (c) 2014-2019 The mqttwarn developers
+"""Multi-process mode: fan out received messages to worker processes partitioned by topic."""
+
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+
+
+log = logging.getLogger(__name__)
+
+
+def shard_for(topic, num_shards):
+    """Return index of the shard responsible for the given topic.
+
+    Uses a hash function, which is stable across processes, so that all
+    messages on a topic are handled, in order, by the same worker process.
+
+    """
+    if isinstance(topic, str):
+        topic = topic.encode('utf-8')
+
+    return zlib.crc32(topic) % num_shards
+
+
+class PublishProxy(object):
+    """Stand-in for the MQTT client object in worker processes.
+
+    Calls to ``publish()`` are relayed to the process owning the broker
+    connection, which publishes the messages with the real client.
+
+    """
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.outbox.put(('publish', topic, payload, qos, retain))
+
+
+class ShardRouter(object):
+    """Owner-side end of the multi-process mode.
+
+    Starts ``num_shards`` worker processes, each running ``target(shard_id,
+    inbox, outbox)``, and distributes messages among them via pipe-backed
+    queues by hashing the message topic.
+
+    Worker processes send messages to publish and status reports (see
+    ``get_status()``) back via a queue shared by all of them.
+
+    """
+
+    def __init__(self, num_shards, target):
+        self.num_shards = num_shards
+        self.target = target
+        self.processes = []
+        self.inboxes = []
+        self.outbox = None
+        self.relay_thread = None
+        self.dispatched = [0] * num_shards
+        # Messages may be dispatched by several threads
+        self.lock = threading.Lock()
+        # Status reports of the worker processes: (request number, shard id, status)
+        self.status_replies = queue.Queue()
+        self.status_requests = 0
+        self.status_lock = threading.Lock()
+        # Child processes inherit the fully set up runtime state of the
+        # parent process, so the "fork" start method is required.
+        self.mp = multiprocessing.get_context('fork')
+
+    def start(self):
+        self.outbox = self.mp.Queue()
+
+        for shard_id in range(self.num_shards):
+            inbox = self.mp.Queue()
+            proc = self.mp.Process(target=self.target, args=(shard_id, inbox, self.outbox),
+                                   name='mqttwarn-shard-%i' % shard_id)
+            proc.daemon = True
+            proc.start()
+            log.debug("Started worker process #%i (pid %i).", shard_id, proc.pid)
+            self.inboxes.append(inbox)
+            self.processes.append(proc)
+
+    def start_relay(self, mqttc):
+        """Start thread publishing messages relayed from worker processes via ``mqttc``."""
+        def relay():
+            while True:
+                item = self.outbox.get()
+
+                if item is None:
+                    break
+
+                if item[0] == 'status':
+                    self.status_replies.put(item[1:])
+                    continue
+
+                topic, payload, qos, retain = item[1:]
+
+                try:
+                    mqttc.publish(topic, payload, qos=qos, retain=retain)
+                except Exception as exc:
+                    log.warning("Cannot publish message relayed from worker process to '%s': %s",
+                                topic, exc)
+
+        self.relay_thread = threading.Thread(target=relay, name='shard-relay')
+        self.relay_thread.daemon = True
+        self.relay_thread.start()
+
+    def dispatch(self, msg):
+        """Pass received MQTT message to the worker process responsible for its topic."""
+        shard_id = shard_for(msg.topic, self.num_shards)
+        self.inboxes[shard_id].put(('message', msg.topic, msg.payload, msg.qos, msg.retain))
+
+        with self.lock:
+            self.dispatched[shard_id] += 1
+
+    def dispatch_failover(self, reason, message):
+        """Let the worker process responsible for ``reason`` handle a failover event."""
+        self.inboxes[shard_for(reason, self.num_shards)].put(('failover', reason, message))
+
+    def dispatch_job(self, record):
+        """Let the worker process responsible for the job's topic restore a saved job."""
+        self.inboxes[shard_for(record['topic'], self.num_shards)].put(('job', record))
+
+    def get_status(self, timeout=2.0):
+        """Return list of the status dicts reported by the worker processes.
+
+        Worker processes answer after the messages already passed to them were
+        queued. The status of a worker process, which does not answer within
+        ``timeout`` seconds, is None.
+
+        """
+        with self.status_lock:
+            self.status_requests += 1
+            request = self.status_requests
+            deadline = time.monotonic() + timeout
+            status = [None] * self.num_shards
+
+            for inbox in self.inboxes:
+                inbox.put(('status', request))
+
+            while None in status:
+                try:
+                    number, shard_id, shard_status = self.status_replies.get(
+                        timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+
+                # Late answers to an earlier request are ignored
+                if number == request:
+                    status[shard_id] = shard_status
+
+            return status
+
+    def stop(self, timeout=None):
+        """Let worker processes finish their queued messages and wait for them to exit.
+
+        Worker processes get ``timeout`` seconds (in total) to finish, they
+        receive the deadline along with the request to stop.
+
+        """
+        # Wall clock time, which is the same in all processes
+        deadline = None if timeout is None else time.time() + timeout
+
+        for inbox in self.inboxes:
+            inbox.put(('stop', deadline))
+
+        for shard_id, proc in enumerate(self.processes):
+            proc.join(None if deadline is None else max(deadline - time.time(), 0))
+
+            if proc.is_alive():
+                # Worker processes ignore SIGTERM
+                log.warning("Worker process #%i did not exit in time, killing it.", shard_id)
+                proc.kill()
+
+        if self.outbox is not None:
+            self.outbox.put(None)
+
+        log.info("Messages dispatched to worker processes: %s.",
+                 ", ".join("#%i=%i" % item for item in enumerate(self.dispatched)))
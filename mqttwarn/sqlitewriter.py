@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# (c) 2014-2019 The mqttwarn developers
+"""Shared, batching writer for the SQLite service plugins.
+
+Opening a database, creating its table and committing a transaction for each
+message limits throughput to a few hundred messages per second, mostly
+because of the disk syncs on every commit. Instead, the SQLite service
+plugins hand their INSERT statements to the ``SQLiteWriter`` of the database
+file, which keeps one connection open in WAL mode and executes the queued
+statements from a dedicated thread, grouping as many as are available into
+one transaction.
+
+"""
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from itertools import groupby
+
+from mqttwarn.util import shutdown_event, start_flusher
+
+
+log = logging.getLogger(__name__)
+
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+class SQLiteWriter(object):
+    """Execute INSERT statements for one database file in batches from a writer thread.
+
+    ``insert()`` only queues a statement and returns immediately. The writer
+    thread executes all queued statements with the same SQL in one
+    ``executemany()`` call and commits up to ``batch_size`` of them at once.
+    If the queue holds ``max_pending`` statements, ``insert()`` blocks until
+    the writer has caught up.
+
+    The statements needed to create a table (or add columns to it) are
+    executed once per table and remembered afterwards.
+
+    Statements still queued are written when mqttwarn shuts down, unless
+    that takes longer than its ``drain_timeout``. The writer thread stops
+    once the queue is empty then.
+
+    """
+
+    def __init__(self, path, synchronous='NORMAL', batch_size=500, max_pending=10000,
+                 busy_timeout=30.0):
+        synchronous = str(synchronous).upper()
+
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError("Invalid value for 'synchronous': %s (must be one of %s)." %
+                             (synchronous, ", ".join(SYNCHRONOUS_MODES)))
+
+        self.path = path
+        self.batch_size = batch_size
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        # Schema statements, which were already executed successfully
+        self.schema = set()
+        self.queue = queue.Queue(max_pending)
+        # Transactions are handled explicitly by the writer thread
+        self.conn = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None,
+                                    check_same_thread=False)
+
+        if path != ':memory:':
+            self.conn.execute('PRAGMA journal_mode=WAL')
+
+        self.conn.execute('PRAGMA synchronous=%s' % synchronous)
+        self.thread = start_flusher(self._run, 'sqlite-writer')
+        log.debug("Opened SQLite database '%s' (synchronous=%s).", path, synchronous)
+
+    def __repr__(self):
+        return "<SQLiteWriter('%s')>" % self.path
+
+    def insert(self, schema, sql, params):
+        """Queue statement ``sql`` to be executed with ``params``.
+
+        ``schema`` is a sequence of statements, which must have been executed
+        (once) before ``sql``, e.g. ``CREATE TABLE IF NOT EXISTS ...``.
+
+        """
+        self.queue.put((tuple(schema), sql, params))
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=0.5)]
+            except queue.Empty:
+                if not shutdown_event.is_set():
+                    continue
+
+                break
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._write(batch)
+
+        self.conn.close()
+        log.debug("Closed SQLite database '%s' (%i rows written in %i transactions, "
+                  "%i failed).", self.path, self.written, self.batches, self.failed)
+
+    def _execute_schema(self, statement):
+        try:
+            self.conn.execute(statement)
+        except sqlite3.OperationalError as exc:
+            # The column may have been added by another writer (or process) in the meantime
+            if 'ADD COLUMN' not in statement or 'duplicate column name' not in str(exc):
+                raise
+
+            log.debug("Column already exists in SQLite database '%s': %s", self.path, statement)
+
+    def _write(self, batch):
+        schema = set()
+
+        try:
+            self.conn.execute('BEGIN')
+
+            # Keep order of statements, but group consecutive ones with the same SQL
+            for (statements, sql), items in groupby(batch, lambda item: item[:2]):
+                for statement in statements:
+                    if statement not in self.schema and statement not in schema:
+                        self._execute_schema(statement)
+                        schema.add(statement)
+
+                self.conn.executemany(sql, [item[2] for item in items])
+
+            self.conn.execute('COMMIT')
+        except sqlite3.Error as exc:
+            if self.conn.in_transaction:
+                self.conn.execute('ROLLBACK')
+
+            if len(batch) == 1:
+                self.failed += 1
+                log.warning("Cannot write to SQLite database '%s': %s (SQL: %s)", self.path, exc,
+                            batch[0][1])
+            else:
+                # Write statements one by one, so that only the faulty ones are lost
+                for item in batch:
+                    self._write([item])
+        else:
+            self.schema.update(schema)
+            self.written += len(batch)
+            self.batches += 1
+
+
+def get_writer(path, config=None):
+    """Return the ``SQLiteWriter`` for the database file at ``path``, creating it if needed.
+
+    ``config`` is the service configuration dict, from which the options
+    ``synchronous`` and ``batch_size`` are taken when the writer is created.
+
+    """
+    key = path if path == ':memory:' else os.path.abspath(path)
+
+    with _writers_lock:
+        writer = _writers.get(key)
+
+        if writer is None:
+            config = config or {}
+            writer = _writers[key] = SQLiteWriter(path,
+                                                  synchronous=config.get('synchronous', 'NORMAL'),
+                                                  batch_size=config.get('batch_size', 500))
+
+    return writer
+
+
+# Writers (and their threads) of the parent process are not usable after a fork
+os.register_at_fork(after_in_child=_writers.clear)
@@ -1,12 +1,37 @@
 # -*- coding: utf-8 -*-
 # (c) 2014-2019 The mqttwarn developers
 
+import atexit
 import importlib
+import itertools
+import json
+import logging
+import os
 import pkg_resources
 import re
+import threading
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import six
 
+log = logging.getLogger(__name__)
+
+# Set when mqttwarn shuts down, threads started by ``start_flusher()`` then
+# write what they buffered and exit
+shutdown_event = threading.Event()
+# Value of ``time.monotonic()`` by which shutting down must be done, if limited
+shutdown_deadline = None
+# Tuples of (thread, wakeup event) started by ``start_flusher()``
+_flushers = []
+_flushers_lock = threading.Lock()
+
 
 class Struct:
     """Convert Python dict to data object.
@@ -27,6 +52,245 @@ class Struct:
         return {k: v for k, v in six.iteritems(self.__dict__)}
 
 
+class RingBuffer(object):
+    """Preallocated, bounded FIFO buffer for handing off items between threads.
+
+    Unless asked to wait for space, ``put()`` never blocks: if the buffer is
+    full, the item is dropped and counted instead. ``get()`` blocks until an
+    item is available or the buffer was closed.
+
+    """
+    def __init__(self, size):
+        self.size = size
+        self.closed = False
+        # Number of items put into / dropped by the buffer so far
+        self.received = 0
+        self.dropped = 0
+        # Maximum number of items held by the buffer at the same time
+        self.high_watermark = 0
+        self._slots = [None] * size
+        self._head = 0
+        self._count = 0
+        self._not_empty = threading.Condition(threading.Lock())
+        self._not_full = threading.Condition(self._not_empty)
+
+    def __len__(self):
+        return self._count
+
+    def put(self, item, block=False):
+        """Append item to buffer, return False if it was dropped because the buffer is full.
+
+        With ``block``, wait for space instead, unless the buffer was closed.
+
+        """
+        with self._not_empty:
+            if block:
+                while self._count >= self.size and not self.closed:
+                    self._not_full.wait()
+
+            if self._count >= self.size:
+                self.dropped += 1
+                return False
+
+            self._slots[(self._head + self._count) % self.size] = item
+            self._count += 1
+            self.received += 1
+
+            if self._count > self.high_watermark:
+                self.high_watermark = self._count
+
+            self._not_empty.notify()
+
+        return True
+
+    def get(self):
+        """Remove and return oldest item from buffer.
+
+        Returns None when the buffer is empty and was closed.
+
+        """
+        with self._not_empty:
+            while not self._count:
+                if self.closed:
+                    return None
+
+                self._not_empty.wait()
+
+            item = self._slots[self._head]
+            self._slots[self._head] = None
+            self._head = (self._head + 1) % self.size
+            self._count -= 1
+            self._not_full.notify()
+            return item
+
+    def take_all(self):
+        """Remove and return all items from the buffer, oldest first."""
+        with self._not_empty:
+            items = [self._slots[(self._head + i) % self.size] for i in range(self._count)]
+            self._slots = [None] * self.size
+            self._head = 0
+            self._count = 0
+            self._not_full.notify_all()
+            return items
+
+    def close(self):
+        """Wake up all consumers, which will receive None once the buffer is empty."""
+        with self._not_empty:
+            self.closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'occupancy': self._count,
+            'high_watermark': self.high_watermark,
+            'received': self.received,
+            'dropped': self.dropped,
+        }
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as JSON objects, one per line."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class AsyncLogHandler(QueueHandler):
+    """Queue log records for a listener thread, which passes them to ``handler``.
+
+    Records are still formatted by the thread emitting them (see
+    ``QueueHandler.prepare()``), only writing them is left to the listener.
+    Closing the handler, e.g. by ``logging.shutdown()``, writes the records
+    still queued and stops the listener. Forked child processes start a
+    listener of their own.
+
+    """
+
+    def __init__(self, handler):
+        super(AsyncLogHandler, self).__init__(queue.Queue())
+        self.handler = handler
+        self.listener = None
+        self.start()
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.start)
+
+    def start(self):
+        # The listener thread of the parent does not exist in a child process
+        self.queue = queue.Queue()
+        self.listener = QueueListener(self.queue, self.handler, respect_handler_level=True)
+        self.listener.start()
+
+    def close(self):
+        listener, self.listener = self.listener, None
+
+        if listener is not None:
+            listener.stop()
+
+        super(AsyncLogHandler, self).close()
+
+
+class DebugSampler(logging.Filter):
+    """Only let every ``rate``-th DEBUG log record pass, records of higher levels pass always."""
+
+    def __init__(self, rate):
+        super(DebugSampler, self).__init__()
+        self.rate = rate
+        self._counter = itertools.count()
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or next(self._counter) % self.rate == 0
+
+
+def start_flusher(target, name, wakeup=None):
+    """Start daemon thread ``name`` running ``target``, which flushes buffered data.
+
+    ``target`` should wait on ``shutdown_event`` (or on ``wakeup``, which is
+    set along with it) between its periodic flushes, flush one final time
+    after ``shutdown_event`` was set and return. Being a daemon thread, it
+    does not keep the process alive beyond ``stop_flushers()``.
+
+    """
+    thread = threading.Thread(target=target, name=name)
+    thread.daemon = True
+
+    with _flushers_lock:
+        # Forget about threads, which have exited already (e.g. idle websocket senders)
+        _flushers[:] = [flusher for flusher in _flushers if flusher[0].is_alive()]
+        _flushers.append((thread, wakeup))
+
+    thread.start()
+    return thread
+
+
+def set_shutdown_deadline(deadline):
+    """Limit shutting down, including the final flushes, to ``deadline`` (``time.monotonic()``)."""
+    global shutdown_deadline
+    shutdown_deadline = deadline
+
+
+def shutdown_timeout(default=None):
+    """Return the seconds left until the shutdown deadline, ``default`` if there is none."""
+    if shutdown_deadline is None:
+        return default
+
+    return max(shutdown_deadline - time.monotonic(), 0)
+
+
+def stop_flushers():
+    """Signal threads started by ``start_flusher()`` to exit and wait for their final flush.
+
+    Waits until the shutdown deadline at most, threads still running then are
+    abandoned, along with the data they have not written yet.
+
+    """
+    shutdown_event.set()
+
+    with _flushers_lock:
+        flushers = list(_flushers)
+        del _flushers[:]
+
+    for thread, wakeup in flushers:
+        if wakeup is not None:
+            wakeup.set()
+
+    for thread, wakeup in flushers:
+        thread.join(shutdown_timeout())
+
+        if thread.is_alive():
+            log.warning("Thread '%s' did not finish its final flush in time, abandoning it.",
+                        thread.name)
+
+
+def _reset_flushers():
+    # The flushing threads of the parent do not exist in a child process
+    global shutdown_deadline, _flushers_lock
+    _flushers_lock = threading.Lock()
+    del _flushers[:]
+    shutdown_event.clear()
+    shutdown_deadline = None
+
+
+# Flush when exiting without mqttwarn's own shutdown, e.g. after ``--plugin``
+atexit.register(stop_flushers)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_flushers)
+
+
 def is_funcspec(s):
     if s and ':' in s:
         dottedpath, name = s.split(':', 1)